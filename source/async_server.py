@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+#coding:utf-8
+# Author:   AIFDR www.aifdr.org
+# Purpose:  Event loop front end for the RPC server
+# Created: 10/18/2026
+
+"""Serve XMLRPC and JSON-RPC requests from a single event loop thread
+
+The threaded front end (rpc_server.RequestHandler) ties up a worker thread
+while it reads a request and writes the response. Here one thread reads
+and writes all connections with asyncore, and only the calls themselves
+are handed to the bounded worker pool of the server. Slow clients (e.g.
+dashboards polling job status over poor links) then cost a socket and a
+little memory each.
+
+Requests are decoded, dispatched and encoded by the same server object as
+with the threaded front end, so methods, statistics, caching, request ids,
+deadlines and scratch directories work the same. Requests arriving while
+the worker queue is full are answered with a SERVER_BUSY fault at once.
+"""
+
+import asyncore
+import asynchat
+import socket
+import errno
+import time
+import logging
+import collections
+import mimetools
+import StringIO
+import Queue
+import xmlrpclib
+from context import set_context
+
+
+class AsyncFrontEnd(asyncore.dispatcher):
+    """Accept connections on the socket of server and serve them from an event loop
+    
+    Arguments
+        server = rpc_server.XMLRPCServer_overload whose socket is listened
+                 on and whose worker pool runs the calls. Its pool_size
+                 must be at least 1.
+        xmlrpc_path, json_path = request paths for XMLRPC and JSON-RPC
+    
+    The keep-alive and gzip settings are taken from the server. Run
+    serve_forever until the server is told to stop, then drain.
+    """
+    
+    # Seconds between checks for idle connections
+    sweep_interval = 1.0
+    
+    # Requests with longer headers are refused
+    max_header_size = 65536
+    
+    # Connections waiting to be accepted. With the default of SocketServer
+    # (5), clients connecting in a burst wait for a SYN retransmission.
+    backlog = socket.SOMAXCONN
+    
+    def __init__(self, server, xmlrpc_path='/RPC2', json_path='/JSON'):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.server = server
+        self.xmlrpc_path = xmlrpc_path
+        self.json_path = json_path
+        
+        server.socket.setblocking(0)
+        server.socket.listen(self.backlog)
+        self.set_socket(server.socket, self.map)
+        self.accepting = True
+        self.paused = False  # Out of file descriptors
+        
+        self.connections = set()
+        self.in_flight = 0
+        
+        # Responses of calls completed by worker threads, sent by the loop
+        self.completed = collections.deque()
+    
+    
+    def serve_forever(self):
+        """Serve until the server is told to stop (see request_stop)
+        """
+        
+        server = self.server
+        server.start_serving()
+        self.waker = Waker(server.wakeup_r, self.map)
+        
+        last_sweep = time.time()
+        while not server.quit:
+            asyncore.loop(self.sweep_interval, True, self.map, 1)
+            self.send_completed()
+            while server.deferred:
+                server.deferred.pop(0)()
+            
+            now = time.time()
+            if now - last_sweep >= self.sweep_interval:
+                self.close_idle(now - server.keepalive_timeout)
+                last_sweep = now
+    
+    
+    def drain(self, timeout):
+        """Stop accepting and send the responses of requests already accepted
+        
+        Call after serve_forever has returned. Idle connections are closed
+        at once and the others as soon as their response is sent. Returns
+        the number of responses not sent within timeout seconds.
+        """
+        
+        deadline = time.time() + timeout
+        self.accepting = False
+        self.del_channel(self.map)  # The server closes the socket itself
+        
+        self.close_idle(time.time())
+        while self.in_flight and time.time() < deadline:
+            asyncore.loop(0.1, True, self.map, 1)
+            self.send_completed()
+            self.close_idle(time.time())
+        
+        # Let the last responses go out
+        while [c for c in self.connections if c.writable()] and time.time() < deadline:
+            asyncore.loop(0.1, True, self.map, 1)
+        
+        for connection in list(self.connections):
+            connection.close()
+        self.waker.close()
+        return self.in_flight
+    
+    
+    def readable(self):
+        return self.accepting and not self.paused
+    
+    
+    def writable(self):
+        return False
+    
+    
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error, e:
+            if e.args[0] in (errno.EMFILE, errno.ENFILE):
+                # Wait for a connection to close rather than spinning
+                logging.warning('Out of file descriptors with %i connections open' % len(self.connections))
+                self.paused = True
+                return
+            raise
+        if pair is None:
+            return  # Taken by another process
+        
+        sock, address = pair
+        self.connections.add(AsyncConnection(sock, address, self))
+    
+    
+    def handle_error(self):
+        # Keep listening whatever goes wrong with one connection
+        logging.exception('Error in event loop')
+    
+    
+    def remove(self, connection):
+        self.connections.discard(connection)
+        self.paused = False
+    
+    
+    def submit(self, connection, function):
+        """Run function(), which returns a response, on the worker pool
+        
+        Raises Queue.Full if the worker queue is full.
+        """
+        
+        def call():
+            response = None
+            try:
+                response = function()
+            finally:
+                self.completed.append((connection, response))
+                self.server.wake()
+        
+        self.server.submit(call)
+        self.in_flight += 1
+    
+    
+    def send_completed(self):
+        while self.completed:
+            connection, response = self.completed.popleft()
+            self.in_flight -= 1
+            if connection.connected:
+                connection.send_response(response)
+    
+    
+    def close_idle(self, last_active):
+        """Close connections without running requests inactive since last_active
+        """
+        
+        for connection in list(self.connections):
+            if (not connection.busy and not connection.producer_fifo and
+                connection.last_active <= last_active):
+                connection.close()
+
+
+class Waker(asyncore.file_dispatcher):
+    """Read wakeup bytes so that worker threads and signals end loop waits
+    """
+    
+    def readable(self):
+        return True
+    
+    
+    def writable(self):
+        return False
+    
+    
+    def handle_read(self):
+        try:
+            self.recv(512)
+        except OSError:
+            pass
+
+
+class AsyncConnection(asynchat.async_chat):
+    """One client connection, serving one HTTP request at a time
+    
+    Requests are POSTs of XMLRPC or JSON-RPC documents as for
+    rpc_server.RequestHandler. Pipelined requests are answered in order.
+    """
+    
+    def __init__(self, sock, address, frontend):
+        asynchat.async_chat.__init__(self, sock, frontend.map)
+        self.address = address
+        self.frontend = frontend
+        self.server = frontend.server
+        
+        self.data = []
+        self.size = 0
+        self.request = None   # (request line, headers) while reading the body
+        self.pending = []     # Requests read but not yet answered
+        self.busy = False     # Waiting for a worker to answer a request
+        self.closing = False
+        self.requests = 0
+        self.last_active = time.time()
+        self.set_terminator('\r\n\r\n')
+    
+    
+    def readable(self):
+        # Leave further requests in the socket while one is being answered
+        return (not self.busy and not self.closing and not self.server.quit and
+                asynchat.async_chat.readable(self))
+    
+    
+    def collect_incoming_data(self, data):
+        if self.closing:
+            return
+        self.data.append(data)
+        self.size += len(data)
+        self.last_active = time.time()
+        if self.request is None and self.size > self.frontend.max_header_size:
+            self.send_error(431, 'Request Header Fields Too Large')
+    
+    
+    def found_terminator(self):
+        if self.closing:
+            return
+        data = ''.join(self.data)
+        self.data = []
+        self.size = 0
+        
+        if self.request is None:
+            lines = data.split('\r\n')
+            headers = mimetools.Message(StringIO.StringIO('\r\n'.join(lines[1:]) + '\r\n'), 0)
+            try:
+                length = int(headers.get('content-length', 0))
+            except ValueError:
+                length = -1
+            if len(lines[0].split()) != 3 or length < 0:
+                self.send_error(400, 'Bad Request')
+                return
+            
+            if length > 0:
+                self.request = (lines[0], headers)
+                self.set_terminator(length)
+                return
+            self.pending.append((lines[0], headers, ''))
+        else:
+            self.pending.append(self.request + (data,))
+            self.request = None
+        
+        self.set_terminator('\r\n\r\n')
+        if not self.busy:
+            self.handle_next()
+    
+    
+    def handle_next(self):
+        """Start answering the next pending request
+        """
+        
+        requestline, headers, body = self.pending.pop(0)
+        self.requestline = requestline
+        self.headers = headers
+        self.requests += 1
+        
+        command, self.path, version = requestline.split()
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            self.keep_alive = connection != 'close'
+        else:
+            self.keep_alive = connection == 'keep-alive'
+        if self.requests >= self.server.keepalive_requests:
+            self.keep_alive = False
+        
+        if command != 'POST':
+            self.send_error(501, 'Unsupported method (%r)' % command)
+            return
+        if self.path not in (self.frontend.xmlrpc_path, self.frontend.json_path):
+            self.send_error(404, 'Not Found')
+            return
+        
+        encoding = headers.get('content-encoding', 'identity').lower()
+        if encoding == 'gzip':
+            try:
+                body = xmlrpclib.gzip_decode(body)
+            except ValueError:
+                self.send_error(400, 'Error decoding gzip content')
+                return
+        elif encoding != 'identity':
+            self.send_error(501, 'Encoding %r not supported' % encoding)
+            return
+        
+        self.context = self.server.new_request_context(headers)
+        self.busy = True
+        try:
+            self.frontend.submit(self, lambda: self.dispatch(body))
+        except Queue.Full:
+            # Answer at once. Cheap methods such as get_load are still
+            # served (see XMLRPCServer_overload.always_admitted).
+            self.server.rejecting.value = True
+            try:
+                response = self.dispatch(body)
+            finally:
+                self.server.rejecting.value = False
+            self.send_response(response)
+    
+    
+    def dispatch(self, body):
+        """Dispatch request and return the response (runs in a worker thread)
+        
+        Requests turned away are dispatched by the loop itself. Workers 
+        count as active while they run tasks, so requests dispatched by
+        the loop are not counted.
+        """
+        
+        context = self.context
+        previous = set_context(context)
+        try:
+            try:
+                response = self.server._marshaled_dispatch(body, path=self.path)
+            except:
+                logging.exception('Could not dispatch request')
+                response = None
+            self.log_request(response)
+        finally:
+            set_context(previous)
+            context.scratch.remove()
+        return response
+    
+    
+    def log_request(self, response):
+        if response is None:
+            code, size = 500, '-'
+        else:
+            code, size = 200, len(response)
+        logging.info('%s "%s" %s %s' % (self.address[0], self.requestline, code, size))
+    
+    
+    def send_response(self, response):
+        """Send response to the current request (None for an internal error)
+        """
+        
+        self.busy = False
+        self.last_active = time.time()
+        if response is None:
+            self.send_error(500, 'Internal Server Error')
+            return
+        
+        if self.path == self.frontend.json_path:
+            content_type = 'application/json'
+        else:
+            content_type = 'text/xml'
+        head = ['HTTP/1.1 200 OK',
+                'Content-Type: %s' % content_type,
+                'X-Request-Id: %s' % self.context.request_id]
+        
+        accept = self.headers.get('accept-encoding', '')
+        if len(response) > self.server.gzip_threshold and 'gzip' in accept:
+            response = xmlrpclib.gzip_encode(response)
+            head.append('Content-Encoding: gzip')
+        self.write_response(head, response)
+    
+    
+    def send_error(self, code, message):
+        self.keep_alive = False
+        self.busy = False
+        self.pending = []
+        self.write_response(['HTTP/1.1 %i %s' % (code, message),
+                   'Content-Type: text/plain'], message)
+    
+    
+    def write_response(self, head, body):
+        if self.server.quit:
+            self.keep_alive = False
+        
+        head.append('Content-Length: %i' % len(body))
+        if not self.keep_alive:
+            head.append('Connection: close')
+        self.push('\r\n'.join(head) + '\r\n\r\n' + body)
+        
+        if not self.keep_alive:
+            self.closing = True
+            self.close_when_done()
+        elif self.pending:
+            self.handle_next()
+    
+    
+    def handle_close(self):
+        self.close()
+    
+    
+    def close(self):
+        asynchat.async_chat.close(self)
+        self.frontend.remove(self)
+    
+    
+    def handle_error(self):
+        logging.exception('Error on connection from %s' % str(self.address))
+        self.close()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#coding:utf-8
+# Author:   AIFDR www.aifdr.org
+# Purpose:  Reuse results of idempotent RPC methods for a while
+# Created: 10/18/2026
+
+import threading
+import time
+
+
+class ResultCache:
+    """Results of method calls kept for a number of seconds per method
+    
+    Arguments
+        ttls = dictionary of seconds that results are kept, keyed by
+               method name. Other methods are not cached.
+        invalidations = dictionary keyed by method name of lists of
+                        cached methods whose results are dropped when the
+                        method is called, e.g.
+                        {'create_workspace': ['workspace_exists']}
+        max_entries = number of results kept before expired ones are
+                      removed. If none have expired all are removed.
+    
+    Results are keyed by method and parameters. Only results of calls
+    that succeeded are kept. A result is not kept if results were dropped
+    while it was being worked out, as it may be out of date.
+    """
+    
+    def __init__(self, ttls=None, invalidations=None, max_entries=10000):
+        self.ttls = {}
+        for method, ttl in (ttls or {}).items():
+            if ttl > 0:
+                self.ttls[method] = ttl
+        self.invalidations = invalidations or {}
+        self.max_entries = max_entries
+        
+        # (method, repr(params)) -> (expiry time, result)
+        self.entries = {}
+        self.epoch = 0  # Counts invalidations
+        self.hits = {}
+        self.misses = {}
+        self.lock = threading.Lock()
+    
+    
+    def is_cached(self, method):
+        return method in self.ttls
+    
+    
+    def get(self, method, params):
+        """Look up result of call
+        
+        Returns (True, result, epoch) for a cached call and (False, None, 
+        epoch) otherwise. Pass epoch on to put.
+        """
+        
+        key = (method, repr(params))
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self.hits[method] = self.hits.get(method, 0) + 1
+                return True, entry[1], self.epoch
+            
+            self.misses[method] = self.misses.get(method, 0) + 1
+            return False, None, self.epoch
+        finally:
+            self.lock.release()
+    
+    
+    def put(self, method, params, result, epoch):
+        key = (method, repr(params))
+        now = time.time()
+        self.lock.acquire()
+        try:
+            if epoch != self.epoch:
+                return  # Results were dropped in the meantime
+                
+            if len(self.entries) >= self.max_entries:
+                for k, (expiry, value) in self.entries.items():
+                    if expiry <= now:
+                        del self.entries[k]
+                if len(self.entries) >= self.max_entries:
+                    self.entries.clear()
+            
+            self.entries[key] = (now + self.ttls[method], result)
+        finally:
+            self.lock.release()
+    
+    
+    def invalidate_after(self, method):
+        """Drop results of the methods that a call of method may change
+        """
+        
+        dependents = self.invalidations.get(method)
+        if not dependents:
+            return
+        
+        self.lock.acquire()
+        try:
+            self.epoch += 1
+            for key in self.entries.keys():
+                if key[0] in dependents:
+                    del self.entries[key]
+        finally:
+            self.lock.release()
+    
+    
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.epoch += 1
+            self.entries.clear()
+        finally:
+            self.lock.release()
+    
+    
+    def get_stats(self):
+        """Get ttl, hits and misses of each cached method
+        """
+        
+        self.lock.acquire()
+        try:
+            stats = {}
+            for method, ttl in self.ttls.items():
+                stats[method] = {'ttl': ttl,
+                                 'hits': self.hits.get(method, 0),
+                                 'misses': self.misses.get(method, 0)}
+            return stats
+        finally:
+            self.lock.release()
@@ -4,15 +4,10 @@
 # Purpose:  Common Functions
 # Created: 01/16/2011
 
-# Logging #
-import logging
+import os
 import io
-import riab_api
-
-
-
-LOG_FILENAME='out'
-logging.basicConfig(filename=LOG_FILENAME, level=logging.DEBUG)
+import importlib
+from logs import start_logging
 
 # Configuration Support
 import ConfigParser
@@ -20,6 +15,121 @@ default_config="""
 [Server]
 port=8000
 server_url=localhost
+# Number of worker threads serving requests (0 means one request at a time)
+threads=1
+# Set to 1 to read and write all client connections from one event loop 
+# thread, so that idle connections take no worker thread. All calls then
+# run on the worker threads (at least one).
+event_loop=0
+# Number of pre-forked server processes sharing the port
+processes=1
+# Number of requests waiting for a worker thread before new ones are 
+# turned away with a SERVER_BUSY fault
+queue_size=32
+# Largest array (bytes, uncompressed) accepted in an array payload, e.g.
+# by calculate_arrays
+max_array_bytes=268435456
+# Seconds an idle client connection is kept open
+keepalive_timeout=5
+# Maximum number of requests on one client connection
+keepalive_requests=100
+# Responses larger than this (bytes) are gzip encoded if the client accepts it
+gzip_threshold=1400
+# Seconds that a stopping server waits for running requests and jobs.
+# Jobs still running then are put back in the job queue.
+drain_timeout=30
+# Number of most recent calls of each method that get_server_stats works 
+# out latency percentiles and throughput from
+stats_window=1000
+# Each request and job writes its intermediate files (downloads, results,
+# curl logs) in a directory of its own under this one. The directory is 
+# removed when the request is done, and directories left behind by killed 
+# servers are removed when the server starts.
+scratch_directory=scratch
+# Bytes the intermediate files of one request may take up (0 for no limit)
+scratch_quota=1073741824
+[Jobs]
+# Number of background jobs (e.g. submit_calculation) running at the same time
+workers=1
+# Jobs are recorded here so that they survive restarts
+database=jobs.db
+# Seconds that results of completed jobs are kept
+keep=3600
+# Number of queued jobs before new ones are turned away with a SERVER_BUSY fault
+queue_size=100
+[Health]
+# GeoServers that readiness reports on (separated by commas, may be empty)
+geoservers=http://localhost:8080/geoserver
+# Seconds between checks that the GeoServers can be reached
+check_interval=30
+# Seconds before a GeoServer that does not answer counts as unreachable
+check_timeout=5
+[Logging]
+# Log file. It is rotated when it reaches max_bytes and backup_count old
+# files (out.1, out.2, ...) are kept.
+filename=out
+max_bytes=10485760
+backup_count=5
+# Lowest level logged: DEBUG, INFO, WARNING or ERROR
+level=INFO
+# Number of log records waiting to be written before further ones are 
+# dropped rather than holding up requests
+queue_size=10000
+[Cache]
+# Seconds that results of these methods are reused for calls with the same
+# arguments (0 turns caching of a method off). Methods that change what 
+# they report drop the results, e.g. create_workspace drops those of 
+# workspace_exists. Each server process has its own cache.
+version=3600
+get_all_impact_functions=300
+get_impact_func_details=300
+workspace_exists=30
+check_geoserver_layer_handle=30
+resolve_layer_handles=30
+[Sessions]
+# Sessions started with login are recorded here so that all server 
+# processes share them. GeoServer passwords are kept encrypted with a key
+# that only the running server knows, so sessions end when it restarts.
+database=sessions.db
+# Seconds a session lasts after it was last used
+lifetime=3600
+# Seconds a verified GeoServer connection is reused before it is verified 
+# again. Each server process keeps its own connections.
+connection_max_age=300
+[Distributed]
+# standalone: calculate in this server.
+# coordinator: split calculations into bands of the bounding box and have
+# registered workers calculate them. Run coordinators as one process.
+# worker: register with the coordinator and calculate the bands it sends.
+# Coordinator and workers must reach the same GeoServers. Session handles
+# only work in the server that started the session.
+role=standalone
+# URL of the coordinator's server (used by workers)
+coordinator_url=http://localhost:8000
+# URL under which the coordinator reaches this worker. Leave empty for
+# http://<server_url>:<port>
+worker_url=
+# Secret shared by the coordinator and its workers. Workers send it when 
+# they register, and GeoServer credentials in the layer handles sent to 
+# workers are encrypted with it. Coordinators turn all workers away while
+# it is empty.
+secret=
+# URLs of the workers allowed to register (separated by commas). Leave 
+# empty to allow any worker that knows the secret.
+allowed_workers=
+# Seconds between heartbeats of workers
+heartbeat_interval=10
+# Seconds after its last heartbeat that a worker is dropped
+worker_timeout=30
+# Seconds a worker is given no work after a call to it failed
+retry_after=30
+# Number of bands per concurrent call the workers can take, so that fast
+# workers can take over work from slow ones
+tiles_per_worker=2
+# Number of workers a band is tried on before the calculation fails
+max_attempts=3
+# Seconds a worker may take for one band before it counts as failed
+tile_timeout=600
 [Plugins]
 basepath="."
 """
@@ -30,5 +140,92 @@ config.read('riab_server.cfg')
 
 port=config.getint('Server', 'port')
 server_url=config.get('Server', 'server_url')
+threads=config.getint('Server', 'threads')
+event_loop=config.getboolean('Server', 'event_loop')
+processes=config.getint('Server', 'processes')
+queue_size=config.getint('Server', 'queue_size')
+keepalive_timeout=config.getfloat('Server', 'keepalive_timeout')
+keepalive_requests=config.getint('Server', 'keepalive_requests')
+gzip_threshold=config.getint('Server', 'gzip_threshold')
+max_array_bytes=config.getint('Server', 'max_array_bytes')
+drain_timeout=config.getfloat('Server', 'drain_timeout')
+stats_window=config.getint('Server', 'stats_window')
+scratch_directory=os.path.abspath(config.get('Server', 'scratch_directory'))
+scratch_quota=config.getint('Server', 'scratch_quota')
+job_workers=config.getint('Jobs', 'workers')
+job_database=config.get('Jobs', 'database')
+job_keep=config.getint('Jobs', 'keep')
+job_queue_size=config.getint('Jobs', 'queue_size')
+session_database=config.get('Sessions', 'database')
+session_lifetime=config.getfloat('Sessions', 'lifetime')
+connection_max_age=config.getfloat('Sessions', 'connection_max_age')
+geoservers=[url.strip() for url in config.get('Health', 'geoservers').split(',') 
+            if url.strip()]
+health_interval=config.getfloat('Health', 'check_interval')
+health_timeout=config.getfloat('Health', 'check_timeout')
+log_filename=config.get('Logging', 'filename')
+role=config.get('Distributed', 'role')
+coordinator_url=config.get('Distributed', 'coordinator_url')
+worker_url=config.get('Distributed', 'worker_url')
+worker_secret=config.get('Distributed', 'secret')
+allowed_workers=[url.strip() for url in config.get('Distributed', 'allowed_workers').split(',')
+                 if url.strip()]
+heartbeat_interval=config.getfloat('Distributed', 'heartbeat_interval')
+worker_timeout=config.getfloat('Distributed', 'worker_timeout')
+worker_retry_after=config.getfloat('Distributed', 'retry_after')
+tiles_per_worker=config.getint('Distributed', 'tiles_per_worker')
+max_attempts=config.getint('Distributed', 'max_attempts')
+tile_timeout=config.getfloat('Distributed', 'tile_timeout')
+cache_ttls=dict([(method, float(ttl)) for method, ttl in config.items('Cache')])
+
+
+# Logging #
+
+log_handler = start_logging(log_filename, 
+                            level=config.get('Logging', 'level'),
+                            max_bytes=config.getint('Logging', 'max_bytes'),
+                            backup_count=config.getint('Logging', 'backup_count'),
+                            queue_size=config.getint('Logging', 'queue_size'))
+
+
+# Imports #
+
+class LazyModule:
+    """Stand-in for a module that is imported when first used
+    
+    Usage
+        geoserver = LazyModule('geoserver_api.geoserver')
+        gs = geoserver.Geoserver(url, username, userpass)  # Imports here
+    """
+    
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+        
+    def __getattr__(self, attribute):
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self.__dict__['_name'])
+            self.__dict__['_module'] = module
+        return getattr(module, attribute)
+        
+    def __repr__(self):
+        return '<lazy module %s>' % self.__dict__['_name']
+        
+
+# Errors #
+
+# XMLRPC fault code telling clients that the server is saturated and 
+# that they should back off or try elsewhere.
+SERVER_BUSY = -32001
+
+class ServerBusy(Exception):
+    """Raised when the server can not accept more work
+    """
+    pass
+
+# XMLRPC fault code telling clients that their call was abandoned because
+# the time they allowed for it ran out (see rpc_server.RequestHandler)
+DEADLINE_EXCEEDED = -32002
 
 
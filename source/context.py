@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+#coding:utf-8
+# Author:   AIFDR www.aifdr.org
+# Purpose:  State of the request served by the current thread
+# Created: 10/18/2026
+
+"""Per-request state that code deep down in the API can get at
+
+The server creates a RequestContext for each request (and each job) and
+makes it current for the thread serving it with set_context. Work that
+is handed to other threads on behalf of the request takes the context
+along (see rpc_server.PoolTask).
+
+Long running code calls check_deadline between steps, and limits waits
+to get_time_left, so that work nobody waits for any more stops.
+
+Intermediate files go in the scratch directory of the request (see
+get_scratch_path), so that requests served at the same time do not
+overwrite each other's files.
+"""
+
+import threading
+import time
+import uuid
+
+
+class RequestContext:
+    """State of one request
+    
+    Attributes
+        request_id = correlation id shown on every log line of the request
+        phase = name of the current phase of the work, e.g. 'download'
+        done, total = number of blocks of the phase processed and to do
+        updated = time of the latest progress report
+        listener = function called with the context on each progress 
+                   report, e.g. to record the progress of a job
+        deadline = time by which the work must be done (None for no limit)
+        cancelled = set to True to make the work stop at the next check
+        scratch = scratch.ScratchDirectory for the files of the request 
+                  (None to use the current directory)
+    """
+    
+    def __init__(self, request_id=None, listener=None, deadline=None,
+                 scratch=None):
+        if not request_id:
+            request_id = new_request_id()
+        self.request_id = request_id
+        self.deadline = deadline
+        self.cancelled = False
+        self.scratch = scratch
+        self.phase = ''
+        self.done = 0
+        self.total = 0
+        self.updated = time.time()
+        self.listener = listener
+        
+        
+    def set_progress(self, phase, done=0, total=0):
+        self.phase = phase
+        self.done = done
+        self.total = total
+        self.updated = time.time()
+        if self.listener is not None:
+            self.listener(self)
+
+
+class Cancelled(Exception):
+    """Raised by check_deadline when the work has been cancelled
+    """
+    pass
+
+
+class DeadlineExceeded(Cancelled):
+    """Raised by check_deadline when the deadline of the work has passed
+    """
+    pass
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:12]
+
+
+_local = threading.local()
+
+
+def get_context():
+    """Get context of the request served by this thread, or None
+    """
+    
+    return getattr(_local, 'context', None)
+
+
+def set_context(context):
+    """Make context current for this thread and return the previous one
+    """
+    
+    previous = getattr(_local, 'context', None)
+    _local.context = context
+    return previous
+
+
+def report_progress(phase, done=0, total=0):
+    """Report progress of the request served by this thread
+    
+    Arguments
+        phase = name of the current phase, e.g. 'download' or 'compute'
+        done = number of blocks of the phase processed so far
+        total = number of blocks in the phase (0 if not known)
+    
+    Does nothing outside requests, so library code can call it freely.
+    """
+    
+    context = getattr(_local, 'context', None)
+    if context is not None:
+        context.set_progress(phase, done, total)
+
+
+def check_deadline():
+    """Raise Cancelled or DeadlineExceeded if the current work should stop
+    
+    Does nothing outside requests.
+    """
+    
+    context = getattr(_local, 'context', None)
+    if context is None:
+        return
+    
+    if context.cancelled:
+        raise Cancelled('Request %s was cancelled' % context.request_id)
+    if context.deadline is not None and time.time() > context.deadline:
+        msg = 'Deadline of request %s passed %.1f seconds ago' % (context.request_id, 
+                                                                 time.time() - context.deadline)
+        raise DeadlineExceeded(msg)
+        
+        
+def get_time_left(limit=None):
+    """Get seconds until the deadline of the current work
+    
+    Arguments
+        limit = upper bound of the result, e.g. a default timeout
+    
+    Returns limit if there is no deadline. Returns None if there is 
+    neither. Never returns less than a small positive number, so the
+    result can be used as a timeout.
+    """
+    
+    context = getattr(_local, 'context', None)
+    if context is None or context.deadline is None:
+        return limit
+    
+    left = max(context.deadline - time.time(), 0.001)
+    if limit is not None:
+        left = min(left, limit)
+    return left
+
+
+def get_scratch_path(filename=''):
+    """Get path for an intermediate file of the request served by this thread
+    
+    Arguments
+        filename = name of the file without directory, e.g. 'curl.stdout'
+    
+    Returns path of the file in the scratch directory of the request. 
+    Outside requests, and for requests without scratch directory, files
+    go in the current directory as they always did.
+    """
+    
+    context = getattr(_local, 'context', None)
+    if context is None or context.scratch is None:
+        return filename
+    return context.scratch.get_path(filename)
+    
+    
+def check_quota():
+    """Raise scratch.QuotaExceeded if the files of the current request take 
+    up more space than allowed
+    
+    Does nothing outside requests.
+    """
+    
+    context = getattr(_local, 'context', None)
+    if context is not None and context.scratch is not None:
+        context.scratch.check_quota()
+        
+        
+def get_scratch_room():
+    """Get number of bytes the current request may still write to its 
+    scratch directory, or None if there is no limit
+    """
+    
+    context = getattr(_local, 'context', None)
+    if context is None or context.scratch is None:
+        return None
+    return context.scratch.get_room()
+    
+    
+def get_request_id():
+    context = getattr(_local, 'context', None)
+    if context is None:
+        return '-'
+    return context.request_id
@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+#coding:utf-8
+# Author:   AIFDR www.aifdr.org
+# Purpose:  Spread the tiles of a calculation over worker servers
+# Created: 10/18/2026
+
+"""Coordinator and worker roles of distributed calculations
+
+A coordinator keeps a WorkerRegistry of the servers that offer to work
+for it. Workers announce themselves with a WorkerAnnouncer, which calls
+register_worker on the coordinator every heartbeat interval. Workers that
+miss heartbeats drop out of the registry. Workers have to know the 
+secret of the registry, and it may only take workers from a list of URLs.
+
+Coordinator.map calls one method with a list of argument lists on the
+registered workers over XMLRPC. Each worker takes the next argument list
+as soon as it is done with the previous one, so fast or idle workers get
+more of the work. Calls that fail because a worker could not be reached
+or answered with broken HTTP are retried on other workers, and a failed
+worker is left alone for a while. If no worker is left, the rest is done
+locally. Faults raised by the called method fail the map straight away.
+"""
+
+import sys
+import time
+import threading
+import socket
+import logging
+import hmac
+import httplib
+import xmlrpclib
+from xml.parsers.expat import ExpatError
+from context import get_context, set_context, check_deadline, get_time_left
+from context import report_progress, get_request_id
+
+# Errors showing that a worker failed rather than the call, e.g. a worker
+# that can not be reached or one answering with broken HTTP or XML. Calls 
+# failing with them are tried on others. Faults are raised by the method 
+# called, e.g. for a bad layer handle or a passed deadline, and other 
+# workers would fare no better.
+worker_errors = (socket.error, xmlrpclib.ProtocolError, xmlrpclib.ResponseError,
+                 httplib.HTTPException, ExpatError)
+
+
+def split_bounding_box(bounding_box, n, pixel_height=None):
+    """Split bounding box into horizontal bands
+    
+    Arguments
+        bounding_box = [minx, miny, maxx, maxy]
+        n = number of bands wanted
+        pixel_height = height of the grid cells of the data. Band edges
+                       are then put on whole rows of cells counted from
+                       the top, so that the bands join up without gaps or
+                       overlaps.
+    
+    Returns
+        list of at most n bounding boxes, top band first
+    """
+    
+    minx, miny, maxx, maxy = [float(x) for x in bounding_box]
+    height = maxy - miny
+    n = max(int(n), 1)
+    
+    if pixel_height:
+        rows = max(int(round(height / pixel_height)), 1)
+        n = min(n, rows)
+        rows_per_band = (rows + n - 1) / n
+        band_height = rows_per_band * pixel_height
+        n = (rows + rows_per_band - 1) / rows_per_band
+    else:
+        band_height = height / n
+    
+    bands = []
+    for i in range(n):
+        top = maxy - i * band_height
+        bottom = max(maxy - (i + 1) * band_height, miny)
+        if i == n - 1:
+            bottom = miny
+        bands.append([minx, bottom, maxx, top])
+    return bands
+
+
+class WorkerRegistry:
+    """Worker servers available to a coordinator
+    
+    Arguments
+        timeout = seconds a worker stays registered after its last heartbeat
+        retry_after = seconds a worker is left alone after a call to it failed
+        secret = secret workers have to know (see authorize). No worker
+                 is allowed while it is empty.
+        allowed_urls = URLs of the workers allowed. Empty allows all.
+    
+    Each server process has its own registry, so run coordinators as a
+    single process.
+    """
+    
+    def __init__(self, timeout=30, retry_after=30, secret='', allowed_urls=()):
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.secret = secret
+        self.allowed_urls = allowed_urls
+        
+        # url -> dictionary with fields capacity, seen, failed,
+        # tiles_done and tiles_failed
+        self.workers = {}
+        self.lock = threading.Lock()
+    
+    
+    def authorize(self, url, secret):
+        """Check that a worker may register or unregister
+        
+        Raises an exception if the secret is wrong or url is not allowed.
+        """
+        
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf-8')
+        if not self.secret:
+            raise Exception('Workers can not register: the coordinator has no secret')
+        if not hmac.compare_digest(secret, self.secret):
+            raise Exception('Worker %s sent the wrong secret' % url)
+        if self.allowed_urls and url not in self.allowed_urls:
+            raise Exception('Worker %s is not allowed' % url)
+    
+    
+    def register(self, url, capacity=1):
+        """Add worker or record its heartbeat
+        
+        Arguments
+            url = URL of the worker's RPC server
+            capacity = number of calls the worker can run at the same time
+        """
+        
+        self.lock.acquire()
+        try:
+            worker = self.workers.setdefault(url, {'tiles_done': 0,
+                                                   'tiles_failed': 0,
+                                                   'failed': 0})
+            worker['capacity'] = max(int(capacity), 1)
+            worker['seen'] = time.time()
+        finally:
+            self.lock.release()
+    
+    
+    def unregister(self, url):
+        self.lock.acquire()
+        try:
+            self.workers.pop(url, None)
+        finally:
+            self.lock.release()
+    
+    
+    def get_available(self):
+        """Get dictionary of capacity by URL of workers that can be given work
+        
+        Workers that missed their heartbeats are dropped.
+        """
+        
+        now = time.time()
+        self.lock.acquire()
+        try:
+            for url, worker in self.workers.items():
+                if now - worker['seen'] > self.timeout:
+                    logging.warning('Worker %s missed its heartbeats and was dropped' % url)
+                    del self.workers[url]
+            return dict([(url, worker['capacity']) for url, worker in self.workers.items()
+                         if now - worker['failed'] > self.retry_after])
+        finally:
+            self.lock.release()
+    
+    
+    def record_result(self, url, success):
+        self.lock.acquire()
+        try:
+            worker = self.workers.get(url)
+            if worker is None:
+                return
+            if success:
+                worker['tiles_done'] += 1
+            else:
+                worker['tiles_failed'] += 1
+                worker['failed'] = time.time()
+        finally:
+            self.lock.release()
+    
+    
+    def get_status(self):
+        """Get list of workers with fields url, capacity, seconds_since_heartbeat,
+        available, tiles_done and tiles_failed
+        """
+        
+        now = time.time()
+        self.lock.acquire()
+        try:
+            return [{'url': url,
+                     'capacity': worker['capacity'],
+                     'seconds_since_heartbeat': now - worker['seen'],
+                     'available': now - worker['failed'] > self.retry_after,
+                     'tiles_done': worker['tiles_done'],
+                     'tiles_failed': worker['tiles_failed']}
+                    for url, worker in sorted(self.workers.items())]
+        finally:
+            self.lock.release()
+
+
+class RequestTransport(xmlrpclib.Transport):
+    """XMLRPC transport passing the id and the time left of the current
+    request on to the called server (see rpc_server.RequestHandler)
+    """
+    
+    def __init__(self, request_id, timeout):
+        xmlrpclib.Transport.__init__(self)
+        self.request_id = request_id
+        self.timeout = timeout
+    
+    
+    def make_connection(self, host):
+        connection = xmlrpclib.Transport.make_connection(self, host)
+        connection.timeout = self.timeout
+        return connection
+    
+    
+    def send_content(self, connection, request_body):
+        connection.putheader('X-Request-Id', self.request_id)
+        if self.timeout is not None:
+            connection.putheader('X-Request-Timeout', '%.3f' % self.timeout)
+        xmlrpclib.Transport.send_content(self, connection, request_body)
+
+
+class Coordinator:
+    """Run calls on the workers of a registry
+    
+    Arguments
+        registry = WorkerRegistry
+        max_attempts = number of workers a call is tried on before it fails
+        call_timeout = seconds a worker may take for one call before it
+                       counts as failed (None for no limit)
+    """
+    
+    def __init__(self, registry, max_attempts=3, call_timeout=None):
+        self.registry = registry
+        self.max_attempts = max_attempts
+        self.call_timeout = call_timeout
+    
+    
+    def map(self, method, params_list, local=None):
+        """Call method once for each list of arguments and return the results in order
+        
+        Arguments
+            method = name of the method of the workers
+            params_list = list of argument lists
+            local = function taking the same arguments that does the work
+                    in this process. It is used when no worker is left.
+                    Without it, map fails instead.
+        
+        Progress is reported in phase 'tiles'. The deadline of the current
+        request is passed on to the workers. A fault raised by a call is 
+        raised again here.
+        """
+        
+        n = len(params_list)
+        run = _MapRun(self, method, params_list)
+        
+        threads = []
+        for url, capacity in self.registry.get_available().items():
+            for i in range(capacity):
+                t = threading.Thread(target=run.work, args=(url,),
+                                     name='Coordinator-%s-%i' % (url, i))
+                t.setDaemon(True)
+                t.start()
+                threads.append(t)
+        
+        for t in threads:
+            t.join()
+        
+        # Calls that no worker could take
+        if run.error is None and run.pending:
+            if local is None:
+                run.error = Exception('No worker left to call %s' % method)
+            else:
+                logging.warning('No worker left. Doing %i calls of %s locally.' % (len(run.pending), method))
+                while run.pending:
+                    check_deadline()
+                    i = run.pending.pop(0)
+                    run.results[i] = local(*params_list[i])
+                    run.done += 1
+                    report_progress('tiles', run.done, n)
+        
+        if run.error is not None:
+            raise run.error
+        return run.results
+
+
+class _MapRun:
+    """State of one Coordinator.map shared by its threads
+    """
+    
+    def __init__(self, coordinator, method, params_list):
+        self.coordinator = coordinator
+        self.method = method
+        self.params_list = params_list
+        self.context = get_context()
+        
+        self.pending = range(len(params_list))
+        self.attempts = [0] * len(params_list)
+        self.results = [None] * len(params_list)
+        self.done = 0
+        self.error = None  # Exception failing the map
+        self.lock = threading.Lock()
+    
+    
+    def take(self):
+        self.lock.acquire()
+        try:
+            if self.error is not None or not self.pending:
+                return None
+            return self.pending.pop(0)
+        finally:
+            self.lock.release()
+    
+    
+    def work(self, url):
+        """Make calls on one worker until there are none left or it fails
+        """
+        
+        previous = set_context(self.context)
+        try:
+            while True:
+                i = self.take()
+                if i is None:
+                    return
+                if not self.call(url, i):
+                    return
+        finally:
+            set_context(previous)
+    
+    
+    def call(self, url, i):
+        """Make call i on worker url. Returns False if the worker or the call failed.
+        """
+        
+        registry = self.coordinator.registry
+        try:
+            check_deadline()
+            request_id = '%s.%i' % (get_request_id(), i)
+            timeout = get_time_left(self.coordinator.call_timeout)
+            proxy = xmlrpclib.ServerProxy(url, RequestTransport(request_id, timeout),
+                                          allow_none=True)
+            result = getattr(proxy, self.method)(*self.params_list[i])
+        except:
+            exc_type, exc_value = sys.exc_info()[:2]
+            worker_failed = issubclass(exc_type, worker_errors)
+            self.lock.acquire()
+            try:
+                self.attempts[i] += 1
+                if self.error is not None:
+                    pass
+                elif issubclass(exc_type, xmlrpclib.Fault):
+                    self.error = exc_value
+                elif not worker_failed:
+                    # E.g. the deadline passed here
+                    self.error = Exception('%s:%s' % (exc_type, exc_value))
+                elif self.attempts[i] >= self.coordinator.max_attempts:
+                    msg = 'Call %i of %s failed on %i workers. Last error from %s: %s' % (
+                        i, self.method, self.attempts[i], url, exc_value)
+                    self.error = Exception(msg)
+                else:
+                    self.pending.insert(0, i)
+            finally:
+                self.lock.release()
+            logging.warning('Call %i of %s failed on worker %s: %s' % (i, self.method, url, exc_value))
+            if worker_failed:
+                registry.record_result(url, False)
+            return False
+        
+        registry.record_result(url, True)
+        self.lock.acquire()
+        try:
+            self.results[i] = result
+            self.done += 1
+            report_progress('tiles', self.done, len(self.results))
+        finally:
+            self.lock.release()
+        return True
+
+
+class WorkerAnnouncer:
+    """Keep a worker registered with its coordinator
+    
+    Arguments
+        coordinator_url = URL of the coordinator's RPC server
+        worker_url = URL under which the coordinator reaches this worker
+        capacity = number of calls this worker can run at the same time
+        interval = seconds between heartbeats
+        secret = secret shared with the coordinator (see WorkerRegistry)
+    
+    Heartbeats are sent by a background thread from start() until stop(),
+    which also unregisters the worker. Failures are logged and retried at
+    the next heartbeat, so workers may start before their coordinator.
+    """
+    
+    def __init__(self, coordinator_url, worker_url, capacity=1, interval=10, secret=''):
+        self.coordinator_url = coordinator_url
+        self.worker_url = worker_url
+        self.capacity = capacity
+        self.interval = interval
+        self.secret = secret
+        self.stopping = threading.Event()
+        self.thread = None
+    
+    
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='WorkerAnnouncer')
+        self.thread.setDaemon(True)
+        self.thread.start()
+    
+    
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        try:
+            self.get_proxy().unregister_worker(self.worker_url, self.secret)
+        except Exception, e:
+            logging.warning('Could not unregister from coordinator %s: %s' % (self.coordinator_url, e))
+    
+    
+    def get_proxy(self):
+        return xmlrpclib.ServerProxy(self.coordinator_url,
+                                     RequestTransport(get_request_id(), self.interval))
+    
+    
+    def run(self):
+        registered = False
+        while not self.stopping.isSet():
+            try:
+                self.get_proxy().register_worker(self.worker_url, self.capacity, self.secret)
+            except xmlrpclib.Fault, e:
+                logging.warning('Coordinator %s turned this worker away: %s' % (self.coordinator_url, 
+                                                                               e.faultString))
+                registered = False
+            except Exception, e:
+                if registered:
+                    logging.warning('Could not reach coordinator %s: %s' % (self.coordinator_url, e))
+                registered = False
+            else:
+                if not registered:
+                    logging.info('Registered with coordinator %s as %s' % (self.coordinator_url,
+                                                                         self.worker_url))
+                registered = True
+            self.stopping.wait(self.interval)
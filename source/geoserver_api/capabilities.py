@@ -0,0 +1,149 @@
+"""Metadata of many coverages from a Web Coverage Service in one go
+
+GetCapabilities lists the coverages, but carries no grid information, so
+it is followed by one DescribeCoverage request for all the coverages
+asked about. Only the standard library (and the server's context module)
+is used, so this can be imported without GDAL and numpy.
+"""
+
+import urllib
+import urllib2
+import base64
+from xml.etree import ElementTree
+from context import check_deadline, get_time_left
+
+WCS = '{http://www.opengis.net/wcs}'
+GML = '{http://www.opengis.net/gml}'
+
+
+def get_xml(url, username=None, password=None, timeout=30):
+    """Get XML document from url, optionally with basic authentication
+    
+    Returns the root element. Waits no longer than the current request
+    has left (see context.get_time_left).
+    """
+    
+    check_deadline()
+    request = urllib2.Request(url)
+    if username is not None:
+        credentials = base64.b64encode('%s:%s' % (username, password))
+        request.add_header('Authorization', 'Basic %s' % credentials)
+    
+    try:
+        handle = urllib2.urlopen(request, timeout=get_time_left(timeout))
+        try:
+            return ElementTree.fromstring(handle.read())
+        finally:
+            handle.close()
+    except urllib2.URLError, e:
+        msg = 'Could not open URL "%s": %s' % (url, getattr(e, 'reason', e))
+        raise Exception(msg)
+
+
+def check_service_exception(root):
+    if root.tag.endswith('ServiceExceptionReport'):
+        msg = 'Web Coverage Service failed: %s' % ' '.join(root.itertext()).strip()
+        raise Exception(msg)
+
+
+def parse_capabilities(root):
+    """Get names of coverages from WCS 1.0.0 GetCapabilities document
+    """
+    
+    check_service_exception(root)
+    return [brief.findtext(WCS + 'name') for brief in root.iter(WCS + 'CoverageOfferingBrief')]
+
+
+def get_envelope(element):
+    """Get [minx, miny, maxx, maxy] from element with two gml:pos
+    """
+    
+    positions = [pos.text.split() for pos in element.findall(GML + 'pos')]
+    return [float(positions[0][0]), float(positions[0][1]),
+            float(positions[1][0]), float(positions[1][1])]
+
+
+def parse_coverage_descriptions(root):
+    """Get metadata from WCS 1.0.0 DescribeCoverage document
+    
+    Returns
+        dictionary keyed by coverage name of dictionaries with fields
+            crs = native coordinate reference system, e.g. 'EPSG:4326'
+            extent = [minx, miny, maxx, maxy] in native CRS
+            extent_wgs84 = [minx, miny, maxx, maxy] in longitude and latitude
+            native_resolution = [columns, rows] of the grid
+            pixel_size = [width, height] of grid cells in native CRS units
+    """
+    
+    check_service_exception(root)
+    descriptions = {}
+    for offering in root.iter(WCS + 'CoverageOffering'):
+        domain = offering.find(WCS + 'domainSet/' + WCS + 'spatialDomain')
+        envelope = domain.find(GML + 'Envelope')
+        grid = domain.find(GML + 'RectifiedGrid')
+        
+        low = [int(x) for x in grid.findtext(GML + 'limits/' + GML + 'GridEnvelope/' + GML + 'low').split()]
+        high = [int(x) for x in grid.findtext(GML + 'limits/' + GML + 'GridEnvelope/' + GML + 'high').split()]
+        offsets = [[float(x) for x in vector.text.split()]
+                   for vector in grid.findall(GML + 'offsetVector')]
+        
+        crs = offering.findtext(WCS + 'supportedCRSs/' + WCS + 'nativeCRSs')
+        if not crs:
+            crs = envelope.get('srsName')
+        
+        descriptions[offering.findtext(WCS + 'name')] = {
+            'crs': crs.split()[0],
+            'extent': get_envelope(envelope),
+            'extent_wgs84': get_envelope(offering.find(WCS + 'lonLatEnvelope')),
+            'native_resolution': [high[0] - low[0] + 1, high[1] - low[1] + 1],
+            'pixel_size': [abs(offsets[0][0]), abs(offsets[1][1])]}
+    
+    return descriptions
+
+
+def get_coverage_info(wcs_url, names, username=None, password=None, timeout=30):
+    """Get metadata of coverages from Web Coverage Service
+    
+    Arguments
+        wcs_url = URL of service, e.g. http://localhost:8080/geoserver/wcs
+        names = list of coverage names, e.g. ['hazard:shakemap_padang']
+        username, password = credentials for basic authentication (optional)
+        timeout = seconds to wait for each response
+    
+    Returns
+        dictionary keyed by the names of the coverages that exist. Values
+        are as for parse_coverage_descriptions. A name without workspace
+        refers to the coverage of that name if only one workspace has it.
+    """
+    
+    query = urllib.urlencode({'service': 'WCS',
+                              'version': '1.0.0',
+                              'request': 'GetCapabilities'})
+    root = get_xml(wcs_url + '?' + query, username, password, timeout)
+    available = parse_capabilities(root)
+    known = set(available)
+    
+    # Map requested names to names known to the service
+    qualified = {}
+    for name in names:
+        if name in known:
+            qualified[name] = name
+        elif ':' not in name:
+            matches = [a for a in available if a.split(':')[-1] == name]
+            if len(matches) == 1:
+                qualified[name] = matches[0]
+    if not qualified:
+        return {}
+    
+    query = urllib.urlencode({'service': 'WCS',
+                              'version': '1.0.0',
+                              'request': 'DescribeCoverage',
+                              'coverage': ','.join(sorted(set(qualified.values())))})
+    root = get_xml(wcs_url + '?' + query, username, password, timeout)
+    descriptions = parse_coverage_descriptions(root)
+    
+    info = {}
+    for name, full_name in qualified.items():
+        if full_name in descriptions:
+            info[name] = descriptions[full_name]
+    return info
@@ -10,6 +10,9 @@ import pycurl
 import numpy
 from osgeo import osr, gdal
 import sys
+import math
+from context import Cancelled, check_deadline, get_time_left
+from context import check_quota, get_scratch_room
 
 class Coverage:
   
@@ -32,6 +35,7 @@ class Coverage:
     # ------------------------------------------------------------------------------------------------------------
     from owslib.wcs import WebCoverageService
 
+    check_deadline()
     wcs = WebCoverageService(base_url, version='1.0.0') # Raises a deprecation waring
     if len(self.layername.split(':')) == 2:
       self.workspace, self.layername = layername.split(':')
@@ -99,7 +103,37 @@ class Coverage:
     c.setopt(pycurl.URL, self.get_url())
     c.setopt(pycurl.WRITEFUNCTION, f.write)
     
+    # Give up when the request we are working for is cancelled, out of time
+    # or out of space
+    self.room = get_scratch_room()
+    timeout = get_time_left()
+    if timeout is not None:
+      c.setopt(pycurl.TIMEOUT, int(math.ceil(timeout)))
+    c.setopt(pycurl.NOPROGRESS, 0)
+    c.setopt(pycurl.PROGRESSFUNCTION, self.check_progress)
+    
     #print pycurl.URL, self.get_url()
     #print pycurl.WRITEFUNCTION
     
-    c.perform()
+    try:
+      try:
+        c.perform()
+      finally:
+        f.close()
+    except pycurl.error:
+      # Report why the download was aborted
+      check_deadline()
+      check_quota()
+      raise
+
+  def check_progress(self, download_total, downloaded, upload_total, uploaded):
+    """Abort transfer (by returning non-zero) if the current request should stop
+    or the downloaded data would not fit in its quota"""
+    
+    try:
+      check_deadline()
+    except Cancelled:
+      return 1
+    if self.room is not None and downloaded > self.room:
+      return 1
+    return 0
@@ -5,6 +5,8 @@ import os
 from utilities import get_web_page, run, curl, get_pathname_from_package
 import numpy
 import coverage
+import capabilities
+from context import report_progress, get_scratch_path
 import raster
 import sld_template
 import osgeo.gdal
@@ -130,7 +132,7 @@ class Geoserver:
             bounding_box = [] # FIXME (Ole): Not sure about default value
             
         if output_filename is None:
-            output_filename = coverage_name + '.tif'
+            output_filename = get_scratch_path(coverage_name + '.tif')
             
         if verbose:
             print 'Downloading coverage %s to %s' % (coverage_name, output_filename)        
@@ -203,6 +205,9 @@ class Geoserver:
         
         Uploads are done using curl commands of the form
         curl -u admin:geoserver -v -X PUT -H "Content-type: image/tif" "http://localhost:8080/geoserver/rest/workspaces/futnuh/coveragestores/population_padang_1/file.geotiff" --data-binary "@data/population_padang_1.tif
+        
+        Intermediate files are written to the scratch directory of the 
+        current request (see context.get_scratch_path).
         """
         
         # Form derived variables
@@ -222,15 +227,16 @@ class Geoserver:
         provided_style_filename = pathname + '.sld'
         
         # Locally stored                
-        upload_filename = layername + '.tif'             
-        style_filename = layername + '.sld'         
+        upload_filename = get_scratch_path(layername + '.tif')
+        style_filename = get_scratch_path(layername + '.sld')
 
         
         if extension == '.tif':
             generate_sld = False
                     
-            cmd = 'cp %s %s' % (filename, os.getcwd()) # upload_filename)
-            run(cmd, verbose=False)            
+            cmd = 'cp %s %s' % (filename, upload_filename)
+            if os.path.abspath(filename) != os.path.abspath(upload_filename):
+                run(cmd, verbose=False)            
         else:
             # Convert to Geotiff
             generate_sld = True            
@@ -239,7 +245,8 @@ class Geoserver:
             if verbose:
                 run(cmd, verbose=verbose)
             else:
-                run(cmd, stdout='upload_raster.stdout', stderr='upload_raster.stderr', verbose=verbose)        
+                run(cmd, stdout=get_scratch_path('upload_raster.stdout'), 
+                    stderr=get_scratch_path('upload_raster.stderr'), verbose=verbose)        
         
         # Upload raster data to Geoserver
         curl(self.geoserver_url, 
@@ -254,12 +261,13 @@ class Geoserver:
 
 
         # Take care of styling 
+        report_progress('style')
         if os.path.isfile(provided_style_filename):
             # Use provided style file
 
             # Copy provide file to local directory because the REST interface
             # spits the dummy with pathnames.
-            cmd = 'cp %s %s' % (provided_style_filename, os.getcwd())
+            cmd = 'cp %s %s' % (provided_style_filename, style_filename)
             run(cmd, verbose=False)    
         else:        
             # Automatically create new style file for raster file
@@ -294,9 +302,9 @@ class Geoserver:
         local_filename = os.path.split(filename)[1]
         
         layername, extension = os.path.splitext(local_filename)
-        upload_filename = layername + '.zip'             
-        style_filename = layername + '.sld'         # Locally stored
-        provided_style_filename = os.path.join(subdir, style_filename) # In case it accompanies the file
+        upload_filename = get_scratch_path(layername + '.zip')
+        style_filename = get_scratch_path(layername + '.sld')         # Locally stored
+        provided_style_filename = os.path.join(subdir, layername + '.sld') # In case it accompanies the file
         
         
         msg = 'Vector data must have extension zip or shp'
@@ -312,20 +320,14 @@ class Geoserver:
             else:
                 fid.close()
         
-            # Zip shapefile and auxiliary files 
-            cmd = 'cd %s; zip %s %s*' % (subdir, upload_filename, layername)
-            run(cmd, stdout='zip.stdout', stderr='zip.stderr', verbose=verbose)
-            
-            # Move to cwd
-            # FIXME (Ole): For some reason geoserver won't accept the zip file unless
-            # located in CWD.       
-            # FIXME (Ole): If zip file already exists with different owner, this
-            # will silently wait for a newline. Annoying.     
-            cmd = 'mv %s/%s .' % (subdir, upload_filename)
-            run(cmd, stdout='mvzip.stdout', stderr='mvzip.stderr', verbose=verbose)            
+            # Zip shapefile and auxiliary files straight into the scratch 
+            # directory, leaving the directory of the shapefile alone
+            cmd = 'cd %s; zip %s %s*' % (subdir or '.', os.path.abspath(upload_filename), layername)
+            run(cmd, stdout=get_scratch_path('zip.stdout'), 
+                stderr=get_scratch_path('zip.stderr'), verbose=verbose)
         else:
             # Already zipped - FIXME: Need to test if it is indeed a zipped shape file
-            pass
+            upload_filename = filename
         
         
         # Upload vector data to Geoserver        
@@ -346,7 +348,7 @@ class Geoserver:
                 
             # Copy provide file to local directory because the REST interface
             # spits the dummy with pathnames.
-            cmd = 'cp %s %s' % (provided_style_filename, os.getcwd())
+            cmd = 'cp %s %s' % (provided_style_filename, style_filename)
             run(cmd, verbose=False)    
         else:        
             # Automatically create new style file for vector file (FIXME: Not yet implemented)
@@ -391,6 +393,24 @@ class Geoserver:
 
         
         
+    def get_coverage_info(self, names):
+        """Get metadata of many coverages with one catalog fetch
+        
+        Arguments
+            names = list of coverage names of the form workspace:name
+        
+        Returns
+            dictionary keyed by the names of the coverages that exist with
+            fields crs, extent, extent_wgs84, native_resolution and 
+            pixel_size (see capabilities.parse_coverage_descriptions)
+        """
+        
+        return capabilities.get_coverage_info(self.geoserver_url.rstrip('/') + '/wcs', 
+                                              names, 
+                                              self.geoserver_username, 
+                                              self.geoserver_userpass)
+        
+        
     def get_vector_data(self, name):
         """Retrieve named vector layer in some kind of Python numeric structure
         """
@@ -477,7 +497,7 @@ class Geoserver:
         #    print 'NoData', nodata    
         
         # Write the SLD file    
-        sld = layername+'.sld'
+        sld = get_scratch_path(layername+'.sld')
         text = sld_template.sld_template
 
         text = text.replace('MIN',str(levels[0]))
@@ -519,7 +539,8 @@ class Geoserver:
                  'text/xml', 
                  'styles', 
                  '--data-ascii', 
-                 '<style><name>%s</name><filename>%s</filename></style>' % (style_name, style_file),  
+                 '<style><name>%s</name><filename>%s</filename></style>' % (style_name, 
+                                                                            os.path.basename(style_file)),  
                  verbose=verbose)
         except Exception, e:
             
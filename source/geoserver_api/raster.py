@@ -3,6 +3,8 @@
 
 import os 
 import numpy
+import zlib
+import StringIO
 
 from osgeo import gdal
 
@@ -248,6 +250,49 @@ def write_coverage_to_geotiff(A, filename, projection, geotransform):
     fid.GetRasterBand(1).WriteArray(A)
     
     
+def pack_array(A):
+    """Convert numeric array to zlib compressed numpy (.npy) format
+    
+    The result is a string that can be sent e.g. as xmlrpclib.Binary.
+    """
+    
+    fid = StringIO.StringIO()
+    numpy.save(fid, A)
+    return zlib.compress(fid.getvalue())
+    
+    
+def unpack_array(data, shape=None, max_bytes=268435456):
+    """Convert string produced by pack_array back to numeric array
+    
+    Arguments
+        data = zlib compressed .npy data
+        shape = expected dimensions of the array (None for any)
+        max_bytes = largest size of the data once decompressed
+    
+    The data may come from any client, so it is checked rather than 
+    trusted: arrays of Python objects are refused instead of unpickled, 
+    data decompressing to more than max_bytes is refused before it takes
+    up the memory, and the array must be numeric and have the given shape.
+    """
+    
+    decompressor = zlib.decompressobj()
+    raw = decompressor.decompress(data, max_bytes)
+    if decompressor.unconsumed_tail or decompressor.unused_data:
+        msg = 'Array data is larger than %i bytes or has trailing data' % max_bytes
+        raise Exception(msg)
+        
+    A = numpy.load(StringIO.StringIO(raw), allow_pickle=False)
+    if A.dtype.kind not in 'biufc':
+        msg = 'Array elements must be numbers, not %s' % A.dtype
+        raise Exception(msg)
+        
+    if shape is not None and list(A.shape) != list(shape):
+        msg = 'Array has shape %s, expected %s' % (list(A.shape), list(shape))
+        raise Exception(msg)
+        
+    return A
+    
+    
 # FIXME (Ole) Hack to get demo going    
 # Use default projection file.
 # DELETE THIS VERY SOON!
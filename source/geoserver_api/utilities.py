@@ -2,8 +2,12 @@
 """
 
 import os
+import time
+import signal
 import urllib, urllib2, osgeo
 from subprocess import Popen, PIPE	
+from context import get_context, check_deadline, get_time_left
+from context import check_quota, get_scratch_path
 
 
 def run(cmd, 
@@ -12,6 +16,10 @@ def run(cmd,
         verbose=True):
     """Run command with or without echoing
     Possible redirect stdout and stderr
+    
+    When run for a request, the command is killed if the request is
+    cancelled, its deadline passes (see context.check_deadline) or its
+    files take up more than its quota (see context.check_quota).
     """
     
     if verbose:
@@ -25,7 +33,10 @@ def run(cmd,
     if stderr:
         s += ' 2> %s' % stderr        
         
-    err = os.system(s)
+    if get_context() is None:
+        err = os.system(s)
+    else:
+        err = run_until_deadline(s)
     
     if err != 0:
         msg = 'Command "%s" failed with errorcode %i. ' % (cmd, err)
@@ -36,6 +47,34 @@ def run(cmd,
 
     
     
+def run_until_deadline(cmd):
+    """Run shell command, killing it if the current request should stop
+    
+    Returns the exit status. Raises context.Cancelled, DeadlineExceeded or
+    scratch.QuotaExceeded if the command was killed.
+    """
+    
+    # Own process group so that the shell and its children are killed
+    p = Popen(cmd, shell=True, preexec_fn=os.setsid)
+    delay = 0.001
+    while p.poll() is None:
+        try:
+            check_deadline()
+            check_quota()
+        except:
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except OSError:
+                pass  # Finished in the meantime
+            p.wait()
+            raise
+            
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+        
+    return p.returncode
+    
+    
 def pipe(cmd, verbose=False):
     """Simplification of the new style pipe command
     
@@ -97,8 +136,12 @@ def makedir(newdir):
     	  
 def get_web_page(url, username=None, password=None):
     """Get url page possible with username and password
+    
+    The credentials are only used for this call. Calls running at the
+    same time in other threads each use their own.
     """
 
+    handlers = []
     if username is not None:
 
         # Create password manager
@@ -106,12 +149,14 @@ def get_web_page(url, username=None, password=None):
         passman.add_password(None, url, username, password)
 
         # create the handler
-        authhandler = urllib2.HTTPBasicAuthHandler(passman)
-        opener = urllib2.build_opener(authhandler)
-        urllib2.install_opener(opener)
+        handlers.append(urllib2.HTTPBasicAuthHandler(passman))
+        
+    # Not installed, as the opener of urllib2 is shared by all threads
+    opener = urllib2.build_opener(*handlers)
         
     try:
-        pagehandle = urllib2.urlopen(url)
+        check_deadline()
+        pagehandle = opener.open(url, timeout=get_time_left())
     except urllib2.URLError, e:
         msg = 'Could not open URL "%s": %s' % (url, e)
         raise urllib2.URLError(msg)
@@ -152,8 +197,8 @@ def curl(url, username, password, request, content_type, rest_dir, data_type, da
         assert len(data) > 0
         cmd += ' "%s"' % data
 
-    curl_stdout = 'curl.stdout'    
-    curl_stderr = 'curl.stderr'
+    curl_stdout = get_scratch_path('curl.stdout')
+    curl_stderr = get_scratch_path('curl.stderr')
     run(cmd, stdout=curl_stdout, stderr=curl_stderr, verbose=verbose)
 
     out = open(curl_stdout).readlines()
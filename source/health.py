@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#coding:utf-8
+# Author:   AIFDR www.aifdr.org
+# Purpose:  Background checks of the services the RPC server depends on
+# Created: 10/18/2026
+
+import threading
+import urllib2
+import socket
+import time
+import logging
+
+
+class HealthChecker:
+    """Check periodically that GeoServers can be reached
+    
+    Arguments
+        geoservers = list of GeoServer URLs, e.g. http://localhost:8080/geoserver
+        interval = seconds between checks
+        timeout = seconds before a GeoServer that does not answer counts
+                  as unreachable
+    
+    A GeoServer is reachable if its REST interface answers at all. Any
+    HTTP status will do as no credentials are sent. Probes read the last
+    results with get_status and cost nothing.
+    """
+    
+    def __init__(self, geoservers, interval=30.0, timeout=5.0):
+        self.geoservers = list(geoservers)
+        self.interval = interval
+        self.timeout = timeout
+        
+        self.status = {}
+        for url in self.geoservers:
+            self.status[url] = {'reachable': False,
+                                'checked': 0.0,
+                                'response_time': 0.0,
+                                'error': 'Not checked yet'}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = False
+    
+    
+    def start(self):
+        """Start checking in a background thread
+        """
+        
+        if not self.geoservers:
+            return
+        
+        self.running = True
+        t = threading.Thread(target=self.run_checks, name='HealthChecker')
+        t.setDaemon(True)
+        t.start()
+    
+    
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+    
+    
+    def run_checks(self):
+        """Check all GeoServers every interval seconds (runs in own thread)
+        """
+        
+        while self.running:
+            self.check()
+            self.wakeup.wait(self.interval)
+    
+    
+    def check(self):
+        """Check all GeoServers once and record the results
+        """
+        
+        for url in self.geoservers:
+            t0 = time.time()
+            error = ''
+            try:
+                urllib2.urlopen(url.rstrip('/') + '/rest', timeout=self.timeout).close()
+            except urllib2.HTTPError:
+                pass  # It answered
+            except (urllib2.URLError, socket.error, IOError), e:
+                error = str(e)
+            
+            status = {'reachable': not error,
+                      'checked': time.time(),
+                      'response_time': time.time() - t0,
+                      'error': error}
+            
+            self.lock.acquire()
+            try:
+                if self.status[url]['reachable'] and error:
+                    logging.warning('GeoServer at %s is unreachable: %s' % (url, error))
+                self.status[url] = status
+            finally:
+                self.lock.release()
+    
+    
+    def get_status(self):
+        """Get results of the latest checks
+        
+        Returns
+            dictionary keyed by GeoServer URL with fields reachable,
+            checked (time of check), response_time (seconds) and error.
+        """
+        
+        self.lock.acquire()
+        try:
+            return dict([(url, status.copy()) for url, status in self.status.items()])
+        finally:
+            self.lock.release()
@@ -0,0 +1,960 @@
+#!/usr/bin/env python
+#coding:utf-8
+# Author:   AIFDR www.aifdr.org
+# Purpose:  Run long API calls in the background
+# Created: 10/18/2026
+
+import threading
+import Queue
+import uuid
+import time
+import sys
+import os
+import sqlite3
+import xmlrpclib
+import logging
+from common import ServerBusy
+from context import RequestContext, set_context
+from scratch import ScratchDirectory, process_exists
+
+
+# Priority classes. Jobs in a lower numbered class always run first.
+priorities = {'high': 0,
+              'normal': 1,
+              'low': 2}
+              
+              
+def get_priority_name(priority):
+    for name, value in priorities.items():
+        if value == priority:
+            return name
+    return str(priority)
+    
+
+class Job:
+    """Record of one API call executed in the background
+    """
+    
+    def __init__(self, method, params, id=None, status='queued', 
+                 result=None, error='', submitted=None, started=0.0, 
+                 finished=0.0, priority='normal', client='', phase='', 
+                 done=0, total=0, progressed=0.0):
+        if priority not in priorities:
+            msg = 'Unknown priority %s. Valid priorities are %s' % (priority, priorities.keys())
+            raise Exception(msg)
+        
+        if id is None:
+            id = uuid.uuid4().hex
+        if submitted is None:
+            submitted = time.time()
+            
+        self.id = id
+        self.method = method
+        self.params = params
+        self.status = status
+        self.result = result
+        self.error = error
+        self.submitted = submitted
+        self.started = started
+        self.finished = finished
+        self.priority = priority
+        self.client = client
+        self.phase = phase
+        self.done = done
+        self.total = total
+        self.progressed = progressed
+        
+        
+    def get_status(self):
+        """Get job status as a dictionary that can be marshalled by XMLRPC
+        """
+        
+        return {'id': self.id,
+                'method': self.method,
+                'status': self.status,
+                'error': self.error,
+                'submitted': self.submitted,
+                'started': self.started,
+                'finished': self.finished,
+                'priority': self.priority,
+                'client': self.client}
+    
+    
+    def get_progress(self):
+        """Get latest progress report of job as a dictionary
+        
+        See RPCServer.get_job_progress for the fields.
+        """
+        
+        if self.status == 'finished':
+            percent = 100.0
+        elif self.total > 0:
+            percent = 100.0 * self.done / self.total
+        else:
+            percent = 0.0
+        
+        if self.status == 'running':
+            since_update = time.time() - max(self.started, self.progressed)
+        else:
+            since_update = 0.0
+        
+        return {'id': self.id,
+                'status': self.status,
+                'phase': self.phase,
+                'blocks_done': self.done,
+                'blocks_total': self.total,
+                'percent': percent,
+                'updated': self.progressed,
+                'seconds_since_update': since_update}
+
+        
+class JobStore:
+    """Durable record of jobs in an SQLite database
+    
+    The database is shared by all server processes using the same file,
+    so a job submitted to one process can be run by, and queried from,
+    any other. Parameters and results are stored XMLRPC marshalled.
+    
+    Queued jobs are claimed in order of priority class. Within a class,
+    the next job is taken from the client with the fewest running jobs, 
+    so that one client's backlog can not starve the others.
+    
+    Running jobs belong to an owner, a token made afresh each time a 
+    JobManager starts (see new_owner). Owners record heartbeats in the 
+    owners table, so that jobs of owners that died can be told from jobs
+    of live ones even when a restarted process gets the same pid.
+    """
+    
+    fields = ['id', 'method', 'params', 'status', 'result', 'error',
+              'submitted', 'started', 'finished', 'owner', 'priority', 
+              'client', 'phase', 'done', 'total', 'progressed']
+    
+    def __init__(self, filename):
+        self.filename = filename
+        
+        db = self.connect()
+        try:
+            db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                              id TEXT PRIMARY KEY,
+                              method TEXT,
+                              params TEXT,
+                              status TEXT,
+                              result TEXT,
+                              error TEXT,
+                              submitted REAL,
+                              started REAL,
+                              finished REAL,
+                              owner INTEGER,
+                              priority INTEGER DEFAULT 1,
+                              client TEXT DEFAULT '',
+                              phase TEXT DEFAULT '',
+                              done INTEGER DEFAULT 0,
+                              total INTEGER DEFAULT 0,
+                              progressed REAL DEFAULT 0.0,
+                              cancel_requested INTEGER DEFAULT 0)''')
+                              
+            db.execute('''CREATE TABLE IF NOT EXISTS owners (
+                              owner TEXT PRIMARY KEY,
+                              pid INTEGER,
+                              heartbeat REAL)''')
+                              
+            # Upgrade databases created before priorities, progress 
+            # reports and cancellation of running jobs were introduced
+            columns = [row[1] for row in db.execute('PRAGMA table_info(jobs)')]
+            if 'priority' not in columns:
+                db.execute('ALTER TABLE jobs ADD COLUMN priority INTEGER DEFAULT 1')
+                db.execute("ALTER TABLE jobs ADD COLUMN client TEXT DEFAULT ''")
+            if 'phase' not in columns:
+                db.execute("ALTER TABLE jobs ADD COLUMN phase TEXT DEFAULT ''")
+                db.execute('ALTER TABLE jobs ADD COLUMN done INTEGER DEFAULT 0')
+                db.execute('ALTER TABLE jobs ADD COLUMN total INTEGER DEFAULT 0')
+                db.execute('ALTER TABLE jobs ADD COLUMN progressed REAL DEFAULT 0.0')
+            if 'cancel_requested' not in columns:
+                db.execute('ALTER TABLE jobs ADD COLUMN cancel_requested INTEGER DEFAULT 0')
+                
+            db.execute('''CREATE INDEX IF NOT EXISTS jobs_by_status 
+                              ON jobs (status, submitted)''')
+            db.commit()
+        finally:
+            db.close()
+            
+    
+    def connect(self):
+        # A new connection per operation keeps the store safe to use 
+        # from any thread and across fork.
+        return sqlite3.connect(self.filename, timeout=30)
+        
+        
+    def make_job(self, row):
+        """Create Job from database row
+        """
+        
+        d = dict(zip(self.fields, row))
+        params = list(xmlrpclib.loads(d['params'])[0])
+        if d['result']:
+            result = xmlrpclib.loads(d['result'])[0][0]
+        else:
+            result = None
+            
+        return Job(d['method'], params, id=d['id'], status=d['status'],
+                   result=result, error=d['error'], submitted=d['submitted'],
+                   started=d['started'], finished=d['finished'],
+                   priority=get_priority_name(d['priority']), 
+                   client=d['client'], phase=d['phase'], done=d['done'],
+                   total=d['total'], progressed=d['progressed'])
+        
+        
+    def add(self, job, limit=None):
+        """Insert job into the store
+        
+        Arguments
+            job = Job to insert
+            limit = number of queued jobs at which the job is not inserted 
+                    (None for no limit)
+                    
+        Returns True if the job was inserted. Counting and inserting is 
+        one transaction, so concurrent processes can not exceed the limit.
+        """
+        
+        db = self.connect()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            if limit is not None:
+                row = db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()
+                if row[0] >= limit:
+                    return False
+                    
+            db.execute('INSERT INTO jobs (%s) VALUES (%s)' % (', '.join(self.fields),
+                                                              ', '.join(['?']*len(self.fields))),
+                       (job.id, job.method, xmlrpclib.dumps(tuple(job.params)),
+                        job.status, '', job.error, job.submitted, job.started,
+                        job.finished, 0, priorities[job.priority], job.client,
+                        job.phase, job.done, job.total, job.progressed))
+            db.commit()
+        finally:
+            db.close()
+            
+        return True
+            
+            
+    def get(self, job_id):
+        """Get job with given id. Raise exception if it does not exist.
+        """
+        
+        db = self.connect()
+        try:
+            row = db.execute('SELECT %s FROM jobs WHERE id = ?' % ', '.join(self.fields), 
+                             (job_id,)).fetchone()
+        finally:
+            db.close()
+            
+        if row is None:
+            msg = 'Unknown job id %s' % job_id
+            raise Exception(msg)
+            
+        return self.make_job(row)
+        
+        
+    def count(self, status):
+        """Get number of jobs with given status
+        """
+        
+        db = self.connect()
+        try:
+            row = db.execute('SELECT COUNT(*) FROM jobs WHERE status = ?', 
+                             (status,)).fetchone()
+        finally:
+            db.close()
+            
+        return row[0]
+        
+        
+    def claim(self, n, owner):
+        """Mark up to n queued jobs as running and return them
+        
+        Jobs are chosen by priority class and then fair share between 
+        clients (see class docstring). All jobs are claimed in one 
+        transaction, so concurrent processes never claim the same job.
+        """
+        
+        db = self.connect()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            queued = db.execute('''SELECT id, priority, client FROM jobs 
+                                   WHERE status = 'queued' 
+                                   ORDER BY priority, submitted''').fetchall()
+            running = dict(db.execute('''SELECT client, COUNT(*) FROM jobs 
+                                         WHERE status = 'running' 
+                                         GROUP BY client''').fetchall())
+                                         
+            selected = []
+            while queued and len(selected) < n:
+                # Candidates are the jobs in the most urgent class. They are
+                # in order of submission, so min picks the oldest job of 
+                # the least served client.
+                priority = queued[0][1]
+                candidates = [x for x in queued if x[1] == priority]
+                chosen = min(candidates, key=lambda x: running.get(x[2], 0))
+                
+                selected.append(chosen[0])
+                running[chosen[2]] = running.get(chosen[2], 0) + 1
+                queued.remove(chosen)
+                
+            jobs = []
+            for job_id in selected:
+                row = db.execute('SELECT %s FROM jobs WHERE id = ?' % ', '.join(self.fields),
+                                 (job_id,)).fetchone()
+                jobs.append(self.make_job(row))
+            
+            now = time.time()
+            for job in jobs:
+                job.status = 'running'
+                job.started = now
+                db.execute('''UPDATE jobs SET status = ?, started = ?, owner = ? 
+                              WHERE id = ?''', (job.status, job.started, owner, job.id))
+            db.commit()
+        finally:
+            db.close()
+            
+        return jobs
+        
+        
+    def update(self, job, owner):
+        """Record status, result and times of job run by owner
+        
+        Nothing is recorded if the job is no longer running for owner, 
+        e.g. because it was requeued and claimed by another owner after 
+        owner was taken for dead. Returns True if the job was recorded.
+        """
+        
+        if job.result is None:
+            result = ''
+        else:
+            result = xmlrpclib.dumps((job.result,), allow_none=True)
+            
+        db = self.connect()
+        try:
+            cursor = db.execute('''UPDATE jobs SET status = ?, result = ?, error = ?, 
+                                   started = ?, finished = ? 
+                                   WHERE id = ? AND owner = ? AND status = 'running' ''', 
+                                (job.status, result, job.error, job.started, 
+                                 job.finished, job.id, owner))
+            db.commit()
+        finally:
+            db.close()
+            
+        return cursor.rowcount == 1
+        
+        
+    def set_progress(self, job):
+        """Record phase and blocks done of running job
+        """
+        
+        db = self.connect()
+        try:
+            db.execute('''UPDATE jobs SET phase = ?, done = ?, total = ?, progressed = ? 
+                          WHERE id = ? AND status = 'running' ''', 
+                       (job.phase, job.done, job.total, job.progressed, job.id))
+            db.commit()
+        finally:
+            db.close()
+        
+        
+    def cancel(self, job_id):
+        """Cancel job if it is still queued, or ask it to stop if it is running
+        
+        Returns 'cancelled' or 'stopping' respectively, and None if the 
+        job has completed.
+        """
+        
+        db = self.connect()
+        try:
+            cursor = db.execute('''UPDATE jobs SET status = 'cancelled', finished = ? 
+                                   WHERE id = ? AND status = 'queued' ''', 
+                                (time.time(), job_id))
+            if cursor.rowcount == 1:
+                db.commit()
+                return 'cancelled'
+                
+            cursor = db.execute('''UPDATE jobs SET cancel_requested = 1 
+                                   WHERE id = ? AND status = 'running' ''', 
+                                (job_id,))
+            db.commit()
+            if cursor.rowcount == 1:
+                return 'stopping'
+        finally:
+            db.close()
+            
+        return None
+        
+        
+    def get_cancel_requests(self, job_ids):
+        """Get the ids among job_ids of running jobs asked to stop
+        """
+        
+        db = self.connect()
+        try:
+            rows = db.execute('''SELECT id FROM jobs WHERE cancel_requested = 1 
+                                 AND status = 'running' AND id IN (%s)''' % 
+                              ', '.join(['?']*len(job_ids)), tuple(job_ids)).fetchall()
+        finally:
+            db.close()
+            
+        return [row[0] for row in rows]
+        
+            
+    def register_owner(self, owner):
+        """Record owner as live, with a heartbeat now
+        
+        Owners call this every heartbeat interval. An owner that was taken
+        for dead while it could not reach the database is recorded again.
+        """
+        
+        db = self.connect()
+        try:
+            db.execute('INSERT OR REPLACE INTO owners VALUES (?, ?, ?)', 
+                       (owner, os.getpid(), time.time()))
+            db.commit()
+        finally:
+            db.close()
+            
+        
+    def unregister_owner(self, owner):
+        db = self.connect()
+        try:
+            db.execute('DELETE FROM owners WHERE owner = ?', (owner,))
+            db.commit()
+        finally:
+            db.close()
+        
+        
+    def requeue_orphans(self, timeout):
+        """Put running jobs whose owner is gone back in the queue
+        
+        Arguments
+            timeout = seconds without heartbeat after which an owner 
+                      counts as gone even if a process with its pid exists
+        
+        Returns list of ids of requeued jobs.
+        """
+        
+        db = self.connect()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            rows = db.execute('''SELECT id, owner FROM jobs 
+                                 WHERE status = 'running' ''').fetchall()
+            
+            orphans = []
+            live = {}
+            for job_id, owner in rows:
+                if owner not in live:
+                    live[owner] = self.owner_is_live(db, owner, timeout)
+                if not live[owner]:
+                    orphans.append(job_id)
+                    self.requeue_job(db, job_id)
+                    
+            db.execute('DELETE FROM owners WHERE heartbeat < ?', 
+                       (time.time() - timeout,))
+            db.commit()
+        finally:
+            db.close()
+            
+        return orphans
+        
+        
+    def owner_is_live(self, db, owner, timeout):
+        """Return True if owner, as recorded using connection db, is alive
+        """
+        
+        if owner in live_owners:
+            return True
+            
+        row = db.execute('SELECT pid, heartbeat FROM owners WHERE owner = ?', 
+                         (owner,)).fetchone()
+        if row is None:
+            if isinstance(owner, (int, long)):
+                # Claimed before owners were recorded, when the owner was
+                # the pid. This process only uses tokens.
+                return owner != os.getpid() and process_exists(owner)
+            return False  # Unregistered or expired
+            
+        pid, heartbeat = row
+        if pid == os.getpid():
+            return False  # An earlier process with this pid
+        return process_exists(pid) and heartbeat > time.time() - timeout
+        
+        
+    def requeue(self, job_ids):
+        """Put the given running jobs back in the queue
+        
+        Used for jobs that a stopping process gives up on.
+        """
+        
+        db = self.connect()
+        try:
+            for job_id in job_ids:
+                self.requeue_job(db, job_id)
+            db.commit()
+        finally:
+            db.close()
+            
+            
+    def requeue_job(self, db, job_id):
+        """Put running job back in the queue using connection db
+        
+        Jobs that were asked to stop are cancelled instead.
+        """
+        
+        db.execute('''UPDATE jobs SET status = 'cancelled', finished = ? 
+                      WHERE id = ? AND status = 'running' AND cancel_requested = 1''', 
+                   (time.time(), job_id))
+        db.execute('''UPDATE jobs SET status = 'queued', started = 0.0, phase = '', 
+                          done = 0, total = 0, progressed = 0.0
+                      WHERE id = ? AND status = 'running' ''', (job_id,))
+        
+        
+    def get_queue_statistics(self):
+        """Get number of jobs and queue wait times for each priority class
+        
+        Wait times are in seconds from submission until start. Started 
+        jobs count as long as they are kept in the store.
+        """
+        
+        now = time.time()
+        db = self.connect()
+        try:
+            queued = db.execute('''SELECT priority, COUNT(*), MIN(submitted) FROM jobs
+                                   WHERE status = 'queued' 
+                                   GROUP BY priority''').fetchall()
+            started = db.execute('''SELECT priority, COUNT(*), AVG(started - submitted), 
+                                          MAX(started - submitted) FROM jobs
+                                   WHERE started > 0 
+                                   GROUP BY priority''').fetchall()
+        finally:
+            db.close()
+            
+        statistics = {}
+        for name in priorities:
+            statistics[name] = {'queued': 0,
+                                'oldest_queued_wait': 0.0,
+                                'started': 0,
+                                'mean_wait': 0.0,
+                                'max_wait': 0.0}
+                                
+        for priority, count, oldest in queued:
+            s = statistics[get_priority_name(priority)]
+            s['queued'] = count
+            s['oldest_queued_wait'] = now - oldest
+            
+        for priority, count, mean_wait, max_wait in started:
+            s = statistics[get_priority_name(priority)]
+            s['started'] = count
+            s['mean_wait'] = mean_wait
+            s['max_wait'] = max_wait
+            
+        return statistics
+        
+        
+    def purge(self, t):
+        """Delete jobs that completed before time t
+        """
+        
+        db = self.connect()
+        try:
+            db.execute('DELETE FROM jobs WHERE finished > 0 AND finished < ?', (t,))
+            db.commit()
+        finally:
+            db.close()
+        
+        
+# Owners of job managers started in this process
+live_owners = set()
+
+
+def new_owner():
+    """Make owner token for a JobManager starting in this process
+    
+    Tokens differ between starts, so jobs of a crashed process are not 
+    taken for those of a new process that got the same pid (as happens 
+    to pid 1 in containers).
+    """
+    
+    owner = '%i-%s' % (os.getpid(), uuid.uuid4().hex[:12])
+    live_owners.add(owner)
+    return owner
+        
+        
+class JobManager:
+    """Execute API calls on a pool of background worker threads
+    
+    Arguments
+        dispatch = function(method, params) that performs the actual call,
+                   typically the _dispatch method of the XMLRPC server
+        store = JobStore where jobs are recorded
+        workers = number of jobs that can run at the same time
+        keep = seconds that results of completed jobs are kept
+        queue_size = number of queued jobs before submit raises ServerBusy
+        scratch_root = directory for the scratch directories of jobs
+                       (None for the system's temporary directory)
+        scratch_quota = bytes the intermediate files of a job may take up
+                        (0 for no limit)
+        
+    Job states are 'queued', 'running', 'finished', 'failed' and 'cancelled'    
+    
+    Jobs are only taken from the store when a worker is idle, and all
+    jobs that idle workers can take are claimed in one batch.
+    
+    stop() and join() shut the manager down, putting jobs it did not
+    complete back in the queue.
+    """
+    
+    # Seconds between checks for jobs submitted to other processes
+    poll_interval = 1.0
+    
+    # Seconds between removals of old completed jobs from the store, and
+    # between checks for jobs of owners that died
+    purge_interval = 60.0
+    
+    # Seconds between heartbeats of the owner of the jobs run here, and 
+    # seconds without heartbeat after which an owner counts as dead
+    heartbeat_interval = 10.0
+    owner_timeout = 60.0
+    
+    # Longest wait before the dispatcher tries again after an error, e.g.
+    # when the database stayed locked
+    max_backoff = 30.0
+    
+    # Seconds between writes of the progress of a job to the store. 
+    # Changes of phase are always written.
+    progress_interval = 1.0
+    
+    def __init__(self, dispatch, store, workers=1, keep=3600, queue_size=100,
+                 scratch_root=None, scratch_quota=0):
+        self.dispatch = dispatch
+        self.store = store
+        self.workers = workers
+        self.keep = keep
+        self.queue_size = queue_size
+        self.scratch_root = scratch_root
+        self.scratch_quota = scratch_quota
+        self.rejected = 0
+        
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.idle = workers
+        self.threads = []
+        self.running = {}  # RequestContext of each running job
+        self.stopping = False
+        self.stopped = threading.Event()
+        self.owner = None
+        
+        
+    def start(self):
+        """Recover interrupted jobs and start the worker threads
+        
+        This must be done in the process that serves requests, i.e. after
+        any forking.
+        """
+        
+        self.owner = new_owner()
+        self.store.register_owner(self.owner)
+        self.requeue_orphans()
+        self.store.purge(time.time() - self.keep)
+        self.last_purge = time.time()
+        self.last_heartbeat = time.time()
+        
+        if self.workers == 0:
+            return
+        
+        t = threading.Thread(target=self.run_dispatcher, name='JobDispatcher')
+        t.setDaemon(True)
+        t.start()
+        self.threads.append(t)
+        
+        for i in range(self.workers):
+            t = threading.Thread(target=self.run_jobs, name='JobWorker-%i' % i)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+            
+            
+    def submit(self, method, params, priority='normal', client=''):
+        """Queue call of method with params and return the job id
+        
+        See JobStore for how priority and client affect scheduling.
+        """
+        
+        job = Job(method, params, priority=priority, client=client)
+        
+        if not self.store.add(job, limit=self.queue_size):
+            self.rejected += 1
+            msg = 'Job queue is full (%i jobs). Try again later.' % self.queue_size
+            raise ServerBusy(msg)
+            
+        self.wakeup.set()
+        
+        logging.debug('Job %s (%s) queued' % (job.id, method))
+        return job.id
+        
+        
+    def get_status(self, job_id):
+        return self.store.get(job_id).get_status()
+        
+        
+    def get_progress(self, job_id):
+        return self.store.get(job_id).get_progress()
+        
+        
+    def get_result(self, job_id):
+        """Get return value of finished job. 
+        
+        Raise exception if the job failed or has not finished.
+        """
+        
+        job = self.store.get(job_id)
+        if job.status == 'finished':
+            return job.result
+        
+        if job.status == 'failed':
+            msg = 'Job %s failed: %s' % (job_id, job.error)
+        else:
+            msg = 'Job %s has no result. Status is %s' % (job_id, job.status)
+        raise Exception(msg)
+        
+        
+    def cancel(self, job_id):
+        """Cancel queued job, or make running job stop
+        
+        A running job stops at its next check_deadline (see module 
+        context) and then gets status 'cancelled'. The process running 
+        it notices within poll_interval seconds.
+        """
+        
+        outcome = self.store.cancel(job_id)
+        if outcome is None:
+            job = self.store.get(job_id)
+            msg = 'Job %s can not be cancelled. Status is %s' % (job_id, job.status)
+            raise Exception(msg)
+            
+        if outcome == 'stopping':
+            self.stop_cancelled([job_id])
+            return 'SUCCESS: Job %s is stopping' % job_id
+        return 'SUCCESS: Job %s cancelled' % job_id
+        
+        
+    def stop_cancelled(self, job_ids):
+        """Tell those of the given jobs that run in this process to stop
+        """
+        
+        self.lock.acquire()
+        try:
+            for job_id in job_ids:
+                if job_id in self.running:
+                    self.running[job_id].cancelled = True
+        finally:
+            self.lock.release()
+        
+
+    def stop(self):
+        """Stop starting jobs
+        
+        Jobs that were claimed but not yet started are put back in the 
+        queue. Running jobs carry on (see join).
+        """
+        
+        if self.stopping:
+            return
+        self.stopping = True
+        self.stopped.set()
+        self.wakeup.set()
+        if self.threads:
+            self.threads[0].join()  # The dispatcher
+            
+        unstarted = []
+        while True:
+            try:
+                unstarted.append(self.queue.get_nowait().id)
+            except Queue.Empty:
+                break
+        self.store.requeue(unstarted)
+        
+        for i in range(self.workers):
+            self.queue.put(None)  # Tell worker to exit
+            
+            
+    def join(self, timeout):
+        """Wait up to timeout seconds for running jobs after stop()
+        
+        Returns list of ids of jobs still running. These are put back in 
+        the queue so that another process, or the next start, runs them.
+        """
+        
+        deadline = time.time() + timeout
+        for t in self.threads:
+            t.join(max(0, deadline - time.time()))
+            
+        self.lock.acquire()
+        try:
+            abandoned = self.running.keys()
+        finally:
+            self.lock.release()
+        self.store.requeue(abandoned)
+        
+        if self.owner is not None:
+            self.store.unregister_owner(self.owner)
+            live_owners.discard(self.owner)
+        return abandoned
+        
+        
+    def requeue_orphans(self):
+        for job_id in self.store.requeue_orphans(self.owner_timeout):
+            logging.warning('Job %s was interrupted and has been requeued' % job_id)
+        
+        
+    def run_dispatcher(self):
+        """Claim jobs from the store whenever workers are idle (runs in own thread)
+        """
+        
+        failures = 0
+        while True:
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+            if self.stopping:
+                return
+            
+            try:
+                self.dispatch_jobs()
+            except Exception:
+                # E.g. the database stayed locked. Keep dispatching, but 
+                # wait longer after each failure in a row.
+                failures += 1
+                backoff = min(self.poll_interval * 2 ** failures, self.max_backoff)
+                logging.exception('Job dispatcher failed. Trying again in %.1f seconds.' % backoff)
+                self.stopped.wait(backoff)
+            else:
+                failures = 0
+                
+                
+    def dispatch_jobs(self):
+        """Do the housekeeping that is due and claim jobs for idle workers
+        """
+        
+        now = time.time()
+        if now - self.last_heartbeat > self.heartbeat_interval:
+            self.store.register_owner(self.owner)
+            self.last_heartbeat = now
+            
+        if now - self.last_purge > self.purge_interval:
+            self.store.purge(now - self.keep)
+            self.requeue_orphans()
+            self.last_purge = now
+        
+        # Jobs may have been cancelled through another process
+        self.lock.acquire()
+        try:
+            running = self.running.keys()
+        finally:
+            self.lock.release()
+        if running:
+            self.stop_cancelled(self.store.get_cancel_requests(running))
+        
+        self.lock.acquire()
+        try:
+            idle = self.idle
+        finally:
+            self.lock.release()
+        if idle == 0:
+            return
+        
+        jobs = self.store.claim(idle, self.owner)
+        
+        self.lock.acquire()
+        try:
+            self.idle -= len(jobs)
+        finally:
+            self.lock.release()
+            
+        for job in jobs:
+            self.queue.put(job)
+        
+        if jobs:
+            # There may be more
+            self.wakeup.set()
+                
+                
+    def make_progress_recorder(self, job):
+        """Make listener writing progress reported by job to the store
+        """
+        
+        def record(context):
+            if (context.phase == job.phase and 
+                context.updated - job.progressed < self.progress_interval):
+                return
+                
+            job.phase = context.phase
+            job.done = context.done
+            job.total = context.total
+            job.progressed = context.updated
+            try:
+                self.store.set_progress(job)
+            except:
+                logging.exception('Could not record progress of job %s' % job.id)
+                
+        return record
+        
+        
+    def run_jobs(self):
+        """Execute claimed jobs forever (runs in each worker thread)
+        """
+        
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+                
+            # Log lines of the job carry the job id, and progress 
+            # reports are recorded with the job. Its files go in a 
+            # directory of its own.
+            context = RequestContext(job.id, listener=self.make_progress_recorder(job),
+                                     scratch=ScratchDirectory(self.scratch_root,
+                                                              self.scratch_quota,
+                                                              job.id))
+            self.lock.acquire()
+            try:
+                self.running[job.id] = context
+            finally:
+                self.lock.release()
+            
+            set_context(context)
+            logging.debug('Job %s (%s) started' % (job.id, job.method))
+            try:
+                job.result = self.dispatch(job.method, job.params)
+            except:
+                exc_type, exc_value = sys.exc_info()[:2]
+                job.error = '%s:%s' % (exc_type, exc_value)
+                if context.cancelled:
+                    job.status = 'cancelled'
+                else:
+                    job.status = 'failed'
+            else:
+                job.status = 'finished'
+            job.finished = time.time()
+            
+            try:
+                if not self.store.update(job, self.owner):
+                    logging.warning('Job %s was taken over by another process. '
+                                    'Its outcome here is discarded.' % job.id)
+            except:
+                logging.exception('Could not record completion of job %s' % job.id)
+            logging.debug('Job %s %s' % (job.id, job.status))
+            set_context(None)
+            context.scratch.remove()
+            
+            self.lock.acquire()
+            try:
+                del self.running[job.id]
+                self.idle += 1
+            finally:
+                self.lock.release()
+            self.wakeup.set()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#coding:utf-8
+# Author:   AIFDR www.aifdr.org
+# Purpose:  JSON-RPC 2.0 codec for the RPC server
+# Created: 10/18/2026
+
+"""JSON-RPC 2.0 encoding of calls to the same methods as served by XMLRPC
+
+Requests look like
+    {"jsonrpc": "2.0", "method": "version", "params": [], "id": 1}
+and get responses like
+    {"jsonrpc": "2.0", "result": "0.1a", "id": 1}
+or, if the call fails,
+    {"jsonrpc": "2.0", "error": {"code": 1, "message": "..."}, "id": 1}
+    
+Error codes are the XMLRPC fault codes. A list of requests is a batch and
+is answered with a list of responses in the same order. Requests without
+an id are notifications. They are performed but get no response, and a
+request or batch of only notifications gets an empty body.
+
+Binary data (xmlrpclib.Binary) is sent as {"__base64__": "<base64 data>"}
+in both directions. xmlrpclib.DateTime is sent as an ISO 8601 string.
+"""
+
+import json
+import sys
+import base64
+import xmlrpclib
+
+# Standard JSON-RPC error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+INVALID_PARAMS = -32602
+
+
+class Encoder(json.JSONEncoder):
+    """Encode the XMLRPC types that JSON does not have
+    """
+    
+    def default(self, obj):
+        if isinstance(obj, xmlrpclib.Binary):
+            return {'__base64__': base64.b64encode(obj.data)}
+        if isinstance(obj, xmlrpclib.DateTime):
+            return obj.value
+        return json.JSONEncoder.default(self, obj)
+        
+        
+def decode_object(d):
+    if len(d) == 1 and '__base64__' in d:
+        return xmlrpclib.Binary(base64.b64decode(d['__base64__']))
+    return d
+    
+    
+def dumps(obj):
+    # Compact separators keep the payload small
+    return json.dumps(obj, cls=Encoder, separators=(',', ':'))
+
+    
+def loads(data):
+    return json.loads(data, object_hook=decode_object)
+    
+    
+def error_response(code, message, id=None):
+    return {'jsonrpc': '2.0',
+            'error': {'code': code, 'message': message},
+            'id': id}
+            
+            
+def call(dispatch, request):
+    """Perform one call given as decoded request and return decoded response
+    
+    Returns None if the request is a notification.
+    """
+    
+    response = get_response(dispatch, request)
+    if isinstance(request, dict) and 'id' not in request:
+        return None
+    return response
+    
+    
+def get_response(dispatch, request):
+    """Perform one call and return decoded response, also for notifications
+    """
+    
+    if not isinstance(request, dict) or 'method' not in request:
+        return error_response(INVALID_REQUEST, 'Invalid request: %s' % str(request))
+        
+    id = request.get('id')
+    params = request.get('params', [])
+    if not isinstance(params, list):
+        return error_response(INVALID_PARAMS, 'Params must be a list', id)
+        
+    try:
+        result = dispatch(request['method'], tuple(params))
+    except xmlrpclib.Fault, fault:
+        return error_response(fault.faultCode, fault.faultString, id)
+    except:
+        exc_type, exc_value = sys.exc_info()[:2]
+        return error_response(1, '%s:%s' % (exc_type, exc_value), id)
+        
+    return {'jsonrpc': '2.0', 'result': result, 'id': id}
+        
+        
+def marshaled_dispatch(dispatch, data, run_tasks=None):
+    """Decode JSON-RPC request, call dispatch(method, params) and encode response
+    
+    Arguments
+        dispatch = function(method, params) performing the call
+        data = the request body
+        run_tasks = optional function running a list of functions 
+                    concurrently and returning their results in order. 
+                    It is used for batch requests.
+    """
+    
+    try:
+        request = loads(data)
+    except ValueError, e:
+        return dumps(error_response(PARSE_ERROR, 'Parse error: %s' % e))
+
+    if not isinstance(request, list):
+        response = call(dispatch, request)
+    elif not request:
+        response = error_response(INVALID_REQUEST, 'Invalid request: empty batch')
+    else:    
+        functions = [lambda r=r: call(dispatch, r) for r in request]
+        if run_tasks is None:
+            responses = [f() for f in functions]
+        else:
+            responses = run_tasks(functions)
+        response = [r for r in responses if r is not None] or None
+        
+    if response is None:
+        return ''  # Only notifications
+        
+    try:
+        return dumps(response)
+    except TypeError, e:
+        # A result could not be encoded
+        return dumps(error_response(1, 'Could not encode response: %s' % e))
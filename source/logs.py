@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+#coding:utf-8
+# Author:   AIFDR www.aifdr.org
+# Purpose:  Non-blocking logging to a rotating file
+# Created: 10/18/2026
+
+"""Logging that does not make requests wait for the disk
+
+Log records are put on a bounded queue by QueueHandler and written to a
+size-rotated file by a background thread. When the queue is full
+records are dropped and counted rather than blocking the caller. Each
+line carries the correlation id of the request it was logged for (see
+module context).
+
+The writer thread is started in each process on first use, so logging
+set up before forking keeps working in the forked processes. Records
+still queued are written by logging.shutdown, which runs at exit.
+"""
+
+import logging
+import logging.handlers
+import threading
+import Queue
+import os
+from context import get_request_id
+
+log_format = '%(asctime)s %(levelname)s [%(request_id)s] %(threadName)s: %(message)s'
+
+
+class ContextFilter(logging.Filter):
+    """Add request_id of the current request to log records
+    """
+    
+    def filter(self, record):
+        record.request_id = get_request_id()
+        return True
+
+
+class QueueHandler(logging.Handler):
+    """Hand log records to another handler through a queue and a writer thread
+    
+    Arguments
+        target = handler that writes the records, e.g. RotatingFileHandler
+        queue_size = number of records waiting to be written before
+                     further ones are dropped
+    """
+    
+    def __init__(self, target, queue_size=10000):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue_size = queue_size
+        self.dropped = 0
+        self.pid = None
+        self.addFilter(ContextFilter())
+    
+    
+    def start(self):
+        """Start writer thread for this process
+        """
+        
+        # Locks held by threads of the parent process at the time of a
+        # fork are never released in the child, so start afresh.
+        self.queue = Queue.Queue(self.queue_size)
+        self.target.createLock()
+        self.pid = os.getpid()
+        
+        t = threading.Thread(target=self.run_writer, name='LogWriter')
+        t.setDaemon(True)
+        t.start()
+    
+    
+    def emit(self, record):
+        # Called with the handler lock held
+        if self.pid != os.getpid():
+            self.start()
+        
+        # Turn arguments and traceback into text now, as they may change
+        # or be gone by the time the record is written.
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+        except:
+            self.handleError(record)
+            return
+        
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+    
+    
+    def run_writer(self):
+        """Write queued records forever (runs in own thread)
+        """
+        
+        dropped = 0
+        while True:
+            record = self.queue.get()
+            try:
+                if self.dropped != dropped:
+                    msg = '%i log records dropped as logging fell behind' % (self.dropped - dropped)
+                    dropped = self.dropped
+                    self.target.handle(logging.makeLogRecord({'msg': msg,
+                                                              'levelname': 'WARNING',
+                                                              'levelno': logging.WARNING,
+                                                              'request_id': '-',
+                                                              'threadName': 'LogWriter'}))
+                self.target.handle(record)
+            finally:
+                self.queue.task_done()
+    
+    
+    def flush(self):
+        """Wait until all queued records have been written
+        """
+        
+        if self.pid == os.getpid():
+            self.queue.join()
+            self.target.flush()
+    
+    
+    def close(self):
+        self.flush()
+        self.target.close()
+        logging.Handler.close(self)
+
+
+def start_logging(filename, level='DEBUG', max_bytes=10485760, backup_count=5,
+                  queue_size=10000):
+    """Send log records of all loggers to a rotating file through a queue
+    
+    Arguments
+        filename = name of log file
+        level = name of lowest level logged, e.g. 'INFO'
+        max_bytes = size at which the file is rotated. Old files are named
+                    filename.1, filename.2 etc.
+        backup_count = number of old files kept
+        queue_size = number of records waiting to be written before
+                     further ones are dropped
+    
+    Returns the QueueHandler.
+    """
+    
+    target = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes,
+                                                  backupCount=backup_count)
+    target.setFormatter(logging.Formatter(log_format))
+    handler = QueueHandler(target, queue_size)
+    
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(getattr(logging, level.upper()))
+    return handler
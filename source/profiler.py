@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+#coding:utf-8
+# Author:   AIFDR www.aifdr.org
+# Purpose:  Profiling of live RPC methods
+# Created: 10/18/2026
+
+"""Two ways of finding out where a live server spends its time
+
+Profiler.enable(method, n) runs the next n calls of method under cProfile
+and adds them up in one pstats.Stats. This is exact but slows those
+calls down considerably.
+
+Profiler.start_sampling(interval) starts a thread that looks at the stack
+of every thread serving a call each interval seconds and counts the
+functions it finds there, per method. The calls themselves are not
+slowed down, so sampling can stay on for hours.
+"""
+
+import cProfile
+import pstats
+import StringIO
+import threading
+import time
+import sys
+import os
+
+
+def get_function_name(code):
+    return '%s:%i(%s)' % (os.path.basename(code.co_filename),
+                          code.co_firstlineno, code.co_name)
+
+
+class Profiler:
+    """Profile calls dispatched through call()
+    """
+    
+    def __init__(self):
+        # Number of calls still to be profiled for each method
+        self.targets = {}
+        
+        # Number of calls profiled and their pstats.Stats for each method
+        self.profiled = {}
+        self.stats = {}
+        
+        # Sample counts for each method (see start_sampling)
+        self.sampler = None
+        self.sampling_started = 0.0
+        self.sampling_stopped = 0.0
+        self.samples = {}
+        
+        self.lock = threading.Lock()
+    
+    
+    def enable(self, method, n_calls):
+        """Profile the next n_calls calls of method
+        
+        Profiles collected earlier for method are discarded.
+        """
+        
+        self.lock.acquire()
+        try:
+            self.stats.pop(method, None)
+            self.profiled[method] = 0
+            if n_calls > 0:
+                self.targets[method] = n_calls
+            else:
+                self.targets.pop(method, None)
+        finally:
+            self.lock.release()
+    
+    
+    def call(self, method, function, *args):
+        """Call function(*args), profiling it if method is to be profiled
+        """
+        
+        if method not in self.targets:
+            return function(*args)
+        
+        self.lock.acquire()
+        try:
+            n = self.targets.get(method, 0)
+            if n <= 1:
+                self.targets.pop(method, None)
+            else:
+                self.targets[method] = n - 1
+        finally:
+            self.lock.release()
+        if n == 0:
+            return function(*args)  # Someone else took the last one
+        
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args)
+        finally:
+            self.lock.acquire()
+            try:
+                if method in self.stats:
+                    self.stats[method].add(profile)
+                else:
+                    self.stats[method] = pstats.Stats(profile)
+                self.profiled[method] = self.profiled.get(method, 0) + 1
+            finally:
+                self.lock.release()
+    
+    
+    def get_profile(self, method, sort='cumulative', limit=30):
+        """Get pstats summary of the profiled calls of method
+        
+        Returns
+            dictionary with fields method, calls_profiled, calls_pending
+            and summary. The summary lists the limit functions ranked
+            highest by sort (any pstats sort key, e.g. 'time').
+        """
+        
+        self.lock.acquire()
+        try:
+            output = StringIO.StringIO()
+            if method in self.stats:
+                stats = self.stats[method]
+                stats.stream = output
+                stats.sort_stats(sort).print_stats(limit)
+                stats.stream = sys.stdout
+            else:
+                output.write('No calls of %s have been profiled' % method)
+            
+            return {'method': method,
+                    'calls_profiled': self.profiled.get(method, 0),
+                    'calls_pending': self.targets.get(method, 0),
+                    'summary': output.getvalue()}
+        finally:
+            self.lock.release()
+    
+    
+    #---------
+    # Sampling
+    #---------
+    
+    def start_sampling(self, interval, dispatch_code):
+        """Sample stacks of threads serving calls every interval seconds
+        
+        dispatch_code is the code object of the function that calls the
+        methods. Threads with it on their stack are serving a call, and
+        its local variable method says which. Earlier samples are
+        discarded.
+        """
+        
+        self.stop_sampling()
+        
+        self.samples = {}
+        self.sampling_started = time.time()
+        self.sampling_stopped = 0.0
+        self.sampler = threading.Thread(target=self.run_sampler,
+                                        args=(interval, dispatch_code),
+                                        name='ProfileSampler')
+        self.sampler.setDaemon(True)
+        self.sampler.running = True
+        self.sampler.start()
+    
+    
+    def stop_sampling(self):
+        sampler = self.sampler
+        if sampler is not None and sampler.running:
+            sampler.running = False
+            sampler.join()
+            self.sampling_stopped = time.time()
+    
+    
+    def run_sampler(self, interval, dispatch_code):
+        """Take samples until stopped (runs in own thread)
+        """
+        
+        me = threading.currentThread()
+        while me.running:
+            time.sleep(interval)
+            
+            for thread_id, frame in sys._current_frames().items():
+                # Find the method being served, if any
+                functions = []
+                method = None
+                while frame is not None:
+                    if frame.f_code is dispatch_code:
+                        method = frame.f_locals.get('method')
+                        break
+                    functions.append(frame.f_code)
+                    frame = frame.f_back
+                if method is None or not functions:
+                    continue
+                
+                self.lock.acquire()
+                try:
+                    counts = self.samples.setdefault(method, {'samples': 0,
+                                                              'functions': {}})
+                    counts['samples'] += 1
+                    
+                    # Count innermost function as own, all as cumulative
+                    own = functions[0]
+                    for code in set(functions):
+                        entry = counts['functions'].setdefault(code, [0, 0])
+                        entry[1] += 1
+                        if code is own:
+                            entry[0] += 1
+                finally:
+                    self.lock.release()
+            frame = None
+    
+    
+    def get_samples(self, limit=30):
+        """Get sample counts of the functions that the methods spent time in
+        
+        Returns
+            dictionary with fields sampling, duration and methods. methods
+            is keyed by method name and has fields samples and functions.
+            functions lists up to limit entries [function, own samples,
+            cumulative samples], most cumulative samples first.
+        """
+        
+        self.lock.acquire()
+        try:
+            methods = {}
+            for method, counts in self.samples.items():
+                functions = [[get_function_name(code), own, total]
+                             for code, (own, total) in counts['functions'].items()]
+                functions.sort(key=lambda entry: (-entry[2], -entry[1]))
+                methods[method] = {'samples': counts['samples'],
+                                   'functions': functions[:limit]}
+        finally:
+            self.lock.release()
+        
+        sampling = self.sampler is not None and self.sampler.running
+        duration = 0.0
+        if self.sampling_started:
+            duration = (self.sampling_stopped or time.time()) - self.sampling_started
+        return {'sampling': sampling,
+                'duration': duration,
+                'methods': methods}
@@ -5,16 +5,295 @@
 # Created: 01/16/2011
 
 import os, string
-from geoserver_api import geoserver
-from geoserver_api.raster import write_coverage_to_geotiff
+import binascii
+import xmlrpclib
+import common
+from common import LazyModule
+from sessions import ConnectionPool, seal, unseal
+from context import report_progress, check_deadline, check_quota, get_scratch_path
+from distributed import split_bounding_box
+
+# The geoserver_api modules need numpy, GDAL, owslib and pycurl which take
+# long to import. They are only imported when first used. 
+geoserver = LazyModule('geoserver_api.geoserver')
+geoserver_raster = LazyModule('geoserver_api.raster')
+numpy = LazyModule('numpy')
+
+# Username standing for a session started with login. The session token
+# takes the place of the password, e.g. in layer handles of the form
+# __session__:token@geoserver_url/[workspace]/layer_name
+SESSION_USERNAME = '__session__'
+
+# Username of handles whose credentials are sealed with the secret of a 
+# distributed calculation (see seal_layer_handle)
+SEALED_USERNAME = '__sealed__'
+
+
+def seal_layer_handle(handle, secret):
+    """Encrypt the credentials in a geoserver layer handle
+    
+    Handles sent to the workers of a distributed calculation are sealed 
+    with the secret shared by coordinator and workers, so that GeoServer
+    credentials are not sent as they are.
+    
+    Returns
+        handle of the form __sealed__:sealed_credentials@geoserver_url/...
+    """
+    
+    credentials, location = handle.split('@', 1)
+    nonce = binascii.hexlify(os.urandom(8))
+    return '%s:%s%s@%s' % (SEALED_USERNAME, nonce, seal(secret, nonce, credentials), 
+                           location)
+    
+    
+def unseal_layer_handle(handle, secret):
+    """Get handle sealed by seal_layer_handle back
+    
+    Raises an exception if the handle is not sealed with secret.
+    """
+    
+    credentials, location = handle.split('@', 1)
+    username, sealed = credentials.split(':', 1)
+    if username == SEALED_USERNAME:
+        credentials = unseal(secret, sealed[:16], sealed[16:])
+        if credentials is not None:
+            return '%s@%s' % (credentials, location)
+    raise Exception('Layer handle %s is not sealed with the secret of this worker' % location)
+
+
+def make_array_payload(A, projection, geotransform):
+    """Pack numeric array and its georeferencing for transfer through XMLRPC
+    
+    Returns
+        dictionary with fields
+            data = xmlrpclib.Binary with array in zlib compressed .npy format
+            projection = projection as WKT
+            geotransform = GDAL geotransform (list of six numbers)
+            shape = array dimensions
+            dtype = name of array element type
+    """
+    
+    return {'data': xmlrpclib.Binary(geoserver_raster.pack_array(A)),
+            'projection': projection,
+            'geotransform': list(geotransform),
+            'shape': list(A.shape),
+            'dtype': str(A.dtype)}
+            
+            
+def read_array_payload(payload):
+    """Unpack dictionary made by make_array_payload
+    
+    The array must have the shape given in the payload and may not take
+    up more than max_array_bytes (see geoserver_raster.unpack_array).
+    
+    Returns
+        A, projection, geotransform
+    """
+    
+    A = geoserver_raster.unpack_array(payload['data'].data, payload['shape'],
+                                      common.max_array_bytes)
+    return A, payload['projection'], tuple(payload['geotransform'])
+    
+    
+def calculate_impact(hazard_layers, exposure_layers, impact_function_id, block_rows=256):
+    """Calculate impact array from lists of hazard and exposure arrays
+    
+    The array is worked out block_rows rows at a time, reporting progress
+    and checking the deadline of the request before each block.
+    """
+    
+    # FIXME, for the time being we just calculate the fatality function assuming only one of each layer.
+    
+    H = hazard_layers[0]
+    E = exposure_layers[0]
+
+    # Calculate impact
+    # FIXME (Ole): This is where an impact plugin should be called
+    a = 0.97429
+    b = 11.037
+    
+    rows = H.shape[0]
+    blocks = max(1, (rows + block_rows - 1) / block_rows)
+    F = []
+    for i in range(blocks):
+        check_deadline()
+        report_progress('compute', i, blocks)
+        F.append(10**(a*H[i*block_rows:(i+1)*block_rows]-b)*E[i*block_rows:(i+1)*block_rows])
+    report_progress('compute', blocks, blocks)
+    
+    return numpy.concatenate(F)
+    
+    
+def join_array_payloads(payloads):
+    """Join array payloads of horizontal bands into one array
+    
+    Arguments
+        payloads = list of array payloads (see make_array_payload) of 
+                   bands that join up, top band first
+    
+    Returns
+        A, projection, geotransform
+    """
+    
+    arrays = []
+    projection = None
+    geotransform = None
+    for payload in payloads:
+        A, band_projection, band_geotransform = read_array_payload(payload)
+        
+        if projection is None:
+            projection = band_projection
+            geotransform = band_geotransform
+        else:
+            msg = 'Projections of bands are different: %s %s' % (projection, band_projection)
+            assert projection == band_projection, msg
+            
+            # Same cell size and columns, starting where the band above ends
+            top = geotransform[3] + geotransform[5] * sum([B.shape[0] for B in arrays])
+            msg = 'Bands do not join up: %s %s' % (geotransform, band_geotransform)
+            assert (band_geotransform[0] == geotransform[0] and 
+                    band_geotransform[1:3] == geotransform[1:3] and
+                    band_geotransform[4:] == geotransform[4:] and
+                    abs(band_geotransform[3] - top) <= abs(geotransform[5]) / 2), msg
+        arrays.append(A)
+        
+    return numpy.concatenate(arrays, axis=0), projection, geotransform
+    
+    
+def calculate_tiled(api, map_tiles, hazards, exposures, impact_function_id, impact, 
+                    bounding_box, comment, tiles):
+    """Calculate like RiabAPI.calculate with the bounding box split into bands
+    
+    Arguments
+        api = RiabAPI resolving the layers and uploading the result
+        map_tiles = function taking a list of argument lists of 
+                    RiabAPI.calculate_tile and returning the results in 
+                    order, e.g. distributed.Coordinator.map run on workers
+        tiles = number of bands to split the bounding box into
+        other arguments as for RiabAPI.calculate. An empty bounding box
+        stands for the extent of the first hazard layer.
+    
+    Returns
+        string: 'SUCCESS' if complete, otherwise Exception is raised
+    """
+    
+    if type(hazards) != type([]):
+        hazards = [hazards]
+        
+    if type(exposures) != type([]):
+        exposures = [exposures]            
+        
+    report_progress('resolve', 0, 1)
+    layers = api.resolve_layer_handles(hazards + exposures)
+    for layer in layers:
+        if not layer['exists']:
+            raise Exception(layer['error'])
+            
+    # Put band edges on whole rows of the hazard grid so that the bands 
+    # of the result join up
+    minx, miny, maxx, maxy = layers[0]['extent_wgs84']
+    pixel_height = float(maxy - miny) / layers[0]['native_resolution'][1]
+    if not bounding_box:
+        bounding_box = layers[0]['extent_wgs84']
+    bands = split_bounding_box(bounding_box, tiles, pixel_height)
+    
+    payloads = map_tiles([[hazards, exposures, impact_function_id, band] for band in bands])
+    F, projection, geotransform = join_array_payloads(payloads)
+    
+    api._upload_impact(F, projection, geotransform, impact)
+    
+    return 'SUCCES'
+    
 
 class RiabAPI():
     API_VERSION='0.1a'
+    
+    def __init__(self, sessions=None):
+        # Login sessions (a sessions.SessionStore). The server makes the
+        # store once and passes it to each generation of the API.
+        self.sessions = sessions
+        self.connections = ConnectionPool(self._make_connection, common.connection_max_age)
+        
         
     def version(self):
         return self.API_VERSION
     
     
+    def login(self, username, userpass, geoserver_url):
+        """Start session with geoserver
+        
+        Arguments
+            username=username
+            userpass=password 
+            geoserver_url=The URL of the geoserver   
+            
+        Returns
+            session token. Use it with create_session_layer_handle, or
+            pass '__session__' as username and the token as password to 
+            methods taking credentials. The connection to the geoserver
+            is verified once and then reused by calls in the session.
+        """
+        
+        self._check_sessions()
+        self.connections.get(geoserver_url, username, userpass)
+        return self.sessions.create(username, userpass, geoserver_url)
+        
+        
+    def logout(self, session):
+        """End session started with login
+        """
+        
+        self._check_sessions()
+        self.sessions.delete(session)
+        return 'SUCCESS'
+        
+        
+    def create_session_layer_handle(self, session, layer_name, workspace):
+        """Create fully qualified geoserver layer name referring to a session
+        
+        Arguments
+            session=token returned by login
+            layer_name=name of data layer
+            workspace=name of geoserver workspace (default is None)
+            
+        Returns
+            layer_handle=string of the form:
+                __session__:token@geoserver_url/[workspace/]layer_name
+        """
+        
+        self._check_sessions()
+        username, userpass, geoserver_url = self.sessions.get(session)
+        return self.create_geoserver_layer_handle(SESSION_USERNAME, session, 
+                                                  geoserver_url, layer_name, 
+                                                  workspace)
+    
+    
+    def _check_sessions(self):
+        if self.sessions is None:
+            raise Exception('This server has no sessions')
+    
+    
+    def _make_connection(self, geoserver_url, username, userpass):
+        return geoserver.Geoserver(geoserver_url, username, userpass)
+        
+        
+    def _connect(self, username, userpass, geoserver_url):
+        """Get verified connection to geoserver
+        
+        If username is '__session__', userpass is a session token and the
+        credentials of the session are used. Connections are reused.
+        """
+        
+        if username == SESSION_USERNAME:
+            self._check_sessions()
+            username, userpass, session_url = self.sessions.get(userpass)
+            if session_url.rstrip('/') != geoserver_url.rstrip('/'):
+                msg = 'Session is for geoserver %s, not %s' % (session_url, geoserver_url)
+                raise Exception(msg)
+                
+        return self.connections.get(geoserver_url, username, userpass)
+    
+    
     def create_geoserver_layer_handle(self, username, userpass, geoserver_url, layer_name, workspace):
         """Create fully qualified geoserver layer name
         
@@ -29,6 +308,8 @@ class RiabAPI():
         Returns
             layer_handle=string of the form:
                 username:password@geoserver_url/[workspace/]layer_name
+            Handles with username '__session__' and a session token as 
+            password refer to a session (see login).
                 
         Example         
             admin:geoserver@http://localhost:8080/geoserver/hazard/shakemap_padang_20090930
@@ -115,12 +396,78 @@ class RiabAPI():
         username, userpass, geoserver_url, layer_name, workspace =\
             self.split_geoserver_layer_handle(geoserver_layer_handle)
         
-        gs = geoserver.Geoserver(geoserver_url, username, userpass)      
+        gs = self._connect(username, userpass, geoserver_url)
         gs.get_workspace(workspace, verbose=False)        
         
         return 'SUCCESS'
 
             
+    def resolve_layer_handles(self, handles):
+        """Check many geoserver layer handles and get metadata of their layers
+        
+        Arguments
+            handles = list of fully qualified geoserver layer names 
+            
+        Returns
+            list with one dictionary per handle with fields 
+                handle = the handle
+                exists = True if the layer can be accessed
+                workspace = workspace of the layer
+                crs = native coordinate reference system, e.g. 'EPSG:4326'
+                extent = [minx, miny, maxx, maxy] in native CRS
+                extent_wgs84 = [minx, miny, maxx, maxy] in longitude and latitude
+                native_resolution = [columns, rows] of the layer
+                pixel_size = [width, height] of cells in native CRS units
+                error = reason the layer can not be accessed ('' if it can)
+            crs, extent etc. are only present if the layer exists.
+            
+        Note    
+            Handles are grouped by geoserver and credentials. The 
+            catalog of each geoserver is fetched once for all its handles.
+        """
+        
+        results = []
+        groups = {}
+        for handle in handles:
+            result = {'handle': handle, 'exists': False, 'workspace': '', 'error': ''}
+            results.append(result)
+            try:
+                username, userpass, geoserver_url, layer_name, workspace =\
+                    self.split_geoserver_layer_handle(handle)
+            except Exception, e:
+                result['error'] = 'Malformed handle: %s' % e
+                continue
+                
+            result['workspace'] = workspace
+            if not layer_name:
+                result['error'] = 'Handle has no layer name'
+                continue
+                
+            if workspace:
+                name = '%s:%s' % (workspace, layer_name)
+            else:
+                name = layer_name
+            groups.setdefault((username, userpass, geoserver_url), []).append((name, result))
+            
+        for (username, userpass, geoserver_url), members in groups.items():
+            try:
+                gs = self._connect(username, userpass, geoserver_url)
+                info = gs.get_coverage_info([name for name, result in members])
+            except Exception, e:
+                for name, result in members:
+                    result['error'] = str(e)
+                continue
+                
+            for name, result in members:
+                if name in info:
+                    result['exists'] = True
+                    result.update(info[name])
+                else:
+                    result['error'] = 'Layer %s was not found on geoserver %s' % (name, geoserver_url)
+                    
+        return results
+        
+            
     def create_workspace(self, username, userpass, geoserver_url, workspace_name):
         """Create new workspace on GeoServer
         
@@ -141,7 +488,7 @@ class RiabAPI():
             return 'SUCCESS'
         
         # Connect to Geoserver
-        gs = geoserver.Geoserver(geoserver_url, username, userpass)                  
+        gs = self._connect(username, userpass, geoserver_url)
         gs.create_workspace(workspace_name, verbose=False)
                     
         # Check that it was indeed created 
@@ -166,7 +513,7 @@ class RiabAPI():
         
         # FIXME(Ole): Should this use the handle even though layername would be ignored?
         
-        gs = geoserver.Geoserver(geoserver_url, username, userpass)                  
+        gs = self._connect(username, userpass, geoserver_url)
         try:
             gs.get_workspace(workspace_name, verbose=False)
         except:
@@ -198,6 +545,10 @@ class RiabAPI():
                      
         Note
             hazards and exposure may be lists of handles or just a single handle each.             
+            Progress is reported in phases 'resolve', 'download', 'align', 
+            'compute', 'write', 'upload' and 'style' (see get_job_progress).
+            Downloaded layers and the result are written to the scratch
+            directory of the request, which is removed afterwards.
         """
         
         # Make sure hazards and exposures are lists
@@ -207,13 +558,73 @@ class RiabAPI():
         if type(exposures) != type([]):
             exposures = [exposures]            
         
-        # Download data - FIXME(Ole): Currently only raster. FIXME (Ole): Not even sure they should be lists
+        # Check handles and credentials before downloading anything. The
+        # connections are reused, so this costs no round trip to geoservers
+        # already verified.
+        report_progress('resolve', 0, 1)
+        for handle in hazards + exposures:
+            username, userpass, geoserver_url, layer_name, workspace = \
+                self.split_geoserver_layer_handle(handle)
+            self._connect(username, userpass, geoserver_url)
+        
+        hazard_layers, exposure_layers, projection, geotransform = \
+            self._read_layers(hazards, exposures, bounding_box)
+                        
+        # Pass hazard and exposure arrays on to plugin    
+        F = calculate_impact(hazard_layers, exposure_layers, impact_function_id)
+        
+        self._upload_impact(F, projection, geotransform, impact)
+        
+        return 'SUCCES'
+    
+    
+    def calculate_tile(self, hazards, exposures, impact_function_id, bounding_box):
+        """Calculate impact for part of a bounding box and return it as an array
+        
+        This is the work done by each worker of a distributed calculation
+        (see riab_server.RiabServer.calculate_distributed).
+        
+        Arguments
+            hazards, exposures, impact_function_id = as for calculate
+            bounding_box = part of the bounding box of the calculation 
+        
+        Returns
+            impact as an array payload (see get_raster_array)
+        """
+        
+        if type(hazards) != type([]):
+            hazards = [hazards]
+            
+        if type(exposures) != type([]):
+            exposures = [exposures]            
+            
+        hazard_layers, exposure_layers, projection, geotransform = \
+            self._read_layers(hazards, exposures, bounding_box)
+        F = calculate_impact(hazard_layers, exposure_layers, impact_function_id)
+        return make_array_payload(F, projection, geotransform)
+        
+        
+    def _read_layers(self, hazards, exposures, bounding_box):
+        """Download hazard and exposure layers and check that they line up
+        
+        Returns
+            hazard_layers, exposure_layers, projection, geotransform
+        """
         
+        # Download data - FIXME(Ole): Currently only raster. FIXME (Ole): Not even sure they should be lists
+        handles = hazards + exposures
+        rasters = []
+        for i, handle in enumerate(handles):
+            check_deadline()
+            report_progress('download', i, len(handles))
+            rasters.append(self.get_raster_data(handle, bounding_box))
+        
+        # Check that the layers line up
+        report_progress('align', 0, 1)
         projection = None
         geotransform = None
         hazard_layers = []
-        for hazard in hazards:
-            raster = self.get_raster_data(hazard, bounding_box)
+        for raster in rasters[:len(hazards)]:
             H = raster.get_data()
             hazard_layers.append(H)
             
@@ -232,8 +643,7 @@ class RiabAPI():
                 
                 
         exposure_layers = []
-        for exposure in exposures:
-            raster = self.get_raster_data(exposure, bounding_box)
+        for raster in rasters[len(hazards):]:
             E = raster.get_data()
             exposure_layers.append(E)
             
@@ -244,25 +654,23 @@ class RiabAPI():
             geotransform == raster.get_geotransform(), msg
             
                         
-        # Pass hazard and exposure arrays on to plugin    
-        # FIXME, for the time being we just calculate the fatality function assuming only one of each layer.
+        return hazard_layers, exposure_layers, projection, geotransform
         
-        H = hazard_layers[0]
-        E = exposure_layers[0]
-
-        # Calculate impact
-        # FIXME (Ole): This is where an impact plugin should be called
-        a = 0.97429
-        b = 11.037
-        F = 10**(a*H-b)*E    
+        
+    def _upload_impact(self, F, projection, geotransform, impact):
+        """Write impact array to GeoTIFF and upload it to the impact layer handle
+        """
         
         # Upload result
         username, userpass, geoserver_url, layer_name, workspace = self.split_geoserver_layer_handle(impact)
         
-        output_file = 'data/%s.tif' % layer_name
-        write_coverage_to_geotiff(F, output_file, 
-                                  projection=projection,
-                                  geotransform=geotransform)
+        output_file = get_scratch_path('%s.tif' % layer_name)
+        check_deadline()
+        report_progress('write', 0, 1)
+        geoserver_raster.write_coverage_to_geotiff(F, output_file, 
+                                                   projection=projection,
+                                                   geotransform=geotransform)
+        check_quota()
         
         #(FIXME(Ole): still super hacky and not at all general)        
         # FIXME(Ole): Get everything from gdalinfo
@@ -283,11 +691,61 @@ class RiabAPI():
                                                 '',
                                                 workspace)
 
+        check_deadline()
+        report_progress('upload', 0, 1)
         self.upload_geoserver_layer(output_file, lh)
+    
+    
+    def calculate_arrays(self, hazards, exposures, impact_function_id, comment):
+        """Calculate impact from hazard and exposure arrays sent with the call
         
+        This avoids the upload and download through GeoServer for clients
+        that already have the data.
+        
+        Arguments
+            hazards = A list of hazard levels [H1,H2..HN] where each H is
+                      an array payload as returned by get_raster_array
+            exposures = A list of exposure levels [E1,E2...EN] in the same
+                        format
+            impact_function_id = Id of the impact function to be run 
+            comment = String with comment for output metadata
+            
+        Returns
+            impact as an array payload (see get_raster_array)
+            
+        Note
+            hazards and exposures may be lists of payloads or just a single payload each.             
+        """
+        
+        # Make sure hazards and exposures are lists
+        if type(hazards) != type([]):
+            hazards = [hazards]
+            
+        if type(exposures) != type([]):
+            exposures = [exposures]            
+            
+        projection = None
+        geotransform = None
+        layers = []
+        for payload in hazards + exposures:
+            A, p, g = read_array_payload(payload)
+            layers.append(A)
+            
+            if projection is None:
+                projection = p
+                geotransform = g
+            else:    
+                msg = 'Projections in hazard and exposure levels are different: %s %s' % (projection, p)
+                assert projection == p, msg
+                
+                msg = 'Geotransforms in hazard and exposure levels are different: %s %s' % (geotransform, g)
+                assert geotransform == g, msg
+                
+        F = calculate_impact(layers[:len(hazards)], layers[len(hazards):], 
+                             impact_function_id)
+                             
+        return make_array_payload(F, projection, geotransform)
         
-        return 'SUCCES'
-    
     
     def suggest_impact_func_ids(self, hazards, exposures):
         """Return appropriate impact function ids for the given hazards and exposure
@@ -350,7 +808,7 @@ class RiabAPI():
 
         # Unpack and connect
         username, userpass, geoserver_url, layer_name, workspace = self.split_geoserver_layer_handle(name)
-        gs = geoserver.Geoserver(geoserver_url, username, userpass)                                  
+        gs = self._connect(username, userpass, geoserver_url)
         
         # Check that workspace exists
         gs.get_workspace(workspace)
@@ -386,7 +844,7 @@ class RiabAPI():
         
         # Unpack and connect
         username, userpass, geoserver_url, layer_name, workspace = self.split_geoserver_layer_handle(name)
-        gs = geoserver.Geoserver(geoserver_url, username, userpass)                                  
+        gs = self._connect(username, userpass, geoserver_url)
 
         # Check that workspace exists
         gs.get_workspace(workspace)
@@ -434,7 +892,7 @@ class RiabAPI():
 
         # Unpack and connect
         username, userpass, geoserver_url, layer_name, workspace = self.split_geoserver_layer_handle(name)
-        gs = geoserver.Geoserver(geoserver_url, username, userpass)                                  
+        gs = self._connect(username, userpass, geoserver_url)
         
         # Check that workspace exists
         gs.get_workspace(workspace)
@@ -447,6 +905,28 @@ class RiabAPI():
 
         return raster
         
+        
+    def get_raster_array(self, name, bounding_box):
+        """Get raster data from the specified geoserver as a compressed array
+        
+        Unlike get_raster_data, the result can be sent through XMLRPC.
+        
+        Arguments
+            name = the fully qualified name of the layer i.e. 'username:password@geoserver_url:shakemap_padang_20090930'
+            bounding box = array bounds of the downloaded map e.g [96.956,-5.519,104.641,2.289] 
+        
+        Returns
+            dictionary with fields data, projection, geotransform, shape
+            and dtype. data is an xmlrpclib.Binary holding the array in
+            zlib compressed numpy (.npy) format. Use numpy.load on the 
+            decompressed data to get the array.
+        """
+        
+        raster = self.get_raster_data(name, bounding_box)
+        return make_array_payload(raster.get_data(), 
+                                  raster.get_projection(), 
+                                  raster.get_geotransform())
+        
             
     
     def download_geoserver_vector_layer(self):
@@ -465,7 +945,7 @@ class RiabAPI():
         
         # Unpack and connect
         username, userpass, geoserver_url, layer_name, workspace = self.split_geoserver_layer_handle(name)
-        gs = geoserver.Geoserver(geoserver_url, username, userpass)                                  
+        gs = self._connect(username, userpass, geoserver_url)
         
         # Delete layer
         gs.delete_layer(layer_name, workspace, verbose=False)
@@ -481,7 +961,7 @@ class RiabAPI():
         """
         
         # Connect
-        gs = geoserver.Geoserver(geoserver_url, username, userpass)                                  
+        gs = self._connect(username, userpass, geoserver_url)
         
         # Delete layer
         gs.delete_all_layers(verbose=False)
@@ -5,26 +5,224 @@
 # Created: 01/16/2011
 
 import sys
-import unittest
+import logging
 import common
 import riab_api
 import argparse
 
 from rpc_server import RPCServer, stop_server
+from sessions import SessionStore
+from distributed import WorkerRegistry, Coordinator, WorkerAnnouncer
 
 
 class RiabServer(RPCServer):
     """Base class for the Risk-in-a-Box server"""
     
-    def __init__(self, server_url, port):
+    # Cached results dropped by calls of each method
+    cache_invalidations = {'create_workspace': ['workspace_exists', 
+                                                'check_geoserver_layer_handle'],
+                           'upload_geoserver_layer': ['check_geoserver_layer_handle',
+                                                      'resolve_layer_handles'],
+                           'delete_layer': ['check_geoserver_layer_handle',
+                                            'resolve_layer_handles'],
+                           'delete_all_layers': ['check_geoserver_layer_handle',
+                                                 'resolve_layer_handles'],
+                           'calculate': ['resolve_layer_handles'],
+                           'logout': ['workspace_exists', 
+                                      'check_geoserver_layer_handle',
+                                      'resolve_layer_handles']}
+    
+    def __init__(self, server_url, port, threads=common.threads, 
+                 processes=common.processes, event_loop=common.event_loop,
+                 role=common.role):
            
+        # Sessions are shared by all generations of the API and, as the 
+        # store is made before pre-forking, by all server processes
+        sessions = SessionStore(common.session_database, common.session_lifetime)
+        
         # Register the api
-        RPCServer.__init__(self, server_url, port, riab_api.RiabAPI, riab_api)
+        RPCServer.__init__(self, server_url, port, riab_api.RiabAPI, riab_api,
+                           threads=threads, processes=processes,
+                           queue_size=common.queue_size,
+                           keepalive_timeout=common.keepalive_timeout,
+                           keepalive_requests=common.keepalive_requests,
+                           gzip_threshold=common.gzip_threshold,
+                           drain_timeout=common.drain_timeout,
+                           stats_window=common.stats_window,
+                           geoservers=common.geoservers,
+                           health_interval=common.health_interval,
+                           health_timeout=common.health_timeout,
+                           cache_ttls=common.cache_ttls,
+                           cache_invalidations=self.cache_invalidations,
+                           scratch_root=common.scratch_directory,
+                           scratch_quota=common.scratch_quota,
+                           job_workers=common.job_workers,
+                           job_database=common.job_database,
+                           job_keep=common.job_keep,
+                           job_queue_size=common.job_queue_size,
+                           event_loop=event_loop,
+                           reload_packages=('geoserver_api',),
+                           api_kwargs={'sessions': sessions})
+                           
+        self.server.register_function(self.submit_calculation)
+        
+        # Distributed calculations (see module distributed)
+        self.role = role
+        self.announcer = None
+        if role == 'coordinator':
+            if processes > 1:
+                logging.warning('Each coordinator process has its own workers. '
+                                'Run coordinators as one process.')
+            if not common.worker_secret:
+                logging.warning('No secret is configured in [Distributed]. '
+                                'Workers can not register.')
+            self.workers = WorkerRegistry(common.worker_timeout, 
+                                          common.worker_retry_after,
+                                          common.worker_secret,
+                                          common.allowed_workers)
+            self.coordinator = Coordinator(self.workers, common.max_attempts,
+                                           common.tile_timeout)
+            self.server.register_function(self.register_worker)
+            self.server.register_function(self.unregister_worker)
+            self.server.register_function(self.get_workers)
+            self.server.register_function(self.calculate_distributed, 'calculate')
+        elif role == 'worker':
+            worker_url = common.worker_url or 'http://%s:%i' % (server_url, port)
+            self.announcer = WorkerAnnouncer(common.coordinator_url, worker_url,
+                                             max(threads, 1) * processes,
+                                             common.heartbeat_interval,
+                                             common.worker_secret)
+            
+            # Bands come with sealed handles (see calculate_distributed)
+            self.server.register_function(self.calculate_tile)
+        elif role != 'standalone':
+            raise Exception('Unknown role %s. Use standalone, coordinator or worker.' % role)
+        
+        
+    def serve(self):
+        # Workers are only offered work while they are serving
+        if self.announcer is not None:
+            self.announcer.start()
+        try:
+            RPCServer.serve(self)
+        finally:
+            if self.announcer is not None:
+                self.announcer.stop()
+        
+        
+    def submit_calculation(self, hazards, exposures, impact_function_id, impact, bounding_box, comment,
+                           priority='normal', client=''):
+        """Start calculation in the background
+        
+        Arguments are the same as for calculate plus
+            priority = 'high', 'normal' or 'low'. Queued high priority 
+                       calculations (e.g. operational shakemaps) always 
+                       start before other calculations.
+            client = identity of the submitting client. Capacity within a
+                     priority class is shared fairly between clients.
+        
+        Returns
+            job_id = string identifying the calculation. Use it with
+                     get_job_status, get_job_result and cancel_job.
+        """
+        
+        return self.jobs.submit('calculate', 
+                                [hazards, exposures, impact_function_id, 
+                                 impact, bounding_box, comment],
+                                priority=priority, client=client)
+        
+        
+    def register_worker(self, url, capacity, secret):
+        """Offer worker server for distributed calculations
+        
+        Workers call this every heartbeat interval (see 
+        distributed.WorkerAnnouncer). Workers whose heartbeats stop are
+        given no more work.
+        
+        Arguments
+            url = URL of the worker's server. It must be one of the 
+                  allowed_workers if any are configured.
+            capacity = number of calculations the worker can run at a time
+            secret = secret shared by coordinator and workers
+        """
+        
+        self.workers.authorize(url, secret)
+        self.workers.register(url, capacity)
+        return 'SUCCESS'
+        
+        
+    def unregister_worker(self, url, secret):
+        self.workers.authorize(url, secret)
+        self.workers.unregister(url)
+        return 'SUCCESS'
+        
+        
+    def get_workers(self):
+        """Get registered workers
+        
+        Returns
+            list of dictionaries, see distributed.WorkerRegistry.get_status
+        """
+        
+        return self.workers.get_status()
+        
+        
+    def calculate_distributed(self, hazards, exposures, impact_function_id, impact, bounding_box, comment):
+        """Calculate like riab_api.RiabAPI.calculate on the registered workers
+        
+        The bounding box is split into tiles_per_worker bands for each 
+        calculation the workers can run at a time. Each worker calculates
+        bands (calculate_tile) until none are left, and bands of workers 
+        that fail are given to others. Without workers, this server 
+        calculates itself. Progress of the bands is reported in phase 
+        'tiles'. The credentials in the handles sent to workers are sealed
+        with the shared secret.
+        """
+        
+        api = self.server.generation.instance
+        capacity = sum(self.workers.get_available().values())
+        if not capacity:
+            logging.warning('No workers registered. Calculating in the coordinator.')
+            return api.calculate(hazards, exposures, impact_function_id, impact, 
+                                 bounding_box, comment)
+            
+        module = self.server.generation.module or riab_api
+        
+        def map_tiles(params_list):
+            sealed = [[[module.seal_layer_handle(h, common.worker_secret) for h in hazards],
+                       [module.seal_layer_handle(e, common.worker_secret) for e in exposures],
+                       impact_function_id, band]
+                      for hazards, exposures, impact_function_id, band in params_list]
+            return self.coordinator.map('calculate_tile', sealed, 
+                                        local=self.calculate_tile)
+            
+        return module.calculate_tiled(api, map_tiles, hazards, exposures, 
+                                      impact_function_id, impact, bounding_box,
+                                      comment, capacity * common.tiles_per_worker)
+
+        
+        
+    def calculate_tile(self, hazards, exposures, impact_function_id, bounding_box):
+        """Calculate band of a distributed calculation like RiabAPI.calculate_tile
+        
+        The handles must be sealed with the shared secret (see 
+        riab_api.seal_layer_handle), so only the coordinator can use this.
+        """
+        
+        module = self.server.generation.module or riab_api
+        hazards = [module.unseal_layer_handle(h, common.worker_secret) for h in hazards]
+        exposures = [module.unseal_layer_handle(e, common.worker_secret) for e in exposures]
+        return self.server.generation.instance.calculate_tile(hazards, exposures, 
+                                                              impact_function_id, 
+                                                              bounding_box)
 
 
-def start_server(server_url, port):
+def start_server(server_url, port, threads=common.threads, 
+                 processes=common.processes, event_loop=common.event_loop,
+                 role=common.role):
     print('Starting Risk in a Box Server at %s:%s' % (server_url, port))
-    RiabServer(server_url,port).start()
+    RiabServer(server_url, port, threads=threads, processes=processes,
+               event_loop=event_loop, role=role).start()
     
 if __name__=='__main__':
     parser = argparse.ArgumentParser(description='Riab Server')
@@ -32,6 +230,15 @@ if __name__=='__main__':
                    help='Port for the server')
     parser.add_argument('--server', type=str, default=common.server_url,
                    help='Server type')
+    parser.add_argument('--threads', type=int, default=common.threads,
+                   help='Number of worker threads serving requests')
+    parser.add_argument('--processes', type=int, default=common.processes,
+                   help='Number of pre-forked server processes')
+    parser.add_argument('--event-loop', action='store_true', default=common.event_loop,
+                   help='Serve connections from one event loop thread')
+    parser.add_argument('--role', type=str, default=common.role,
+                        choices=['standalone', 'coordinator', 'worker'],
+                   help='Role in distributed calculations')
     parser.add_argument('--stop', action='store_const',
                         const=stop_server, default=start_server,
                    help='Stop the server if its running.')
@@ -39,6 +246,11 @@ if __name__=='__main__':
     args = parser.parse_args()
     
     # By default call the server start
-    args.stop(args.server, args.port) # TODO: Better naming convention for args?
+    if args.stop is start_server:
+        start_server(args.server, args.port, threads=args.threads,
+                     processes=args.processes, event_loop=args.event_loop,
+                     role=args.role)
+    else:
+        stop_server(args.server, args.port)
 
 
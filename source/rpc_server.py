@@ -6,13 +6,35 @@
 
 from SimpleXMLRPCServer import SimpleXMLRPCServer
 from SimpleXMLRPCServer import SimpleXMLRPCRequestHandler
+from SimpleXMLRPCServer import resolve_dotted_attribute
 import xmlrpclib
 import socket
 import sys
+import os
+import imp
+import errno
+import re
+import select
+import fcntl
+import signal
+import threading
+import time
+import Queue
 import unittest
 import ConfigParser
 import logging
 from common import *
+import jsonrpc
+from jobs import JobManager, JobStore
+from stats import ServerStats
+from profiler import Profiler
+from health import HealthChecker
+from context import RequestContext, get_context, set_context
+from context import DeadlineExceeded, check_deadline
+from context import check_quota, get_scratch_path
+from cache import ResultCache
+from scratch import ScratchDirectory, remove_stale
+from async_server import AsyncFrontEnd
 
 
 def stop_server(server_url,port):
@@ -24,6 +46,49 @@ def stop_server(server_url,port):
         pass # Silently accept if the server is not running
         #print 'FAIL: No server listening at %s' % url
 
+
+def import_fresh(name, packages=()):
+    """Import a fresh copy of module name and of the given packages
+    
+    The modules are removed from sys.modules and imported again, so that
+    the new copy of the module sees new copies of all the package modules
+    it uses, while modules already holding the old copies keep working 
+    with those. If the import fails the old modules are put back.
+    """
+    
+    def is_fresh(key):
+        return key == name or key.split('.')[0] in packages
+        
+    imp.acquire_lock()
+    try:
+        old_modules = {}
+        for key in sys.modules.keys():
+            if is_fresh(key):
+                old_modules[key] = sys.modules.pop(key)
+                
+        try:
+            __import__(name)
+            return sys.modules[name]
+        except:
+            for key in sys.modules.keys():
+                if is_fresh(key):
+                    del sys.modules[key]
+            sys.modules.update(old_modules)
+            raise
+    finally:
+        imp.release_lock()
+        
+def make_pipe():
+    """Create pipe with non-blocking write end for waking up select()
+    
+    Returns file descriptors for reading and writing.
+    """
+    
+    r, w = os.pipe()
+    flags = fcntl.fcntl(w, fcntl.F_GETFL)
+    fcntl.fcntl(w, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    return r, w
+    
 	
 class APITest():
     API_VERSION='0.1a'
@@ -35,69 +100,1378 @@ class APITest():
         print 'Hello'
         return True
         
-class XMLRPCServer_overload(SimpleXMLRPCServer):
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        return True
+        
+    def work(self, seconds):
+        # Like sleep, but stops when the request runs out of time
+        t0 = time.time()
+        while time.time() - t0 < seconds:
+            check_deadline()
+            time.sleep(0.01)
+        return True
+        
+    def write_file(self, filename, size):
+        # Write intermediate file of the request and return its path
+        path = get_scratch_path(filename)
+        f = open(path, 'w')
+        f.write('x' * size)
+        f.close()
+        check_quota()
+        return path
+        
+class RequestHandler(SimpleXMLRPCRequestHandler):
+    """Request handler serving XMLRPC on /RPC2 and JSON-RPC on /JSON
+    
+    Connections are kept open between requests (HTTP/1.1 keep-alive) for
+    up to keepalive_requests requests, unless they are idle for more than
+    keepalive_timeout seconds. The worker thread does not wait for the 
+    next request: it hands the connection back to the main loop, which 
+    queues it again once a request arrives (see ThreadPoolMixIn). Without
+    a worker pool, connections are closed after each request as the main
+    loop can not wait for more.
+    Idle connections are closed as soon as the server stops.
+    Each request gets a correlation id for its log lines, taken from the
+    X-Request-Id header if the client sent one. It is returned in the
+    X-Request-Id header of the response.
+    Clients may limit the time spent on a request by sending the number
+    of seconds they are prepared to wait in the X-Request-Timeout header.
+    Work on the request stops once that time has passed, and the client
+    gets a fault with code DEADLINE_EXCEEDED.
+    Responses larger than gzip_threshold bytes are gzip encoded for 
+    clients that accept it, and gzip encoded requests are accepted.
+    These three settings are taken from the server.
+    """
+    
+    xmlrpcpath = '/RPC2'
+    jsonpath = '/JSON'
+    
+    # Restrict to particular paths.
+    rpc_paths = (xmlrpcpath, jsonpath)
+    
+    protocol_version = 'HTTP/1.1'
+    
+    def setup(self):
+        self.timeout = self.server.keepalive_timeout
+        self.encode_threshold = self.server.gzip_threshold
+        SimpleXMLRPCRequestHandler.setup(self)
+        
+        
+    def handle(self):
+        """Handle the requests that have arrived on this connection
+        
+        Sets keep_open if the connection is to wait for the next request
+        and requests_handled to the number of requests handled.
+        """
+        
+        self.keep_open = False
+        self.close_connection = 1
+        
+        # Don't hold up the main loop or the rejecter with a second 
+        # request. The response tells the client (see end_headers).
+        self.last_request = (self.server.pool_size == 0 or 
+                             getattr(self.server.rejecting, 'value', False))
+        self.close_announced = False
+        
+        self.handle_one_request()
+        self.requests_handled = 1
+        
+        while not self.close_connection and not self.last_request:
+            if self.requests_handled >= self.server.keepalive_requests:
+                break
+                
+            if self.server.quit:
+                break
+                
+            if not self.rfile._rbuf.tell():
+                # Nothing read yet. Wait in the main loop, not in this worker.
+                self.keep_open = True
+                break
+                
+            self.handle_one_request()
+            self.requests_handled += 1
+            
+    
+    def do_POST(self):
+        context = self.server.new_request_context(self.headers)
+        previous = set_context(context)
+        try:
+            SimpleXMLRPCRequestHandler.do_POST(self)
+        finally:
+            set_context(previous)
+            context.scratch.remove()
+            
+            
+    def end_headers(self):
+        context = get_context()
+        if context is not None:
+            self.send_header('X-Request-Id', context.request_id)
+        if self.last_request and not self.close_announced:
+            self.send_header('Connection', 'close')
+        SimpleXMLRPCRequestHandler.end_headers(self)
+        
+        
+    def log_message(self, format, *args):
+        # Log requests with the other log messages rather than on stderr
+        logging.info('%s %s' % (self.client_address[0], format % args))
+        
+        
+    def send_header(self, keyword, value):
+        # The base class always announces XML
+        if keyword.lower() == 'content-type' and self.path == self.jsonpath:
+            value = 'application/json'
+            
+        # Error responses announce the close themselves
+        if keyword.lower() == 'connection' and value.lower() == 'close':
+            self.close_announced = True
+        SimpleXMLRPCRequestHandler.send_header(self, keyword, value)
+        
+        
+class PoolTask:
+    """Function call that can be run by a pool worker or by the submitter
+    
+    Whoever calls run() first executes the function. Later calls do 
+    nothing, so a submitter waiting for tasks can run any task that no 
+    worker has picked up yet instead of waiting for it.
+    """
+    
+    def __init__(self, function):
+        self.function = function
+        self.context = get_context()
+        self.result = None
+        self.claimed = False
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        
+        
+    def run(self):
+        self.lock.acquire()
+        try:
+            if self.claimed:
+                return
+            self.claimed = True
+        finally:
+            self.lock.release()
+            
+        # Run in the context of the request the task was created for
+        previous = set_context(self.context)
+        try:
+            self.result = self.function()
+        finally:
+            set_context(previous)
+            self.done.set()
+            
+            
+class ThreadPoolMixIn:
+    """Mix-in class to serve requests from a bounded pool of worker threads
+    
+    The main loop only accepts connections and places them on a queue.
+    pool_size long lived worker threads take requests off the queue and
+    serve them, so a slow call (e.g. calculate) no longer blocks cheap
+    ones (e.g. version). A pool_size of 0 serves requests in the main loop
+    one at a time as before.
+    
+    At most queue_size requests wait for a worker. Further requests are
+    answered straight away with a SERVER_BUSY fault instead of being left
+    to time out in the listen backlog. They are read and answered by a
+    thread of their own, so that cheap methods (see always_admitted) are 
+    still served. While that thread is busy with another request, the 
+    fault is sent without reading the request. The main loop only ever 
+    hands requests on.
+    
+    Keep-alive connections waiting for their next request are watched by
+    the main loop rather than by a worker, so idle clients never keep the
+    pool from serving others. They are closed after keepalive_timeout
+    seconds, or straight away once max_idle connections are waiting.
+    """
+    
+    pool_size = 0
+    queue_size = 32
+    
+    # Most keep-alive connections the main loop watches at a time
+    max_idle = 256
+    
+    # Seconds a request that is turned away may take to arrive in full
+    reject_timeout = 1.0
+    
+    # Requests turned away are served with rejecting.value set, where
+    # rejecting is a threading.local of the server
+    
+    def start_pool(self):
+        """Start the worker threads
+        """
+        
+        self.request_queue = Queue.Queue(self.queue_size)
+        self.workers = []
+        self.active = 0
+        self.active_lock = threading.Lock()
+        self.rejected = 0
+        
+        # Keep-alive connections the main loop waits on: request -> 
+        # (client_address, requests served, time it went idle). Workers 
+        # put connections they are done with on returned.
+        self.idle = {}
+        self.returned = []
+        self.idle_lock = threading.Lock()
+        
+        # Fault sent to requests turned away without being read
+        self.busy_message = 'Server busy: %i requests queued. Try again later.' % self.queue_size
+        body = xmlrpclib.dumps(xmlrpclib.Fault(SERVER_BUSY, self.busy_message), 
+                               methodresponse=True)
+        self.busy_response = ('HTTP/1.1 200 OK\r\n'
+                              'Content-Type: text/xml\r\n'
+                              'Content-Length: %i\r\n'
+                              'Connection: close\r\n\r\n%s' % (len(body), body))
+            
+        for i in range(self.pool_size):
+            t = threading.Thread(target=self.process_request_worker,
+                                 name='RPCWorker-%i' % i)
+            t.setDaemon(True)  # Don't let workers keep the process alive
+            t.start()
+            self.workers.append(t)
+            
+        self.reject_queue = Queue.Queue(1)
+        self.rejecter_busy = False
+        self.rejecter = None
+        if self.pool_size > 0:
+            self.rejecter = threading.Thread(target=self.process_rejected_worker,
+                                             name='RPCRejecter')
+            self.rejecter.setDaemon(True)
+            self.rejecter.start()
+            
+        logging.debug('Started %i RPC worker threads' % self.pool_size)
+    
+    
+    def process_request_worker(self):
+        """Serve queued requests until told to exit (runs in each worker thread)
+        """
+        
+        while True:
+            item = self.request_queue.get()
+            if item is None:
+                return
+                
+            if isinstance(item, PoolTask):
+                # Tasks keep workers as busy as requests do
+                self.count_active(1)
+                try:
+                    item.run()
+                finally:
+                    self.count_active(-1)
+                continue
+                
+            request, client_address, served = item
+            self.count_active(1)
+            handler = None
+            try:
+                handler = self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            if handler is not None and handler.keep_open:
+                self.return_idle(request, client_address, 
+                                 served + handler.requests_handled)
+            else:
+                self.shutdown_request(request)
+            self.count_active(-1)
+            
+            
+    def finish_request(self, request, client_address):
+        """Handle request and return the request handler
+        """
+        
+        return self.RequestHandlerClass(request, client_address, self)
+        
+        
+    def return_idle(self, request, client_address, served):
+        """Have the main loop wait for the next request on a keep-alive connection
+        
+        Called by worker threads. The connection is closed instead if it 
+        has served keepalive_requests requests, the server is stopping or
+        max_idle connections are waiting already.
+        """
+        
+        self.idle_lock.acquire()
+        try:
+            keep = (served < self.keepalive_requests and not self.quit and 
+                    len(self.idle) + len(self.returned) < self.max_idle)
+            if keep:
+                self.returned.append((request, client_address, served))
+        finally:
+            self.idle_lock.release()
+            
+        if keep:
+            self.wake()
+        else:
+            self.shutdown_request(request)
+            
+            
+    def check_idle(self):
+        """Take over connections returned by workers and close timed out ones
+        
+        Runs in the main loop. Returns the idle connections to wait on and 
+        the seconds until the first of them times out (None if there are 
+        none).
+        """
+        
+        now = time.time()
+        self.idle_lock.acquire()
+        try:
+            for request, client_address, served in self.returned:
+                self.idle[request] = (client_address, served, now)
+            self.returned = []
+        finally:
+            self.idle_lock.release()
+            
+        timeout = None
+        for request, (client_address, served, since) in self.idle.items():
+            left = since + self.keepalive_timeout - now
+            if left <= 0:
+                del self.idle[request]
+                self.shutdown_request(request)
+            elif timeout is None or left < timeout:
+                timeout = left
+        return self.idle.keys(), timeout
+        
+        
+    def process_idle(self, request):
+        """Queue the next request of an idle keep-alive connection
+        
+        Connections closed by the client are closed here rather than 
+        taking up a place in the queue.
+        """
+        
+        client_address, served, since = self.idle.pop(request)
+        try:
+            closed = not request.recv(1, socket.MSG_PEEK)
+        except socket.error:
+            closed = True
+        if closed:
+            self.shutdown_request(request)
+        else:
+            self.process_request(request, client_address, served)
+        
+        
+    def close_idle(self):
+        """Close the connections waiting for their next request
+        """
+        
+        self.idle_lock.acquire()
+        try:
+            requests = self.idle.keys() + [item[0] for item in self.returned]
+            self.idle = {}
+            self.returned = []
+        finally:
+            self.idle_lock.release()
+        for request in requests:
+            self.shutdown_request(request)
+            
+            
+    def submit(self, function):
+        """Have a worker thread call function
+        
+        Raises Queue.Full if queue_size requests are waiting already.
+        """
+        
+        self.request_queue.put_nowait(PoolTask(function))
+        
+        
+    def count_active(self, n):
+        self.active_lock.acquire()
+        try:
+            self.active += n
+        finally:
+            self.active_lock.release()
+            
+            
+    def count_rejected(self):
+        self.active_lock.acquire()
+        try:
+            self.rejected += 1
+        finally:
+            self.active_lock.release()
+                
+                
+    def process_request(self, request, client_address, served=0):
+        """Hand request over to the worker pool
+        
+        served = number of requests served on the connection before
+        """
+        
+        if self.pool_size > 0:
+            try:
+                self.request_queue.put_nowait((request, client_address, served))
+            except Queue.Full:
+                self.reject_request(request, client_address)
+        else:
+            SimpleXMLRPCServer.process_request(self, request, client_address)
+            
+            
+    def run_tasks(self, functions):
+        """Call functions concurrently and return results in order
+        
+        Functions are handed to idle workers. The calling thread runs the
+        remaining ones itself, so this never waits for a busy pool, and 
+        tasks never wait in the queue in place of requests.
+        """
+        
+        tasks = [PoolTask(f) for f in functions]
+        
+        if self.pool_size > 0:
+            idle = self.pool_size - self.active - self.request_queue.qsize()
+            for task in tasks[1:idle+1]:
+                try:
+                    self.request_queue.put_nowait(task)
+                except Queue.Full:
+                    break
+                    
+        for task in tasks:
+            task.run()
+        for task in tasks:
+            task.done.wait()
+            
+        return [task.result for task in tasks]
+            
+            
+    def reject_request(self, request, client_address):
+        """Have request answered with a SERVER_BUSY fault (see _dispatch)
+        
+        Runs in the main loop, so it never waits for the client.
+        """
+        
+        if self.rejecter_busy:
+            self.send_busy(request)
+            return
+        try:
+            self.reject_queue.put_nowait((request, client_address))
+        except Queue.Full:
+            self.send_busy(request)
+            
+            
+    def send_busy(self, request):
+        """Send the SERVER_BUSY fault and close the connection without reading the request
+        """
+        
+        self.count_rejected()
+        request.setblocking(0)
+        try:
+            request.send(self.busy_response)
+            
+            # Take what the client sent already, as closing with unread 
+            # data resets the connection and may discard the response
+            while request.recv(65536):
+                pass
+        except socket.error:
+            pass  # Nothing more to read, or the client is gone
+        self.shutdown_request(request)
+        
+        
+    def process_rejected_worker(self):
+        """Read and answer requests turned away (runs in own thread)
+        
+        Each request is given reject_timeout seconds in all. The socket is
+        shut down when the time is up, which ends any read still waiting.
+        """
+        
+        while True:
+            item = self.reject_queue.get()
+            if item is None:
+                return
+                
+            request, client_address = item
+            self.rejecter_busy = True
+            timer = threading.Timer(self.reject_timeout, self.abort_request, [request])
+            timer.start()
+            self.rejecting.value = True
+            request.settimeout(self.reject_timeout)
+            try:
+                try:
+                    self.finish_request(request, client_address)
+                except:
+                    logging.warning('Could not turn away request from %s' % str(client_address))
+            finally:
+                self.rejecting.value = False
+                timer.cancel()
+            self.shutdown_request(request)
+            self.rejecter_busy = False
+            
+            
+    def abort_request(self, request):
+        try:
+            request.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass  # Closed already
+        
+        
+    def get_load(self):
+        """Get request queue depth and counts for this process
+        """
+        
+        return {'threads': self.pool_size,
+                'active_requests': self.active,
+                'queued_requests': self.request_queue.qsize(),
+                'queue_size': self.queue_size,
+                'rejected_requests': self.rejected}
+            
+            
+class APIGeneration:
+    """One loaded version of the API instance served by XMLRPCServer_overload
+    
+    Requests are dispatched to the generation that was current when they
+    arrived, and active counts those still running. The generation holds
+    on to its module as Python clears the globals of discarded modules.
+    """
+    
+    def __init__(self, number, instance, module=None):
+        self.number = number
+        self.instance = instance
+        self.module = module
+        self.active = 0
+        
+        
+class XMLRPCServer_overload(ThreadPoolMixIn, SimpleXMLRPCServer):
     """Subclass to allow clean exit
     
     Taken from http://code.activestate.com/recipes/114579-remotely-exit-a-xmlrpc-server-cleanly/
     """
     
+    # Cheap methods that are served even when requests are being turned 
+    # away, so that load balancers can see how busy the server is.
+    always_admitted = ['get_load', 'ping', 'readiness']
+    
+    # HTTP connection settings (see RequestHandler)
+    keepalive_timeout = 5.0
+    keepalive_requests = 100
+    gzip_threshold = 1400
+    
+    # Set to make serve_forever return. Not reset when serving starts, 
+    # as a pre-forked worker may be told to stop while starting up.
+    quit = 0
+    
+    # Current API generation (see register_generation)
+    generation = None
+    
+    # Call statistics (a stats.ServerStats)
+    stats = None
+    
+    # Profiler of selected calls (a profiler.Profiler)
+    profiler = None
+    
+    # Recent results of idempotent methods (a cache.ResultCache)
+    cache = None
+    
+    # Where the scratch directories of requests are made and how many
+    # bytes each may take up (see scratch.ScratchDirectory)
+    scratch_root = None
+    scratch_quota = 0
+    
+    def __init__(self, *args, **kwargs):
+        SimpleXMLRPCServer.__init__(self, *args, **kwargs)
+        
+        # Mutable state is made here rather than in the class, so that 
+        # servers in the same process share none of it.
+        
+        # Callables to be run by the main loop between requests, e.g. work
+        # requested from a signal handler.
+        self.deferred = []
+        
+        # Current and draining API generations (see register_generation)
+        self.generations = []
+        self.generation_lock = threading.Lock()
+        
+        # Top level method of the request being handled by each thread
+        self.current = threading.local()
+        
+        # Set while a request is turned away (see ThreadPoolMixIn)
+        self.rejecting = threading.local()
+        
+        
     def serve_forever(self):
-	self.quit = 0
+	self.start_serving()
 	while not self.quit:
 	    self.handle_request()
+	    while self.deferred:
+	        self.deferred.pop(0)()
+
+
+    def start_serving(self):
+        """Set up the wakeup pipes and the worker pool before serving
+        """
+        
+        self.wakeup_r, self.wakeup_w = make_pipe()
+        self.set_signal_wakeup(self.wakeup_w)
+        self.start_pool()
+        
+        # Do work deferred before serving started, e.g. a reload signalled
+        # while a pre-forked worker was starting, before the first request
+        if self.deferred:
+            self.wake()
+        
+        
+    def new_request_context(self, headers):
+        """Create RequestContext for request with the given HTTP headers
+        
+        The request id is taken from X-Request-Id and the deadline from 
+        X-Request-Timeout (see RequestHandler). The context gets a scratch
+        directory, which the caller removes when the request is done.
+        """
+        
+        request_id = headers.get('X-Request-Id', '')
+        if not re.match(r'^[\w.:-]{1,64}$', request_id):
+            request_id = None  # Make one up
+            
+        deadline = None
+        timeout = headers.get('X-Request-Timeout')
+        if timeout:
+            try:
+                deadline = time.time() + float(timeout)
+            except ValueError:
+                pass  # Ignore malformed header
+                
+        # Intermediate files of the request go in a directory of its own
+        scratch = ScratchDirectory(self.scratch_root, self.scratch_quota, 
+                                   request_id or '')
+        return RequestContext(request_id, deadline=deadline, scratch=scratch)
+        
+        
+    def handle_request(self):
+        """Handle one request, returning early if woken up (see wake)
+        
+        Idle keep-alive connections are waited on as well, and queued 
+        again when their next request arrives.
+        """
+        
+        idle, timeout = self.check_idle()
+        if timeout is None or (self.timeout is not None and self.timeout < timeout):
+            timeout = self.timeout
+            
+        try:
+            ready = select.select([self, self.wakeup_r] + idle, [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return  # Interrupted by a signal
+            raise
+            
+        if self.wakeup_r in ready:
+            os.read(self.wakeup_r, 512)
+        for request in ready:
+            if request in self.idle:
+                self.process_idle(request)
+        if self in ready:
+            self._handle_request_noblock()
+            
+            
+    def wake(self):
+        """Make the main loop look at quit and deferred straight away
+        
+        May be called from any thread and from signal handlers.
+        """
+        
+        try:
+            os.write(self.wakeup_w, 'x')
+        except (AttributeError, OSError):
+            pass  # Not serving yet, or a wakeup is pending already
+            
+            
+    def set_signal_wakeup(self, fd):
+        """Have signals wake the main loop
+        
+        Any thread may receive a signal, while the Python handler only 
+        runs once the main thread wakes up. fd = -1 turns this off.
+        """
+        
+        try:
+            signal.set_wakeup_fd(fd)
+        except ValueError:
+            pass  # Not serving in the main thread, so no signal handlers
+            
+            
+    def request_stop(self):
+        """Make serve_forever return
+        """
+        
+        self.quit = 1
+        self.wake()
+        
+        
+    def drain(self, timeout):
+        """Stop accepting requests and finish those already accepted
+        
+        Call after serve_forever has returned. Idle connections are closed.
+        Returns the number of requests still running after timeout seconds.
+        """
+        
+        deadline = time.time() + timeout
+        self.socket.close()
+        self.close_idle()
+        
+        for worker in self.workers:
+            try:
+                self.request_queue.put(None, True, max(0, deadline - time.time()))
+            except Queue.Full:
+                break
+        for worker in self.workers:
+            worker.join(max(0, deadline - time.time()))
+        running = len([worker for worker in self.workers if worker.isAlive()])
+        
+        if self.rejecter is not None:
+            try:
+                self.reject_queue.put(None, True, max(0, deadline - time.time()))
+            except Queue.Full:
+                pass
+            self.rejecter.join(max(0, deadline - time.time()))
+        
+        self.set_signal_wakeup(-1)
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+        del self.wakeup_w
+        return running
+
+
+    def _dispatch(self, method, params):
+        if getattr(self.rejecting, 'value', False) and method not in self.always_admitted:
+            self.count_rejected()
+            raise xmlrpclib.Fault(SERVER_BUSY, self.busy_message)
+            
+        if getattr(self.current, 'method', None) is None:
+            self.current.method = method
+            
+        t0 = time.time()
+        error = True
+        try:
+            try:
+                # The request may have waited in the queue for too long
+                check_deadline()
+                
+                if self.cache is not None:
+                    result = self.dispatch_cached(method, params)
+                else:
+                    result = self.dispatch_profiled(method, params)
+            except ServerBusy, e:
+                raise xmlrpclib.Fault(SERVER_BUSY, str(e))
+            except DeadlineExceeded, e:
+                raise xmlrpclib.Fault(DEADLINE_EXCEEDED, str(e))
+            error = False
+            return result
+        finally:
+            if self.stats is not None:
+                self.stats.record_call(method, time.time() - t0, error)
+            
+            
+    def dispatch_cached(self, method, params):
+        """Dispatch call, reusing recent results of cacheable methods
+        """
+        
+        if self.cache.is_cached(method):
+            hit, result, epoch = self.cache.get(method, params)
+            if not hit:
+                result = self.dispatch_profiled(method, params)
+                self.cache.put(method, params, result, epoch)
+            return result
+            
+        try:
+            return self.dispatch_profiled(method, params)
+        finally:
+            # Even a failed call may have changed something
+            self.cache.invalidate_after(method)
+            
+            
+    def dispatch_profiled(self, method, params):
+        if self.profiler is not None:
+            return self.profiler.call(method, self.dispatch_generation, 
+                                      method, params)
+        return self.dispatch_generation(method, params)
+        
+        
+    def register_generation(self, instance, module=None):
+        """Register instance as a new generation of the API
+        
+        New requests go to the new generation at once while requests 
+        already running on older generations finish there.
+        """
+        
+        self.generation_lock.acquire()
+        try:
+            number = 1
+            if self.generation is not None:
+                number = self.generation.number + 1
+            generation = APIGeneration(number, instance, module)
+            self.generations = [g for g in self.generations if g.active] + [generation]
+            self.generation = generation
+            self.register_instance(instance)
+        finally:
+            self.generation_lock.release()
+        return generation
+        
+        
+    def dispatch_generation(self, method, params):
+        """Dispatch like SimpleXMLRPCServer._dispatch, using the current generation
+        
+        Registered functions take precedence over methods of the instance.
+        """
+        
+        if method in self.funcs or self.generation is None:
+            return SimpleXMLRPCServer._dispatch(self, method, params)
+            
+        self.generation_lock.acquire()
+        generation = self.generation
+        generation.active += 1
+        self.generation_lock.release()
+        try:
+            try:
+                func = resolve_dotted_attribute(generation.instance, method,
+                                                self.allow_dotted_names)
+            except AttributeError:
+                raise Exception('method "%s" is not supported' % method)
+            return func(*params)
+        finally:
+            self.generation_lock.acquire()
+            generation.active -= 1
+            self.generation_lock.release()
+            
+            
+    def get_generations(self):
+        """Get the current API generation and the number of older ones still running requests
+        """
+        
+        self.generation_lock.acquire()
+        try:
+            draining = [g for g in self.generations 
+                        if g is not self.generation and g.active]
+        finally:
+            self.generation_lock.release()
+        return {'api_generation': self.generation.number,
+                'draining_generations': len(draining)}
+            
+            
+    def _marshaled_dispatch(self, data, dispatch_method=None, path=None):
+        """Decode request, dispatch it and encode the response
+        
+        Requests to the JSON path use JSON-RPC (see module jsonrpc), all
+        others use XMLRPC. Both reach the same registered methods.
+        Request and response sizes of JSON-RPC batches are recorded under
+        the name jsonrpc.batch.
+        """
+        
+        self.current.method = None
+        if path == RequestHandler.jsonpath:
+            response = jsonrpc.marshaled_dispatch(self._dispatch, data, self.run_tasks)
+            if data.lstrip().startswith('['):
+                self.current.method = 'jsonrpc.batch'
+        else:
+            response = SimpleXMLRPCServer._marshaled_dispatch(self, data, 
+                                                              dispatch_method, path)
+            
+        # Sizes count against the method called by the client
+        if self.stats is not None and self.current.method is not None:
+            self.stats.record_sizes(self.current.method, len(data), len(response))
+        return response
+            
+            
+    def system_multicall(self, call_list):
+        """system.multicall([{'methodName': 'add', 'params': [2, 2]}, ...]) => [[4], ...]
+        
+        Same as SimpleXMLRPCDispatcher.system_multicall except that the
+        calls are run concurrently on the worker pool. Results are 
+        returned in the order of the calls.
+        """
+        
+        functions = [lambda call=call: self.multicall_one(call) for call in call_list]
+        return self.run_tasks(functions)
+        
+        
+    def multicall_one(self, call):
+        """Perform one call of a multicall and return its result entry
+        """
+        
+        method_name = call['methodName']
+        params = call['params']
+        
+        try:
+            # XXX A marshalling error in any response will fail the entire
+            # multicall. If someone cares they should fix this.
+            return [self._dispatch(method_name, params)]
+        except xmlrpclib.Fault, fault:
+            return {'faultCode' : fault.faultCode,
+                    'faultString' : fault.faultString}
+        except:
+            exc_type, exc_value = sys.exc_info()[:2]
+            return {'faultCode' : 1,
+                    'faultString' : "%s:%s" % (exc_type, exc_value)}
 
         
 class RPCServer():
     # The stateless RIAB server
     
-    def __init__(self, url, port, api_class, api_module=None):
-        # Restrict to a particular path.
-        class RequestHandler(SimpleXMLRPCRequestHandler):
-            xmlrpcpath="/RPC2"
-    
-            rpc_paths = (xmlrpcpath)
-
+    def __init__(self, url, port, api_class, api_module=None, threads=0,
+                 processes=1, queue_size=32, keepalive_timeout=5.0, 
+                 keepalive_requests=100, gzip_threshold=1400, job_workers=1, 
+                 job_database='jobs.db', job_keep=3600, job_queue_size=100,
+                 reload_packages=(), drain_timeout=30.0, stats_window=1000,
+                 geoservers=(), health_interval=30.0, health_timeout=5.0,
+                 cache_ttls=None, cache_invalidations=None, scratch_root=None,
+                 scratch_quota=0, event_loop=False, api_kwargs=None):
         self.api_class=api_class
         self.api_module=api_module
+        self.api_kwargs=api_kwargs or {}  # Passed to api_class, also on reload
+        self.reload_packages=reload_packages
         self.url=url
         self.port=port
+        self.processes=processes
+        self.drain_timeout=drain_timeout
+        self.scratch_root=scratch_root
+        self.event_loop=event_loop
+        self.master_pid=None
         
         # Create server
         self.server = XMLRPCServer_overload((url, port),
                                             requestHandler=RequestHandler)
+        self.server.pool_size = threads
+        if event_loop:
+            # The event loop hands every call to the worker pool
+            self.server.pool_size = max(threads, 1)
+        self.server.queue_size = queue_size
+        self.server.keepalive_timeout = keepalive_timeout
+        self.server.keepalive_requests = keepalive_requests
+        self.server.gzip_threshold = gzip_threshold
+        self.server.stats = ServerStats(stats_window)
+        self.server.profiler = Profiler()
+        self.server.cache = ResultCache(cache_ttls, cache_invalidations)
+        self.server.scratch_root = scratch_root
+        self.server.scratch_quota = scratch_quota
         logging.debug('XMLRPC Server instantiated.')
         
         # Register functions that allow listMethods, methodHelp and methodSignature.
         self.server.register_introspection_functions()
         
+        # Register system.multicall. Calls in a batch run concurrently.
+        self.server.register_multicall_functions()
+        
         # Register an instance; all the methods of the apiclass instance are
-        # published as XML-RPC methods 
-        self.server.register_instance(api_class())
+        # published as XML-RPC methods. Reloading registers new generations.
+        self.server.register_generation(api_class(**self.api_kwargs), api_module)
         logging.debug('API Registered.')
         
         self.server.register_function(self.stop)
         self.server.register_function(self.reload)
+        self.server.register_function(self.get_load)
+        self.server.register_function(self.ping)
+        self.server.register_function(self.readiness)
+        self.server.register_function(self.get_server_stats)
+        self.server.register_function(self.enable_profiling)
+        self.server.register_function(self.get_profile)
+        self.server.register_function(self.start_sampling)
+        self.server.register_function(self.stop_sampling)
+        self.server.register_function(self.get_samples)
+        
+        # Background jobs. Calls are dispatched through the server so 
+        # they always reach the currently registered API instance.
+        self.jobs = JobManager(self.server._dispatch, JobStore(job_database), 
+                               workers=job_workers, keep=job_keep,
+                               queue_size=job_queue_size, 
+                               scratch_root=scratch_root, 
+                               scratch_quota=scratch_quota)
+        self.server.register_function(self.get_job_status)
+        self.server.register_function(self.get_job_progress)
+        self.server.register_function(self.get_job_result)
+        self.server.register_function(self.cancel_job)
+        self.server.register_function(self.get_queue_statistics)
+        
+        # Reachability of the GeoServers, checked in the background
+        self.health = HealthChecker(geoservers, health_interval, health_timeout)
 
 
     def reload(self):
-        if self.api_module:
-            reload(self.api_module)
+        if self.is_worker():
+            # Check that the API imports, then have the master pass the 
+            # reload on to all workers. This one reloads when the master's
+            # signal arrives like the others, so each reloads once and 
+            # all of them stay at the same API generation.
+            if self.api_module:
+                import_fresh(self.api_module.__name__, self.reload_packages)
+            os.kill(self.master_pid, signal.SIGHUP)
+            return 'SUCCESS: %s reloading in all %i worker processes' % (str(self.api_module), 
+                                                                          self.processes)
             
-        # To do work out how to handle this without direct ref
-        self.server.register_instance(self.api_module.RiabAPI())
-        return 'SUCCESS: %s reloaded' % str(self.api_module)
+        self.reload_api()
+        return 'SUCCESS: %s reloaded (API generation %i)' % (str(self.api_module),
+                                                              self.server.generation.number)
 
+        
+    def reload_api(self):
+        """Register a new generation of the API
+        
+        The API module and the reload_packages it uses are imported afresh, 
+        so all of them change together. Requests in flight finish on the
+        old generation.
+        """
+        
+        if self.api_module:
+            self.api_module = import_fresh(self.api_module.__name__, 
+                                           self.reload_packages)
+            self.api_class = getattr(self.api_module, self.api_class.__name__)
+            
+        generation = self.server.register_generation(self.api_class(**self.api_kwargs), 
+                                                     self.api_module)
+        self.server.cache.clear()
+        logging.info('API generation %i registered' % generation.number)
+        
             
     def start(self):
         # Run the server's main loop
         logging.debug('Server Started.')
-        self.server.serve_forever()
+        remove_stale(self.scratch_root)
+        if self.processes > 1:
+            self.serve_prefork()
+        else:    
+            self.serve()
+            
+            
+    def serve(self):
+        # Serve requests and jobs in this process until stopped
+        self.jobs.start()
+        self.health.start()
+        if self.event_loop:
+            frontend = AsyncFrontEnd(self.server, RequestHandler.xmlrpcpath,
+                                     RequestHandler.jsonpath)
+            frontend.serve_forever()
+            
+            # Requests are answered by the loop, so it has to send the 
+            # responses of running requests before the pool is stopped
+            if frontend.drain(self.drain_timeout):
+                logging.warning('%i responses not sent at shutdown' % frontend.in_flight)
+        else:
+            self.server.serve_forever()
+        self.drain()
+        logging.debug('Server Stopped.')
+        
+        
+    def drain(self):
+        """Finish accepted requests and running jobs after the main loop stopped
+        
+        Waits at most drain_timeout seconds. Jobs still running then are 
+        abandoned and put back in the job queue.
+        
+        Returns list of ids of abandoned jobs.
+        """
+        
+        deadline = time.time() + self.drain_timeout
+        self.health.stop()
+        self.jobs.stop()
+        
+        requests = self.server.drain(self.drain_timeout)
+        if requests:
+            logging.warning('%i requests abandoned at shutdown' % requests)
+            
+        abandoned = self.jobs.join(max(0, deadline - time.time()))
+        for job_id in abandoned:
+            logging.warning('Job %s abandoned at shutdown and requeued' % job_id)
+        return abandoned
         
         
     def stop(self):
-        logging.debug('Server Stopped.')
-        self.server.quit = 1
+        logging.debug('Server stopping.')
+        self.server.request_stop()
+        
+        if self.is_worker():
+            # Have the master stop all workers
+            os.kill(self.master_pid, signal.SIGTERM)
+            
         return 'SUCCESS: Server at %s:%s stopping' % (self.url, self.port)
+        
+        
+    def get_load(self):
+        """Get current load of this server process
+        
+        Returns
+            dictionary with fields threads, active_requests, 
+            queued_requests, queue_size, rejected_requests, queued_jobs, 
+            job_queue_size, rejected_jobs, api_generation and 
+            draining_generations. Rejected counts are since start. 
+            Requests and jobs turned away get a fault with code SERVER_BUSY.
+        """
+        
+        load = self.server.get_load()
+        load.update(self.server.get_generations())
+        load['queued_jobs'] = self.jobs.store.count('queued')
+        load['job_queue_size'] = self.jobs.queue_size
+        load['rejected_jobs'] = self.jobs.rejected
+        return load
+        
+        
+    def ping(self):
+        """Check that the server is alive. Touches nothing else.
+        """
+        
+        return 'pong'
+        
+        
+    def readiness(self):
+        """Check whether the server is ready to serve API calls
+        
+        Returns
+            dictionary with fields ready, stopping and geoservers. ready is
+            False if the server is stopping or any GeoServer was found to 
+            be unreachable at its last check. geoservers holds the results
+            of the last checks, see health.HealthChecker.get_status.
+        """
+        
+        stopping = bool(getattr(self.server, 'quit', 0))
+        geoservers = self.health.get_status()
+        ready = not stopping
+        for status in geoservers.values():
+            if not status['reachable']:
+                ready = False
+                
+        return {'ready': ready,
+                'stopping': stopping,
+                'geoservers': geoservers}
+        
+        
+    def get_server_stats(self):
+        """Get call counts, latencies and message sizes of each method
+        
+        Returns
+            dictionary with fields uptime, window and methods, see 
+            stats.ServerStats.get_stats, and cache with the ttl, hits and
+            misses of each cached method. Statistics are for the process
+            serving the call.
+        """
+        
+        stats = self.server.stats.get_stats()
+        stats['cache'] = self.server.cache.get_stats()
+        return stats
+        
+        
+    #----------
+    # Profiling
+    #----------
+    
+    def enable_profiling(self, method_name, n_calls=1):
+        """Profile the next n_calls calls of method_name with cProfile
+        
+        Get the result with get_profile. n_calls = 0 cancels profiling.
+        Only calls served by this process are profiled.
+        """
+        
+        self.server.profiler.enable(method_name, n_calls)
+        return 'SUCCESS: Profiling next %i calls of %s' % (n_calls, method_name)
+        
+        
+    def get_profile(self, method_name, sort='cumulative', limit=30):
+        """Get pstats summary of the calls profiled after enable_profiling
+        
+        Returns
+            dictionary with fields method, calls_profiled, calls_pending
+            and summary (text as printed by pstats).
+        """
+        
+        return self.server.profiler.get_profile(method_name, sort, limit)
+        
+        
+    def start_sampling(self, interval=0.01):
+        """Start sampling what all calls spend their time on
+        
+        The stacks of threads serving calls are looked at every interval 
+        seconds. This has little overhead and can be left on.
+        """
+        
+        dispatch_code = XMLRPCServer_overload._dispatch.im_func.func_code
+        self.server.profiler.start_sampling(interval, dispatch_code)
+        return 'SUCCESS: Sampling every %f seconds' % interval
+        
+        
+    def stop_sampling(self):
+        self.server.profiler.stop_sampling()
+        return 'SUCCESS: Sampling stopped'
+        
+        
+    def get_samples(self, limit=30):
+        """Get functions most often seen on the stack of each method
+        
+        Returns
+            dictionary with fields sampling, duration and methods, see
+            profiler.Profiler.get_samples.
+        """
+        
+        return self.server.profiler.get_samples(limit)
+        
+        
+    #----------------
+    # Background jobs
+    #----------------
+    
+    def get_job_status(self, job_id):
+        """Get status of background job
+        
+        Returns
+            dictionary with fields id, method, status, error, submitted, 
+            started and finished. Status is one of 'queued', 'running', 
+            'finished', 'failed' or 'cancelled'.
+        """
+        
+        return self.jobs.get_status(job_id)
+        
+        
+    def get_job_progress(self, job_id):
+        """Get latest progress report of background job
+        
+        Returns
+            dictionary with fields 
+                id, status = as for get_job_status
+                phase = current phase of the work, e.g. for calculate one of
+                        'resolve', 'download', 'align', 'compute', 'write',
+                        'upload' or 'style' ('' before the first report)
+                blocks_done, blocks_total = blocks of the phase processed 
+                                            and to do
+                percent = blocks_done as percentage of blocks_total
+                updated = time of latest report
+                seconds_since_update = seconds since the latest report (or 
+                                       the start) of a running job. A 
+                                       large value suggests it is stuck.
+            Reports are recorded at most once a second within a phase.
+        """
+        
+        return self.jobs.get_progress(job_id)
+        
+        
+    def get_job_result(self, job_id):
+        """Get return value of finished background job
+        
+        An exception is raised if the job failed or has not yet finished.
+        """
+        
+        return self.jobs.get_result(job_id)
+        
+        
+    def cancel_job(self, job_id):
+        """Cancel background job
+        
+        Queued jobs are cancelled straight away. Running jobs stop at 
+        their next check of the deadline and then get status 'cancelled'.
+        """
+        
+        return self.jobs.cancel(job_id)
+        
+        
+    def get_queue_statistics(self):
+        """Get job counts and queue wait times for each priority class
+        
+        Returns
+            dictionary keyed by priority class ('high', 'normal', 'low') 
+            with fields queued, oldest_queued_wait, started, mean_wait 
+            and max_wait. Times are in seconds.
+        """
+        
+        return self.jobs.store.get_queue_statistics()
+        
+        
+    #------------------------
+    # Pre-forked worker model
+    #------------------------
+    
+    def is_worker(self):
+        """Return True if running in a pre-forked worker process
+        """
+        
+        return self.master_pid is not None and os.getpid() != self.master_pid
+        
+        
+    def serve_prefork(self):
+        """Fork worker processes that share the listening socket
+        
+        The master process does not serve requests itself. It supervises
+        the workers, respawns any that die, and passes stop (SIGTERM) and
+        reload (SIGHUP) on to every worker.
+        """
+        
+        self.master_pid = os.getpid()
+        self.worker_pids = []
+        self.stopping = False
+        
+        signal.signal(signal.SIGTERM, self.master_stop_handler)
+        signal.signal(signal.SIGINT, self.master_stop_handler)        
+        signal.signal(signal.SIGHUP, self.master_reload_handler)
+        
+        for i in range(self.processes):
+            self.spawn_worker()
+        logging.debug('Started %i worker processes' % self.processes)
+            
+        while self.worker_pids:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue  # Interrupted by a signal
+                raise
+                
+            if pid not in self.worker_pids:
+                continue
+            self.worker_pids.remove(pid)
+            
+            if not self.stopping:
+                logging.warning('Worker process %i died with status %i. Respawning.' % (pid, status))
+                self.spawn_worker()
+                
+        self.server.server_close()
+        logging.debug('All worker processes stopped.')    
+        
+        
+    def spawn_worker(self):
+        """Fork one worker process serving requests from the shared socket
+        """
+        
+        pid = os.fork()
+        if pid > 0:
+            self.worker_pids.append(pid)
+            return
+        
+        # In worker process
+        signal.signal(signal.SIGTERM, self.worker_stop_handler)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)        
+        signal.signal(signal.SIGHUP, self.worker_reload_handler)
+        try:
+            self.serve()
+        finally:
+            logging.shutdown()  # Write queued log records
+            os._exit(0)
+            
+        
+    def master_stop_handler(self, signum, frame):
+        if os.getpid() != self.master_pid:
+            # Signal reached a new worker before it set its own handlers
+            return self.worker_stop_handler(signum, frame)
+            
+        self.stopping = True
+        for pid in self.worker_pids:
+            os.kill(pid, signal.SIGTERM)
+        
+        
+    def master_reload_handler(self, signum, frame):
+        if os.getpid() != self.master_pid:
+            return self.worker_reload_handler(signum, frame)
+            
+        for pid in self.worker_pids:
+            os.kill(pid, signal.SIGHUP)
+            
+            
+    def worker_stop_handler(self, signum, frame):
+        self.server.request_stop()
+        
+        
+    def worker_reload_handler(self, signum, frame):
+        # Reload between requests rather than in the middle of one
+        self.server.deferred.append(self.reload_deferred)
+        self.server.wake()
+        
+        
+    def reload_deferred(self):
+        # Runs in the main loop, which must keep serving if the reload fails
+        try:
+            self.reload_api()
+        except:
+            logging.exception('Reload failed. Still serving API generation %i.' % 
+                              self.server.generation.number)
     
 
 if __name__=='__main__':
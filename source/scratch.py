@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+#coding:utf-8
+# Author:   AIFDR www.aifdr.org
+# Purpose:  Private directories for the files of each request
+# Created: 10/18/2026
+
+import os
+import errno
+import shutil
+import tempfile
+import threading
+import uuid
+import logging
+
+# Names of scratch directories start with this and the owner token of the
+# process that made them, so that directories left behind by processes
+# that were killed can be recognised
+PREFIX = 'riab-'
+
+# Owner token of this process by pid, as forked children need their own
+owners = {}
+
+
+def get_owner():
+    """Get owner token of this process, e.g. '1234.5f2c9a01'
+    
+    Tokens differ between processes that get the same pid (as happens to
+    pid 1 in restarted containers).
+    """
+    
+    pid = os.getpid()
+    if pid not in owners:
+        owners[pid] = '%i.%s' % (pid, uuid.uuid4().hex[:8])
+    return owners[pid]
+    
+    
+def owner_is_live(owner):
+    """Return True if the process with given owner token is alive
+    """
+    
+    try:
+        pid = int(owner.split('.')[0])
+    except ValueError:
+        return False  # Not a token, e.g. made before tokens were used
+        
+    if pid == os.getpid():
+        return owner == get_owner()
+    return process_exists(pid)
+    
+    
+def process_exists(pid):
+    """Return True if process with given pid is alive
+    """
+    
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM  # Alive, but not ours to signal
+    else:
+        return True
+
+
+class QuotaExceeded(Exception):
+    """Raised when the files of a request take more space than allowed
+    """
+    pass
+
+
+class ScratchDirectory:
+    """Directory for the intermediate files of one request or job
+    
+    Arguments
+        root = directory holding the scratch directories of all requests
+               (None for the system's temporary directory)
+        quota = number of bytes the files may take up (0 for no limit)
+        name = included in the name of the directory, e.g. the request id
+    
+    The directory is only made when a path in it is first asked for, so
+    requests that write no files cost nothing. remove() deletes it with
+    everything in it. Calls of a multicall or batch share the directory
+    from several threads.
+    """
+    
+    def __init__(self, root=None, quota=0, name=''):
+        self.root = root
+        self.quota = quota
+        self.name = name
+        self.path = None
+        self.lock = threading.Lock()
+    
+    
+    def get_path(self, filename=''):
+        """Get path of file in the directory, making the directory if needed
+        """
+        
+        self.lock.acquire()
+        try:
+            if self.path is None:
+                if self.root and not os.path.isdir(self.root):
+                    try:
+                        os.makedirs(self.root)
+                    except OSError:
+                        pass  # Made by another process in the meantime
+                prefix = '%s%s-%s-' % (PREFIX, get_owner(), self.name)
+                self.path = tempfile.mkdtemp(prefix=prefix, dir=self.root or None)
+            path = self.path
+        finally:
+            self.lock.release()
+        return os.path.join(path, filename)
+    
+    
+    def get_usage(self):
+        """Get number of bytes taken up by the files in the directory
+        """
+        
+        if self.path is None:
+            return 0
+        
+        usage = 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                try:
+                    usage += os.path.getsize(os.path.join(dirpath, filename))
+                except OSError:
+                    pass  # Removed while walking
+        return usage
+    
+    
+    def get_room(self):
+        """Get number of bytes that may still be written, None if unlimited
+        """
+        
+        if not self.quota:
+            return None
+        return max(self.quota - self.get_usage(), 0)
+    
+    
+    def check_quota(self):
+        """Raise QuotaExceeded if the files take up more than the quota
+        """
+        
+        if not self.quota:
+            return
+        
+        usage = self.get_usage()
+        if usage > self.quota:
+            msg = ('Files of request %s take up %i bytes, which is more than '
+                   'the %i bytes allowed' % (self.name, usage, self.quota))
+            raise QuotaExceeded(msg)
+    
+    
+    def remove(self):
+        self.lock.acquire()
+        try:
+            path = self.path
+            self.path = None
+        finally:
+            self.lock.release()
+        if path is not None:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def remove_stale(root):
+    """Remove scratch directories left behind in root by processes that died
+    
+    Directories of live processes, e.g. other servers sharing root, are 
+    left alone.
+    """
+    
+    if not root or not os.path.isdir(root):
+        return
+    
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if not name.startswith(PREFIX) or not os.path.isdir(path):
+            continue
+        owner = name[len(PREFIX):].split('-')[0]
+        if not owner_is_live(owner):
+            logging.info('Removing stale scratch directory %s' % path)
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+#coding:utf-8
+# Author:   AIFDR www.aifdr.org
+# Purpose:  Login sessions and reuse of verified GeoServer connections
+# Created: 10/18/2026
+
+import os
+import time
+import threading
+import binascii
+import hashlib
+import hmac
+import sqlite3
+
+
+def make_keystream(key, nonce, n):
+    stream = []
+    for i in range((n + 31) / 32):
+        stream.append(hmac.new(key, '%s:%i' % (nonce, i), hashlib.sha256).digest())
+    return ''.join(stream)[:n]
+
+
+def seal(key, nonce, text):
+    """Encrypt text so that only holders of key can read it
+    
+    Arguments
+        key = secret string
+        nonce = string used for no other text sealed with the same key
+        text = string to encrypt
+    
+    Returns
+        hex string of the text XORed with a stream derived from key and
+        nonce, followed by a tag that shows whether it was sealed with key
+    """
+    
+    data = text.encode('utf-8')
+    stream = make_keystream(key, nonce, len(data))
+    data = ''.join([chr(ord(a) ^ ord(b)) for a, b in zip(data, stream)])
+    tag = hmac.new(key, nonce + data, hashlib.sha256).digest()[:16]
+    return binascii.hexlify(data + tag)
+
+
+def unseal(key, nonce, sealed):
+    """Decrypt text sealed by seal
+    
+    Returns None if it was not sealed with key and nonce, or was changed.
+    """
+    
+    try:
+        sealed = binascii.unhexlify(sealed)
+    except TypeError:
+        return None
+    data, tag = sealed[:-16], sealed[-16:]
+    if not hmac.compare_digest(hmac.new(key, nonce + data, hashlib.sha256).digest()[:16], tag):
+        return None
+    stream = make_keystream(key, nonce, len(data))
+    return ''.join([chr(ord(a) ^ ord(b)) for a, b in zip(data, stream)]).decode('utf-8')
+
+
+class SessionStore:
+    """Login sessions in an SQLite database
+    
+    Arguments
+        filename = database file
+        lifetime = seconds a session lasts after it was last used
+    
+    Sessions hold the GeoServer credentials given at login so that
+    clients can refer to them by token. Passwords are not written to the
+    database as they are. They are encrypted with a key that only exists
+    in the memory of the server, made when the store is created. Create
+    the store once in the server before pre-forking, so that a session
+    started with one server process can be used with any other. Sessions
+    end when the server restarts. The database file is only readable by
+    the owner of the server process.
+    """
+    
+    def __init__(self, filename, lifetime=3600):
+        self.filename = filename
+        self.lifetime = lifetime
+        self.key = os.urandom(32)
+        
+        if not os.path.exists(filename):
+            os.close(os.open(filename, os.O_WRONLY | os.O_CREAT, 0600))
+        
+        db = self.connect()
+        try:
+            # Drop sessions of earlier versions, which kept passwords as they are
+            columns = [row[1] for row in db.execute('PRAGMA table_info(sessions)')]
+            if 'userpass' in columns:
+                db.execute('DROP TABLE sessions')
+            
+            db.execute('''CREATE TABLE IF NOT EXISTS sessions (
+                              token TEXT PRIMARY KEY,
+                              username TEXT,
+                              sealed_userpass TEXT,
+                              geoserver_url TEXT,
+                              expires REAL)''')
+            db.commit()
+        finally:
+            db.close()
+    
+    
+    def connect(self):
+        # A new connection per operation keeps the store safe to use
+        # from any thread and across fork.
+        return sqlite3.connect(self.filename, timeout=30)
+    
+    
+    def create(self, username, userpass, geoserver_url):
+        """Start session and return its token
+        """
+        
+        token = binascii.hexlify(os.urandom(16))
+        now = time.time()
+        db = self.connect()
+        try:
+            db.execute('DELETE FROM sessions WHERE expires < ?', (now,))
+            db.execute('INSERT INTO sessions VALUES (?, ?, ?, ?, ?)',
+                       (token, username, seal(self.key, token, userpass), 
+                        geoserver_url, now + self.lifetime))
+            db.commit()
+        finally:
+            db.close()
+        return token
+    
+    
+    def get(self, token):
+        """Get credentials of session
+        
+        Returns
+            username, userpass, geoserver_url
+        
+        Raises an exception if the session is unknown or has expired.
+        """
+        
+        now = time.time()
+        db = self.connect()
+        try:
+            row = db.execute('''SELECT username, sealed_userpass, geoserver_url, expires
+                                FROM sessions WHERE token = ?''', (str(token),)).fetchone()
+            if row is not None:
+                # None if sealed by a server that ran before
+                userpass = unseal(self.key, str(token), row[1])
+            if row is None or row[3] < now or userpass is None:
+                raise Exception('Session is unknown or has expired. Please log in again.')
+            
+            # Extend session, but only write once in a while
+            if row[3] - now < self.lifetime / 2:
+                db.execute('UPDATE sessions SET expires = ? WHERE token = ?',
+                           (now + self.lifetime, token))
+                db.commit()
+        finally:
+            db.close()
+        return row[0], userpass, row[2]
+    
+    
+    def delete(self, token):
+        db = self.connect()
+        try:
+            db.execute('DELETE FROM sessions WHERE token = ?', (token,))
+            db.commit()
+        finally:
+            db.close()
+
+
+class ConnectionPool:
+    """Verified connections kept for reuse, one per URL and credentials
+    
+    Arguments
+        connect = function taking geoserver_url, username and userpass
+                  that returns a verified connection, e.g.
+                  geoserver.Geoserver. It raises an exception if the
+                  connection can not be made.
+        max_age = seconds a connection is reused before it is verified
+                  again
+        max_connections = number of connections kept
+    
+    Connections are kept in memory of each server process.
+    """
+    
+    def __init__(self, connect, max_age=300, max_connections=100):
+        self.connect = connect
+        self.max_age = max_age
+        self.max_connections = max_connections
+        
+        # (geoserver_url, username, userpass) -> (time verified, connection)
+        self.connections = {}
+        self.lock = threading.Lock()
+    
+    
+    def get(self, geoserver_url, username, userpass):
+        """Get verified connection, making one if needed
+        """
+        
+        key = (geoserver_url, username, userpass)
+        now = time.time()
+        self.lock.acquire()
+        try:
+            entry = self.connections.get(key)
+        finally:
+            self.lock.release()
+        if entry is not None and now - entry[0] < self.max_age:
+            return entry[1]
+        
+        # Verify without holding the lock as it takes a round trip
+        connection = self.connect(geoserver_url, username, userpass)
+        
+        self.lock.acquire()
+        try:
+            if len(self.connections) >= self.max_connections:
+                for k, (verified, c) in self.connections.items():
+                    if now - verified >= self.max_age:
+                        del self.connections[k]
+                if len(self.connections) >= self.max_connections:
+                    self.connections.clear()
+            self.connections[key] = (now, connection)
+        finally:
+            self.lock.release()
+        return connection
+
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#coding:utf-8
+# Author:   AIFDR www.aifdr.org
+# Purpose:  Per-method call statistics for the RPC server
+# Created: 10/18/2026
+
+import threading
+import time
+import math
+from collections import deque
+
+
+def percentile(values, p):
+    """Return the p'th percentile (0-100) of sorted list values (nearest rank)
+    """
+    
+    if not values:
+        return 0.0
+    
+    i = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[min(max(i, 0), len(values) - 1)]
+
+
+class MethodStats:
+    """Counts and recent latencies of calls to one method
+    """
+    
+    def __init__(self, window):
+        self.calls = 0
+        self.errors = 0
+        
+        # (finish time, duration) of the most recent calls
+        self.recent = deque(maxlen=window)
+        
+        self.requests = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.max_request_bytes = 0
+        self.max_response_bytes = 0
+
+
+class ServerStats:
+    """Call statistics of the methods served by one server process
+    
+    Arguments
+        window = number of most recent calls of each method that
+                 latencies and throughput are calculated from
+    
+    Recording a call only appends to a bounded deque under a lock.
+    Percentiles are worked out when statistics are requested.
+    """
+    
+    # Calls of further methods (e.g. misspelt ones) are lumped together 
+    # under the name 'other' once this many methods have been seen.
+    max_methods = 500
+    
+    def __init__(self, window=1000):
+        self.window = window
+        self.started = time.time()
+        self.methods = {}
+        self.lock = threading.Lock()
+    
+    
+    def get_method(self, method):
+        # Must be called with the lock held
+        stats = self.methods.get(method)
+        if stats is None:
+            if len(self.methods) >= self.max_methods:
+                method = 'other'
+                stats = self.methods.get(method)
+        if stats is None:
+            stats = self.methods[method] = MethodStats(self.window)
+        return stats
+    
+    
+    def record_call(self, method, duration, error=False):
+        """Record call of method that took duration seconds
+        """
+        
+        self.lock.acquire()
+        try:
+            stats = self.get_method(method)
+            stats.calls += 1
+            if error:
+                stats.errors += 1
+            stats.recent.append((time.time(), duration))
+        finally:
+            self.lock.release()
+    
+    
+    def record_sizes(self, method, request_bytes, response_bytes):
+        """Record sizes of an encoded request of method and its response
+        """
+        
+        self.lock.acquire()
+        try:
+            stats = self.get_method(method)
+            stats.requests += 1
+            stats.request_bytes += request_bytes
+            stats.response_bytes += response_bytes
+            stats.max_request_bytes = max(stats.max_request_bytes, request_bytes)
+            stats.max_response_bytes = max(stats.max_response_bytes, response_bytes)
+        finally:
+            self.lock.release()
+    
+    
+    def get_stats(self):
+        """Get statistics of all methods called so far
+        
+        Returns
+            dictionary with fields uptime, window and methods. methods is
+            keyed by method name and has fields calls, errors,
+            calls_per_second, latency_p50, latency_p95, latency_p99,
+            mean_request_bytes, max_request_bytes, mean_response_bytes
+            and max_response_bytes. Latencies are in seconds. Rates and
+            latencies are over the most recent window calls.
+        """
+        
+        now = time.time()
+        self.lock.acquire()
+        try:
+            snapshot = [(method, stats.calls, stats.errors, list(stats.recent),
+                         stats.requests, stats.request_bytes,
+                         stats.response_bytes, stats.max_request_bytes,
+                         stats.max_response_bytes)
+                        for method, stats in self.methods.items()]
+        finally:
+            self.lock.release()
+        
+        methods = {}
+        for (method, calls, errors, recent, requests, request_bytes,
+             response_bytes, max_request_bytes, max_response_bytes) in snapshot:
+            durations = sorted([duration for finished, duration in recent])
+            
+            rate = 0.0
+            if recent:
+                period = now - (recent[0][0] - recent[0][1])
+                if period > 0:
+                    rate = len(recent) / period
+            
+            mean_request_bytes = mean_response_bytes = 0
+            if requests:
+                mean_request_bytes = request_bytes / requests
+                mean_response_bytes = response_bytes / requests
+            
+            methods[method] = {'calls': calls,
+                               'errors': errors,
+                               'calls_per_second': rate,
+                               'latency_p50': percentile(durations, 50),
+                               'latency_p95': percentile(durations, 95),
+                               'latency_p99': percentile(durations, 99),
+                               'mean_request_bytes': mean_request_bytes,
+                               'max_request_bytes': max_request_bytes,
+                               'mean_response_bytes': mean_response_bytes,
+                               'max_response_bytes': max_response_bytes}
+        
+        return {'uptime': now - self.started,
+                'window': self.window,
+                'methods': methods}
@@ -0,0 +1,103 @@
+"""Measure how long the riab server takes to start accepting requests
+
+Usage: python benchmark_startup.py [repeats]
+
+Starts riab_server.py on a spare port a number of times and reports the
+time from launching the process until it answers ping, as well as the
+time taken to import riab_server. Exits with status 1 if the median
+startup time exceeds the target or if heavy modules are imported at
+startup.
+"""
+
+import os
+import sys
+import time
+import socket
+import tempfile
+import shutil
+import xmlrpclib
+from subprocess import Popen, PIPE
+
+# Location of the server source code
+parent_dir = os.path.split(os.getcwd())[0]
+source_path = os.path.join(parent_dir, 'source')
+
+# Seconds until the server must answer
+target = 0.5
+
+# Modules that must only be imported when first used
+heavy_modules = ['numpy', 'osgeo', 'owslib', 'pycurl']
+
+port = 8002
+
+
+def measure_import():
+    """Import riab_server in a fresh interpreter
+
+    Returns seconds taken and list of heavy modules imported.
+    """
+
+    script = ('import sys, time; t0 = time.time(); import riab_server; '
+              'print time.time() - t0; '
+              'print " ".join([m for m in %s if m in sys.modules])' % heavy_modules)
+    p = Popen([sys.executable, '-c', script], cwd=workdir, stdout=PIPE,
+              env=dict(os.environ, PYTHONPATH=source_path))
+    lines = p.communicate()[0].split('\n')
+    return float(lines[0]), lines[1].split()
+
+
+def measure_startup():
+    """Start server and return seconds until it answers ping
+    """
+
+    devnull = open(os.devnull, 'w')
+    t0 = time.time()
+    p = Popen([sys.executable, os.path.join(source_path, 'riab_server.py'),
+               '--port', str(port)], cwd=workdir, stdout=devnull, stderr=devnull)
+    server = xmlrpclib.ServerProxy('http://localhost:%i' % port)
+
+    while True:
+        try:
+            server.ping()
+        except socket.error:
+            if p.poll() is not None:
+                raise Exception('Server exited with status %i' % p.returncode)
+            time.sleep(0.005)
+        else:
+            break
+    duration = time.time() - t0
+
+    xmlrpclib.ServerProxy('http://localhost:%i' % port).stop()
+    p.wait()
+    devnull.close()
+    return duration
+
+
+if __name__ == '__main__':
+    repeats = 5
+    if len(sys.argv) > 1:
+        repeats = int(sys.argv[1])
+
+    # Keep log file and job database of the servers out of the way
+    workdir = tempfile.mkdtemp()
+    try:
+        import_time, imported = measure_import()
+        times = sorted([measure_startup() for i in range(repeats)])
+    finally:
+        shutil.rmtree(workdir)
+
+    median = times[len(times)/2]
+    print 'Import of riab_server: %.3f s' % import_time
+    print 'Startup until first response: min %.3f s, median %.3f s, max %.3f s' % (times[0], median, times[-1])
+
+    ok = True
+    if imported:
+        print 'FAIL: Heavy modules imported at startup: %s' % ', '.join(imported)
+        ok = False
+    if median > target:
+        print 'FAIL: Median startup time exceeds target of %.3f s' % target
+        ok = False
+    if ok:
+        print 'OK'
+    else:
+        sys.exit(1)
@@ -3,6 +3,7 @@
 
 import os
 import sys
+import time
 import xmlrpclib
 from config import test_url
         
@@ -20,10 +21,10 @@ os.system('python %s/%s 2> riab_server_start.stderr & ' % (source_path,
 while(True):
     riab_server = xmlrpclib.ServerProxy(test_url)
     try:
-        riab_server.reload()
+        riab_server.ping()
     except:
-        # Server is not running
-        pass
+        # Server is not running yet
+        time.sleep(0.01)
     else:
         # Server is ready
         break
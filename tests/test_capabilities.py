@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+import sys, os
+import threading
+import tempfile
+import shutil
+import unittest
+import urlparse
+import BaseHTTPServer
+
+# Add location of source code to search path so that API can be imported
+parent_dir = os.path.split(os.getcwd())[0]
+source_path = os.path.join(parent_dir, 'source')
+sys.path.append(source_path)
+
+from geoserver_api import capabilities
+from riab_api import RiabAPI
+from sessions import SessionStore, ConnectionPool
+
+capabilities_document = """<?xml version="1.0" encoding="UTF-8"?>
+<wcs:WCS_Capabilities version="1.0.0" xmlns:wcs="http://www.opengis.net/wcs"
+                      xmlns:gml="http://www.opengis.net/gml">
+  <wcs:ContentMetadata>
+    <wcs:CoverageOfferingBrief>
+      <wcs:name>hazard:shakemap_padang_20090930</wcs:name>
+      <wcs:lonLatEnvelope srsName="urn:ogc:def:crs:OGC:1.3:CRS84">
+        <gml:pos>96.956 -5.519</gml:pos>
+        <gml:pos>104.641 2.289</gml:pos>
+      </wcs:lonLatEnvelope>
+    </wcs:CoverageOfferingBrief>
+    <wcs:CoverageOfferingBrief>
+      <wcs:name>exposure:population_padang_1</wcs:name>
+    </wcs:CoverageOfferingBrief>
+  </wcs:ContentMetadata>
+</wcs:WCS_Capabilities>
+"""
+
+description_template = """<?xml version="1.0" encoding="UTF-8"?>
+<CoverageDescription version="1.0.0" xmlns="http://www.opengis.net/wcs"
+                     xmlns:gml="http://www.opengis.net/gml">
+%s
+</CoverageDescription>
+"""
+
+offering_template = """
+  <CoverageOffering>
+    <name>%s</name>
+    <lonLatEnvelope srsName="urn:ogc:def:crs:OGC:1.3:CRS84">
+      <gml:pos>96.956 -5.519</gml:pos>
+      <gml:pos>104.641 2.289</gml:pos>
+    </lonLatEnvelope>
+    <domainSet>
+      <spatialDomain>
+        <gml:Envelope srsName="EPSG:4326">
+          <gml:pos>96.956 -5.519</gml:pos>
+          <gml:pos>104.641 2.289</gml:pos>
+        </gml:Envelope>
+        <gml:RectifiedGrid dimension="2" srsName="EPSG:4326">
+          <gml:limits>
+            <gml:GridEnvelope>
+              <gml:low>0 0</gml:low>
+              <gml:high>249 253</gml:high>
+            </gml:GridEnvelope>
+          </gml:limits>
+          <gml:axisName>x</gml:axisName>
+          <gml:axisName>y</gml:axisName>
+          <gml:origin>
+            <gml:pos>96.971 2.274</gml:pos>
+          </gml:origin>
+          <gml:offsetVector>0.030741 0.0</gml:offsetVector>
+          <gml:offsetVector>0.0 -0.030741</gml:offsetVector>
+        </gml:RectifiedGrid>
+      </spatialDomain>
+    </domainSet>
+    <supportedCRSs>
+      <requestResponseCRSs>EPSG:4326</requestResponseCRSs>
+      <nativeCRSs>EPSG:4326</nativeCRSs>
+    </supportedCRSs>
+  </CoverageOffering>
+"""
+
+description_document = description_template % (offering_template % 'hazard:shakemap_padang_20090930')
+
+exception_document = """<?xml version="1.0" encoding="UTF-8"?>
+<ServiceExceptionReport version="1.2.0">
+  <ServiceException code="CoverageNotDefined">No such coverage: nonexistent</ServiceException>
+</ServiceExceptionReport>
+"""
+
+
+class WCSHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve the documents above and record the requests
+    """
+    
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        self.server.requests.append((query['request'][0], query.get('coverage', [''])[0],
+                                     self.headers.get('Authorization')))
+        if query['request'][0] == 'GetCapabilities':
+            document = capabilities_document
+        else:
+            coverages = query['coverage'][0].split(',')
+            document = description_template % ''.join([offering_template % name for name in coverages])
+        
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(document)))
+        self.end_headers()
+        self.wfile.write(document)
+    
+    def log_message(self, format, *args):
+        pass
+
+
+class Connection:
+    """Stand-in for geoserver.Geoserver without the dependencies
+    """
+    
+    def __init__(self, geoserver_url, username, userpass):
+        self.geoserver_url = geoserver_url
+        self.username = username
+        self.userpass = userpass
+    
+    def get_coverage_info(self, names):
+        return capabilities.get_coverage_info(self.geoserver_url + '/wcs', names,
+                                              self.username, self.userpass)
+
+
+class Test_Capabilities(unittest.TestCase):
+    
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('localhost', 0), WCSHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.url = 'http://localhost:%i/geoserver' % self.server.server_port
+        
+        self.tmpdir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+    
+    
+    def test_parse_coverage_descriptions(self):
+        """Test that metadata is read from DescribeCoverage documents
+        """
+        
+        root = capabilities.ElementTree.fromstring(description_document)
+        info = capabilities.parse_coverage_descriptions(root)
+        shakemap = info['hazard:shakemap_padang_20090930']
+        assert shakemap['crs'] == 'EPSG:4326'
+        assert shakemap['extent'] == [96.956, -5.519, 104.641, 2.289]
+        assert shakemap['extent_wgs84'] == [96.956, -5.519, 104.641, 2.289]
+        assert shakemap['native_resolution'] == [250, 254]
+        assert shakemap['pixel_size'] == [0.030741, 0.030741]
+        
+        root = capabilities.ElementTree.fromstring(exception_document)
+        self.assertRaises(Exception, capabilities.parse_coverage_descriptions, root)
+    
+    
+    def test_resolve_layer_handles(self):
+        """Test that many handles are resolved with one catalog fetch
+        """
+        
+        api = RiabAPI(SessionStore(os.path.join(self.tmpdir, 'sessions.db')))
+        api.connections = ConnectionPool(Connection)
+        
+        handles = ['admin:geoserver@%s/[hazard]/shakemap_padang_20090930' % self.url,
+                   'admin:geoserver@%s/population_padang_1' % self.url,
+                   'admin:geoserver@%s/[hazard]/nonexistent' % self.url,
+                   'admin:geoserver@%s/[hazard]/' % self.url,
+                   'not a handle']
+        results = api.resolve_layer_handles(handles)
+        
+        assert [r['handle'] for r in results] == handles
+        assert [r['exists'] for r in results] == [True, True, False, False, False], results
+        assert results[0]['workspace'] == 'hazard'
+        assert results[0]['native_resolution'] == [250, 254]
+        assert results[0]['error'] == ''
+        assert 'not found' in results[2]['error']
+        assert results[4]['error'].startswith('Malformed handle')
+        
+        # One capabilities and one description request for all handles
+        kinds = [r[0] for r in self.server.requests]
+        assert kinds == ['GetCapabilities', 'DescribeCoverage'], self.server.requests
+        assert self.server.requests[1][1] == 'exposure:population_padang_1,hazard:shakemap_padang_20090930'
+        assert self.server.requests[0][2] == 'Basic YWRtaW46Z2Vvc2VydmVy'
+        
+        # GeoServers that can not be reached are reported per handle
+        handle = 'admin:geoserver@http://localhost:1/geoserver/[hazard]/shakemap'
+        result = api.resolve_layer_handles([handle])[0]
+        assert not result['exists']
+        assert result['error'].startswith('Could not open URL'), result
+
+
+################################################################################
+
+if __name__ == '__main__':
+    suite = unittest.makeSuite(Test_Capabilities, 'test')
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
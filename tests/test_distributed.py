@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+
+import sys, os
+import time
+import threading
+import unittest
+import xmlrpclib
+import multiprocessing
+import tempfile
+import shutil
+import socket
+
+# Add location of source code to search path so that API can be imported
+parent_dir = os.path.split(os.getcwd())[0]
+source_path = os.path.join(parent_dir, 'source')
+sys.path.append(source_path)
+
+from rpc_server import RPCServer
+from distributed import split_bounding_box, WorkerRegistry, Coordinator, WorkerAnnouncer
+from context import RequestContext, set_context, get_time_left, get_request_id
+
+# Ports of the worker processes and of the in-process coordinator
+worker_ports = [8021, 8022, 8023]
+coordinator_port = 8020
+
+# Nothing listens here
+dead_url = 'http://localhost:8029'
+
+# Servers answering with a broken status line and with something that 
+# is not XML listen here
+garbage_answers = {8027: 'HTTP/1.1 broken\r\n\r\n',
+                   8028: 'Not XML\r\n'}
+
+# Secret shared by the coordinator and the workers of the tests
+secret = 'test-secret'
+
+
+class TileAPI:
+    """Worker API returning what it was asked and who answered
+    """
+    
+    def tile(self, i):
+        time.sleep(0.05)
+        return {'i': i,
+                'pid': os.getpid(),
+                'request_id': get_request_id(),
+                'time_left': get_time_left() or -1}
+
+
+class FailingTileAPI:
+    
+    def tile(self, i):
+        raise Exception('Worker is broken')
+
+
+def answer_garbage(listener, answer):
+    """Answer each connection with answer
+    """
+    
+    while True:
+        try:
+            connection = listener.accept()[0]
+        except socket.error:
+            return  # Closed
+        connection.recv(65536)
+        connection.sendall(answer)
+        connection.close()
+
+
+def run_worker(port, api_class, directory):
+    server = RPCServer('localhost', port, api_class, threads=2,
+                       job_database=os.path.join(directory, 'jobs%i.db' % port))
+    server.start()
+
+
+class Test_Distributed(unittest.TestCase):
+    
+    def setUp(self):
+        """Start worker processes, the last one with a broken API
+        """
+        
+        self.directory = tempfile.mkdtemp()
+        self.urls = []
+        self.processes = []
+        for port in worker_ports:
+            if port == worker_ports[-1]:
+                api_class = FailingTileAPI
+            else:
+                api_class = TileAPI
+            p = multiprocessing.Process(target=run_worker,
+                                        args=(port, api_class, self.directory))
+            p.start()
+            self.processes.append(p)
+            self.urls.append('http://localhost:%i' % port)
+        
+        # Wait for the workers to listen
+        for url in self.urls:
+            t0 = time.time()
+            while True:
+                try:
+                    xmlrpclib.ServerProxy(url).ping()
+                    break
+                except Exception:
+                    assert time.time() - t0 < 10, 'Worker %s did not start' % url
+                    time.sleep(0.05)
+        
+        self.registry = WorkerRegistry(timeout=30, retry_after=30)
+        self.listeners = []
+        
+    def start_garbage_workers(self):
+        """Start the workers answering garbage and return their URLs
+        """
+        
+        urls = []
+        for port, answer in garbage_answers.items():
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind(('localhost', port))
+            listener.listen(5)
+            self.listeners.append(listener)
+            thread = threading.Thread(target=answer_garbage, args=(listener, answer))
+            thread.setDaemon(True)
+            thread.start()
+            urls.append('http://localhost:%i' % port)
+        return urls
+    
+    def tearDown(self):
+        """Stop worker processes
+        """
+        
+        for listener in self.listeners:
+            listener.shutdown(socket.SHUT_RDWR)  # Ends the wait in accept
+            listener.close()
+        for url in self.urls:
+            try:
+                xmlrpclib.ServerProxy(url).stop()
+            except Exception:
+                pass
+        for p in self.processes:
+            p.join(10)
+            if p.is_alive():
+                p.terminate()
+        shutil.rmtree(self.directory)
+    
+    
+    def test_split_bounding_box(self):
+        """Test that bands cover the bounding box on whole rows of cells
+        """
+        
+        bands = split_bounding_box([100, -10, 110, 0], 4)
+        assert len(bands) == 4, bands
+        assert bands[0] == [100, -2.5, 110, 0], bands
+        assert bands[-1] == [100, -10, 110, -7.5], bands
+        
+        # 10 rows of height 1 in 4 bands gives bands of 3, 3, 3 and 1 rows
+        bands = split_bounding_box([100, -10, 110, 0], 4, pixel_height=1.0)
+        assert [band[3] - band[1] for band in bands] == [3, 3, 3, 1], bands
+        for above, below in zip(bands[:-1], bands[1:]):
+            assert above[1] == below[3], bands
+        assert bands[0][3] == 0 and bands[-1][1] == -10, bands
+        
+        # No more bands than rows
+        bands = split_bounding_box([100, -2, 110, 0], 5, pixel_height=1.0)
+        assert len(bands) == 2, bands
+        
+        # 10 rows in 4 bands of 3 rows is 4 bands, in 6 bands of 2 rows is 5
+        assert len(split_bounding_box([0, 0, 1, 10], 6, pixel_height=1.0)) == 5
+    
+    
+    def test_registry(self):
+        """Test that workers drop out when they fail or miss heartbeats
+        """
+        
+        registry = WorkerRegistry(timeout=0.3, retry_after=0.3)
+        registry.register('http://a', 2)
+        registry.register('http://b', 1)
+        assert registry.get_available() == {'http://a': 2, 'http://b': 1}
+        
+        registry.record_result('http://a', True)
+        registry.record_result('http://b', False)
+        assert registry.get_available() == {'http://a': 2}
+        
+        status = registry.get_status()
+        assert [w['url'] for w in status] == ['http://a', 'http://b'], status
+        assert status[0]['tiles_done'] == 1 and status[0]['available'], status
+        assert status[1]['tiles_failed'] == 1 and not status[1]['available'], status
+        
+        # b is back after retry_after while a misses its heartbeat
+        time.sleep(0.2)
+        registry.register('http://b', 1)
+        time.sleep(0.2)
+        assert registry.get_available() == {'http://b': 1}
+        
+        registry.unregister('http://b')
+        assert registry.get_available() == {}
+        assert registry.get_status() == []
+    
+    
+    def test_authorize(self):
+        """Test that only workers knowing the secret and listed may register
+        """
+        
+        registry = WorkerRegistry(secret=secret)
+        registry.authorize('http://a', secret)
+        registry.authorize('http://a', unicode(secret))
+        self.assertRaises(Exception, registry.authorize, 'http://a', 'wrong')
+        self.assertRaises(Exception, registry.authorize, 'http://a', '')
+        
+        registry = WorkerRegistry(secret=secret, allowed_urls=['http://a'])
+        registry.authorize('http://a', secret)
+        self.assertRaises(Exception, registry.authorize, 'http://b', secret)
+        
+        # Without a secret no worker is allowed
+        registry = WorkerRegistry(allowed_urls=['http://a'])
+        self.assertRaises(Exception, registry.authorize, 'http://a', '')
+    
+    
+    def test_map_spreads_over_workers(self):
+        """Test that calls are spread over workers and results come back in order
+        """
+        
+        for url in self.urls[:2]:
+            self.registry.register(url, 2)
+        coordinator = Coordinator(self.registry)
+        
+        results = coordinator.map('tile', [[i] for i in range(12)])
+        assert [r['i'] for r in results] == range(12), results
+        
+        pids = set([r['pid'] for r in results])
+        assert len(pids) == 2, pids
+        assert os.getpid() not in pids
+        
+        status = self.registry.get_status()
+        assert sum([w['tiles_done'] for w in status]) == 12, status
+    
+    
+    def test_failed_workers(self):
+        """Test that calls failing on a worker are done by others
+        """
+        
+        garbage_url = self.start_garbage_workers()[0]
+        self.registry.register(self.urls[0], 1)
+        self.registry.register(garbage_url, 1)
+        self.registry.register(dead_url, 1)
+        coordinator = Coordinator(self.registry, max_attempts=3)
+        
+        results = coordinator.map('tile', [[i] for i in range(6)])
+        assert [r['i'] for r in results] == range(6), results
+        
+        status = dict([(w['url'], w) for w in self.registry.get_status()])
+        assert status[self.urls[0]]['tiles_done'] == 6, status
+        assert status[garbage_url]['tiles_failed'] == 1, status
+        assert status[dead_url]['tiles_failed'] == 1, status
+        assert self.registry.get_available() == {self.urls[0]: 1}
+    
+    
+    def test_broken_responses(self):
+        """Test that workers answering with broken HTTP count as failed
+        """
+        
+        garbage_urls = self.start_garbage_workers()
+        for url in garbage_urls:
+            self.registry.register(url, 1)
+        self.registry.register(self.urls[0], 1)
+        coordinator = Coordinator(self.registry, max_attempts=3)
+        
+        results = coordinator.map('tile', [[i] for i in range(6)])
+        assert [r['i'] for r in results] == range(6), results
+        
+        status = dict([(w['url'], w) for w in self.registry.get_status()])
+        for url in garbage_urls:
+            assert status[url]['tiles_failed'] == 1, status
+        assert status[self.urls[0]]['tiles_done'] == 6, status
+    
+    
+    def test_no_workers_left(self):
+        """Test that calls are done locally or fail when all workers failed
+        """
+        
+        self.registry.register(self.start_garbage_workers()[0], 1)
+        self.registry.register(dead_url, 1)
+        coordinator = Coordinator(self.registry, max_attempts=3)
+        
+        results = coordinator.map('tile', [[i] for i in range(3)],
+                                  local=TileAPI().tile)
+        assert [r['i'] for r in results] == range(3), results
+        assert set([r['pid'] for r in results]) == set([os.getpid()]), results
+        
+        # Both workers are left alone now
+        try:
+            coordinator.map('tile', [[0]])
+        except Exception, e:
+            assert 'No worker left' in str(e), e
+        else:
+            raise Exception('Calls without workers should fail')
+    
+    
+    def test_max_attempts(self):
+        """Test that calls failing on max_attempts workers fail the map
+        """
+        
+        self.registry.register(dead_url, 1)
+        coordinator = Coordinator(self.registry, max_attempts=1)
+        try:
+            coordinator.map('tile', [[0]], local=TileAPI().tile)
+        except Exception, e:
+            assert 'failed on 1 workers' in str(e), e
+            assert dead_url in str(e), e
+        else:
+            raise Exception('Calls failing on all attempts should fail')
+    
+    
+    def test_faults_fail_map(self):
+        """Test that faults raised by the called method are not retried
+        """
+        
+        self.registry.register(self.urls[-1], 1)  # Broken API
+        self.registry.register(self.urls[0], 1)
+        coordinator = Coordinator(self.registry, max_attempts=3)
+        try:
+            coordinator.map('tile', [[i] for i in range(6)], local=TileAPI().tile)
+        except xmlrpclib.Fault, e:
+            assert 'Worker is broken' in e.faultString, e
+        else:
+            raise Exception('Calls raising faults should fail')
+            
+        # The worker is still used
+        status = dict([(w['url'], w) for w in self.registry.get_status()])
+        assert status[self.urls[-1]]['tiles_failed'] == 0, status
+        assert len(self.registry.get_available()) == 2
+    
+    
+    def test_request_passed_on(self):
+        """Test that workers get the request id and deadline of the call
+        """
+        
+        self.registry.register(self.urls[0], 1)
+        coordinator = Coordinator(self.registry, call_timeout=30)
+        
+        previous = set_context(RequestContext('calc-1', None, time.time() + 5))
+        try:
+            results = coordinator.map('tile', [[0], [1]])
+        finally:
+            set_context(previous)
+        
+        assert [r['request_id'] for r in results] == ['calc-1.0', 'calc-1.1'], results
+        for r in results:
+            assert 0 < r['time_left'] <= 5, r
+        
+        # Without a deadline workers get call_timeout
+        results = coordinator.map('tile', [[0]])
+        assert 5 < results[0]['time_left'] <= 30, results
+    
+    
+    def test_announcer(self):
+        """Test that workers register with the coordinator while running
+        """
+        
+        self.registry.secret = secret
+        
+        def register(url, capacity, secret):
+            self.registry.authorize(url, secret)
+            self.registry.register(url, capacity)
+            return True
+        
+        def unregister(url, secret):
+            self.registry.authorize(url, secret)
+            self.registry.unregister(url)
+            return True
+        
+        server = RPCServer('localhost', coordinator_port, TileAPI, threads=1,
+                           job_database=os.path.join(self.directory, 'coordinator.db'))
+        server.server.register_function(register, 'register_worker')
+        server.server.register_function(unregister, 'unregister_worker')
+        thread = threading.Thread(target=server.start)
+        thread.setDaemon(True)
+        thread.start()
+        
+        try:
+            # Workers with the wrong secret are turned away
+            announcer = WorkerAnnouncer('http://localhost:%i' % coordinator_port,
+                                        self.urls[1], capacity=3, interval=0.1,
+                                        secret='wrong')
+            announcer.start()
+            time.sleep(0.3)
+            announcer.stop()
+            assert self.registry.get_available() == {}
+            
+            announcer = WorkerAnnouncer('http://localhost:%i' % coordinator_port,
+                                        self.urls[0], capacity=3, interval=0.1,
+                                        secret=secret)
+            announcer.start()
+            t0 = time.time()
+            while not self.registry.get_available():
+                assert time.time() - t0 < 5, 'Worker did not register'
+                time.sleep(0.05)
+            assert self.registry.get_available() == {self.urls[0]: 3}
+            
+            # Heartbeats keep coming
+            time.sleep(0.3)
+            assert self.registry.get_status()[0]['seconds_since_heartbeat'] < 0.3
+            
+            announcer.stop()
+            assert self.registry.get_available() == {}
+        finally:
+            server.stop()
+            thread.join(10)
+            server.server.server_close()
+
+
+################################################################################
+
+if __name__ == '__main__':
+    suite = unittest.makeSuite(Test_Distributed, 'test')
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
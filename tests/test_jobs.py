@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+
+import sys, os
+import time
+import threading
+import tempfile
+import sqlite3
+import unittest
+
+# Add location of source code to search path so that API can be imported
+parent_dir = os.path.split(os.getcwd())[0]
+source_path = os.path.join(parent_dir, 'source') 
+sys.path.append(source_path)
+
+from jobs import JobManager, JobStore, Job, new_owner
+from common import ServerBusy
+from context import report_progress, check_deadline
+
+
+def wait_for(manager, job_id, timeout=5):
+    """Wait until job is no longer queued or running and return its status
+    """
+    
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        status = manager.get_status(job_id)
+        if status['status'] not in ['queued', 'running']:
+            return status
+        time.sleep(0.05)
+        
+    raise Exception('Job %s did not complete in %f seconds' % (job_id, timeout))
+    
+
+class Test_Jobs(unittest.TestCase):
+
+    def setUp(self):
+        self.databases = []
+        self.managers = []
+        self.release = threading.Event()
+        self.store = self.make_store()
+        self.database = self.store.filename
+        self.manager = self.start_manager(self.store)
+            
+    def tearDown(self):
+        self.release.set()
+        
+        # Managers must stop using the databases before they go
+        for manager in self.managers:
+            manager.stop()
+            manager.join(5)
+        for filename in self.databases:
+            os.remove(filename)
+        
+        
+    def start_manager(self, store):
+        """Start JobManager with one worker, stopped in tearDown
+        """
+        
+        manager = JobManager(self.dispatch, store, workers=1)
+        manager.poll_interval = 0.1
+        manager.start()
+        self.managers.append(manager)
+        return manager
+        
+        
+    def make_store(self):
+        """Create JobStore in new temporary database
+        """
+        
+        fid, filename = tempfile.mkstemp(suffix='.db')
+        os.close(fid)
+        self.databases.append(filename)
+        return JobStore(filename)
+        
+        
+    def dispatch(self, method, params):
+        """Stand-in for the XMLRPC server dispatch method
+        """
+        
+        if method == 'add':
+            return params[0] + params[1]
+        if method == 'block':
+            self.release.wait()
+            return True
+        if method == 'work':
+            while not self.release.isSet():
+                check_deadline()
+                time.sleep(0.01)
+            return True
+        if method == 'progress':
+            for phase in ['download', 'compute']:
+                for i in range(4):
+                    report_progress(phase, i, 4)
+            report_progress('compute', 3, 4)
+            self.release.wait()
+            return True
+        raise Exception('method "%s" is not supported' % method)
+        
+        
+    def test_job_result(self):
+        """Test that submitted job runs in the background and returns result
+        """
+        
+        job_id = self.manager.submit('add', [2, 3])
+        status = wait_for(self.manager, job_id)
+        
+        assert status['status'] == 'finished', status
+        assert status['started'] >= status['submitted']
+        assert self.manager.get_result(job_id) == 5
+        
+        
+    def test_failed_job(self):
+        """Test that exceptions in jobs are reported
+        """
+        
+        job_id = self.manager.submit('unknown', [])
+        status = wait_for(self.manager, job_id)
+        
+        assert status['status'] == 'failed', status
+        assert status['error'].find('not supported') > 0, status['error']
+        self.assertRaises(Exception, self.manager.get_result, job_id)
+        
+
+    def test_cancel_queued_job(self):
+        """Test that queued jobs can be cancelled but running jobs can not
+        """
+        
+        running_id = self.manager.submit('block', [])
+        queued_id = self.manager.submit('add', [1, 1])
+        
+        while self.manager.get_status(running_id)['status'] != 'running':
+            time.sleep(0.05)
+        
+        s = self.manager.cancel(queued_id)
+        assert s.startswith('SUCCESS'), s
+        
+        self.release.set()
+        assert wait_for(self.manager, running_id)['status'] == 'finished'
+        assert wait_for(self.manager, queued_id)['status'] == 'cancelled'
+        
+        # Completed jobs can not be cancelled
+        self.assertRaises(Exception, self.manager.cancel, running_id)
+        self.assertRaises(Exception, self.manager.cancel, queued_id)
+        
+        
+    def test_cancel_running_job(self):
+        """Test that running jobs stop when cancelled through any process
+        """
+        
+        other = JobManager(self.dispatch, JobStore(self.database), workers=0)
+        for manager in [self.manager, other]:
+            job_id = self.manager.submit('work', [])
+            while self.manager.get_status(job_id)['status'] != 'running':
+                time.sleep(0.05)
+                
+            s = manager.cancel(job_id)
+            assert s.startswith('SUCCESS'), s
+            status = wait_for(self.manager, job_id)
+            assert status['status'] == 'cancelled', status
+            assert 'cancelled' in status['error'], status
+        
+        
+    def test_jobs_are_shared_through_store(self):
+        """Test that a job submitted to one manager is visible to all
+        """
+        
+        other = JobManager(self.dispatch, JobStore(self.database), workers=0)
+        job_id = other.submit('add', [4, 5])
+
+        wait_for(self.manager, job_id)
+        assert other.get_result(job_id) == 9
+        
+        
+    def test_interrupted_jobs_are_requeued(self):
+        """Test that running jobs of a dead process are run again on start
+        """
+        
+        job = Job('add', [20, 22])
+        self.store.add(job)
+        
+        # Claim job on behalf of a process that has since died
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.store.claim(10, pid)
+        assert self.store.get(job.id).status == 'running'
+        
+        # Restart
+        manager = self.start_manager(self.store)
+        
+        status = wait_for(manager, job.id)
+        assert status['status'] == 'finished', status
+        assert manager.get_result(job.id) == 42
+        
+        
+    def test_restart_with_same_pid(self):
+        """Test that jobs of a crashed process are requeued by a new process with its pid
+        """
+        
+        store = self.make_store()
+        job = Job('add', [1, 2])
+        store.add(job)
+        
+        # Claimed by an earlier process with this pid, e.g. pid 1 in a 
+        # restarted container
+        owner = '%i-crashed' % os.getpid()
+        store.register_owner(owner)
+        store.claim(10, owner)
+        assert store.requeue_orphans(60) == [job.id]
+        
+        # Jobs of owners started in this process are left alone
+        owner = new_owner()
+        store.register_owner(owner)
+        store.claim(10, owner)
+        assert store.requeue_orphans(60) == []
+        
+        
+    def test_silent_owners_are_dead(self):
+        """Test that jobs of a live process whose owner stopped its heartbeats are requeued
+        """
+        
+        store = self.make_store()
+        job = Job('add', [1, 2])
+        store.add(job)
+        
+        # Claim job in another process that stays alive
+        claimed = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            owner = new_owner()
+            store.register_owner(owner)
+            store.claim(10, owner)
+            os.write(claimed[1], 'x')
+            time.sleep(30)
+            os._exit(0)
+        try:
+            os.read(claimed[0], 1)
+            assert store.requeue_orphans(60) == []
+            assert store.get(job.id).status == 'running'
+            
+            time.sleep(0.3)
+            assert store.requeue_orphans(0.2) == [job.id]
+            assert store.get(job.id).status == 'queued'
+        finally:
+            os.kill(pid, 9)
+            os.waitpid(pid, 0)
+            
+            
+    def test_dispatcher_survives_errors(self):
+        """Test that jobs still run after the store failed the dispatcher
+        """
+        
+        claim = self.store.claim
+        failures = []
+        def fail_once(n, owner):
+            if not failures:
+                failures.append(True)
+                raise sqlite3.OperationalError('database is locked')
+            return claim(n, owner)
+        self.store.claim = fail_once
+        
+        job_id = self.manager.submit('add', [2, 2])
+        status = wait_for(self.manager, job_id)
+        assert status['status'] == 'finished', status
+        assert failures
+        
+        
+    def test_stop_requeues_abandoned_jobs(self):
+        """Test that jobs still running when the drain times out go back in the queue
+        """
+        
+        job_id = self.manager.submit('block', [])
+        waiting_id = self.manager.submit('add', [1, 1])
+        t0 = time.time()
+        while self.manager.get_status(job_id)['status'] != 'running':
+            assert time.time() - t0 < 5, 'Job did not start'
+            time.sleep(0.05)
+            
+        self.manager.stop()
+        abandoned = self.manager.join(0.2)
+        assert abandoned == [job_id], abandoned
+        assert self.manager.get_status(job_id)['status'] == 'queued'
+        assert self.manager.get_status(waiting_id)['status'] == 'queued'
+        
+        
+    def test_priority_and_fair_share(self):
+        """Test that high priority jobs go first and clients take turns
+        """
+        
+        # Submit to a store without workers so that nothing is claimed yet
+        store = self.make_store()
+        manager = JobManager(self.dispatch, store, workers=0)
+        
+        ids = {}
+        for name, priority, client in [('a1', 'low', 'alice'),
+                                       ('a2', 'normal', 'alice'),
+                                       ('a3', 'normal', 'alice'),
+                                       ('a4', 'normal', 'alice'),                                       
+                                       ('b1', 'normal', 'bob'),
+                                       ('b2', 'normal', 'bob'),
+                                       ('q1', 'high', 'quake')]:
+            ids[manager.submit('add', [1, 1], priority=priority, client=client)] = name
+            
+        order = [ids[job.id] for job in store.claim(10, os.getpid())]
+        assert order == ['q1', 'a2', 'b1', 'a3', 'b2', 'a4', 'a1'], order
+        
+        statistics = store.get_queue_statistics()
+        assert statistics['normal']['started'] == 5
+        assert statistics['high']['queued'] == 0
+        
+        self.assertRaises(Exception, manager.submit, 'add', [1, 1], 'urgent')
+        
+        
+    def test_full_job_queue(self):
+        """Test that jobs are turned away when the queue is full
+        """
+        
+        # Store without workers so that the job stays queued
+        manager = JobManager(self.dispatch, self.make_store(), workers=0, 
+                             queue_size=1)
+        manager.submit('add', [1, 2])
+        
+        self.assertRaises(ServerBusy, manager.submit, 'add', [3, 4])
+        assert manager.rejected == 1
+        
+        
+    def test_full_job_queue_is_shared(self):
+        """Test that concurrent submissions do not overfill the queue
+        """
+        
+        store = self.make_store()
+        managers = [JobManager(self.dispatch, JobStore(store.filename), 
+                               workers=0, queue_size=5) for i in range(10)]
+        def submit(manager):
+            for i in range(3):
+                try:
+                    manager.submit('add', [1, 2])
+                except ServerBusy:
+                    pass
+        threads = [threading.Thread(target=submit, args=(manager,)) 
+                   for manager in managers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+            
+        assert store.count('queued') == 5, store.count('queued')
+        assert sum([manager.rejected for manager in managers]) == 25
+        
+        
+    def test_update_by_former_owner(self):
+        """Test that an owner taken for dead can not overwrite the job
+        """
+        
+        store = self.make_store()
+        job = Job('add', [1, 2])
+        store.add(job)
+        
+        # The job is requeued while its first owner is silent, and 
+        # claimed again
+        store.claim(10, 'first')
+        store.requeue([job.id])
+        claimed = store.claim(10, 'second')[0]
+        
+        job.status = 'failed'
+        job.error = 'Late outcome'
+        job.finished = time.time()
+        assert not store.update(job, 'first')
+        assert store.get(job.id).status == 'running'
+        
+        claimed.status = 'finished'
+        claimed.result = 3
+        claimed.finished = time.time()
+        assert store.update(claimed, 'second')
+        assert store.get(job.id).result == 3
+        
+        # Nor can anyone overwrite a cancelled job
+        job = Job('add', [1, 2])
+        store.add(job)
+        store.cancel(job.id)
+        job.status = 'finished'
+        assert not store.update(job, 'second')
+        assert store.get(job.id).status == 'cancelled'
+        
+        
+    def test_job_progress(self):
+        """Test that progress reported by running jobs can be polled
+        """
+        
+        self.manager.progress_interval = 60
+        job_id = self.manager.submit('progress', [])
+        
+        t0 = time.time()
+        while self.manager.get_progress(job_id)['phase'] != 'compute':
+            assert time.time() - t0 < 5, 'Progress was not recorded'
+            time.sleep(0.05)
+            
+        # Within a phase, reports are recorded once per progress_interval
+        progress = self.manager.get_progress(job_id)
+        assert progress['status'] == 'running', progress
+        assert progress['blocks_done'] == 0, progress
+        assert progress['blocks_total'] == 4, progress
+        assert progress['percent'] == 0.0, progress
+        assert 0 <= progress['seconds_since_update'] < 5, progress
+        
+        self.release.set()
+        assert wait_for(self.manager, job_id)['status'] == 'finished'
+        progress = self.manager.get_progress(job_id)
+        assert progress['percent'] == 100.0, progress
+        assert progress['seconds_since_update'] == 0.0, progress
+        
+        
+    def test_unknown_job(self):
+        """Test that unknown job ids raise an exception
+        """
+        
+        self.assertRaises(Exception, self.manager.get_status, 'nonexistent')
+        
+        
+################################################################################
+
+if __name__ == '__main__':
+    suite = unittest.makeSuite(Test_Jobs, 'test')
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
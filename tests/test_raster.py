@@ -10,6 +10,9 @@ sys.path.append(source_path)
 
 # Import everything from the API
 from geoserver_api.raster import read_coverage, write_coverage_to_geotiff, read_coverage_asc, Raster
+from geoserver_api.raster import pack_array, unpack_array
+import zlib
+import StringIO
 
 
 class Test_raster(unittest.TestCase):
@@ -209,6 +212,34 @@ class Test_raster(unittest.TestCase):
         
         
             
+    def test_unpack_array_checks_data(self):
+        """Test that array data from clients is checked before it is used
+        """
+        
+        A = numpy.arange(12.0).reshape(3, 4)
+        assert numpy.allclose(unpack_array(pack_array(A), [3, 4]), A)
+        
+        # Shape must match
+        self.assertRaises(Exception, unpack_array, pack_array(A), [4, 3])
+        
+        # Objects are not unpickled
+        fid = StringIO.StringIO()
+        numpy.save(fid, numpy.array([{}, []], dtype=object))
+        self.assertRaises(Exception, unpack_array, zlib.compress(fid.getvalue()))
+        
+        # Nor are non-numeric arrays accepted
+        self.assertRaises(Exception, unpack_array, pack_array(numpy.array(['abc'])))
+        
+        # Data expanding beyond the limit is refused
+        data = pack_array(numpy.zeros(100000))
+        assert len(data) < 10000
+        self.assertRaises(Exception, unpack_array, data, None, 100000)
+        assert unpack_array(data, None, 1000000).shape == (100000,)
+        
+        # So is trailing data
+        self.assertRaises(Exception, unpack_array, pack_array(A) + 'junk')
+        
+        
     #FIXME: Need test of read and write: data, metadata, M and N!!
                                     
 ################################################################################
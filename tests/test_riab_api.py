@@ -5,6 +5,11 @@ import sys
 import numpy
 import unittest
 import pycurl, StringIO, json
+import xmlrpclib
+import time
+import base64
+import threading
+import BaseHTTPServer, SocketServer
 from config import test_workspace_name, geoserver_url, geoserver_username, geoserver_userpass
        
 from utilities import get_web_page, get_bounding_box
@@ -20,6 +25,36 @@ from riab_api import *
 
 # Low level functions for some of the testing
 from geoserver_api.raster import read_coverage, write_coverage_to_geotiff, read_coverage_asc
+from geoserver_api import utilities as geoserver_utilities
+
+
+class AuthHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer with the name of the user who logged in with basic auth
+    """
+    
+    def do_GET(self):
+        authorization = self.headers.get('Authorization')
+        if authorization is None:
+            self.send_response(401)
+            self.send_header('WWW-Authenticate', 'Basic realm="test"')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+            
+        time.sleep(0.01)  # Let requests overlap
+        username = base64.b64decode(authorization.split()[1]).split(':')[0]
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(username)))
+        self.end_headers()
+        self.wfile.write(username)
+        
+    def log_message(self, format, *args):
+        pass
+
+
+class AuthServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
 
 class Test_API(unittest.TestCase):
 
@@ -122,6 +157,39 @@ class Test_API(unittest.TestCase):
         
         
         
+    def test_get_web_page_credentials(self):
+        """Test that concurrent page fetches each use their own credentials
+        """
+        
+        server = AuthServer(('localhost', 0), AuthHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        url = 'http://localhost:%i/rest' % server.server_port
+        
+        wrong = []
+        def fetch(username):
+            for i in range(20):
+                page = geoserver_utilities.get_web_page(url, username, 'password')
+                if page != [username]:
+                    wrong.append((username, page))
+        
+        try:
+            threads = [threading.Thread(target=fetch, args=(username,))
+                       for username in ['alice', 'bob'] * 2]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert wrong == [], wrong[:5]
+            
+            # Credentials are not left behind for later fetches
+            self.assertRaises(Exception, geoserver_utilities.get_web_page, url)
+        finally:
+            server.shutdown()
+            server.server_close()
+        
+        
     def test_create_workspace(self):            
         """Test that new workspace can be created
         """
@@ -713,6 +781,104 @@ class Test_API(unittest.TestCase):
             
             
                 
+    def test_impact_model_using_arrays(self):
+        """Test that impact model can be computed from arrays sent with the call
+        """
+        
+        # Fatality model parameters
+        a = 0.97429
+        b = 11.037
+        
+        hazard_raster = read_coverage('data/shakemap_padang_20090930.asc')
+        exposure_raster = read_coverage('data/population_padang_1.asc')
+        
+        payloads = []
+        for raster in [hazard_raster, exposure_raster]:
+            payloads.append(make_array_payload(raster.get_data(), 
+                                               raster.get_projection(), 
+                                               raster.get_geotransform()))
+                                               
+        # Payloads must survive XMLRPC marshalling
+        payloads = xmlrpclib.loads(xmlrpclib.dumps(tuple(payloads)))[0]
+        
+        payload = self.api.calculate_arrays(payloads[0], payloads[1], 0, '')
+        F, projection, geotransform = read_array_payload(payload)
+        
+        H = hazard_raster.get_data()
+        E = exposure_raster.get_data()
+        assert F.shape == H.shape
+        assert payload['shape'] == list(H.shape)
+        assert projection == hazard_raster.get_projection()
+        assert numpy.allclose(geotransform, hazard_raster.get_geotransform())
+        assert numpy.allclose(F, 10**(a*H-b)*E, rtol=1.0e-12)
+        
+        
+    def test_impact_model_in_bands(self):
+        """Test that impact calculated in bands and joined equals the whole
+        """
+        
+        hazard_raster = read_coverage('data/shakemap_padang_20090930.asc')
+        exposure_raster = read_coverage('data/population_padang_1.asc')
+        H = hazard_raster.get_data()
+        E = exposure_raster.get_data()
+        projection = hazard_raster.get_projection()
+        geotransform = hazard_raster.get_geotransform()
+        F = calculate_impact([H], [E], 0)
+        
+        def make_band(top_row, bottom_row):
+            # Impact of rows top_row to bottom_row as a worker returns it
+            band_geotransform = list(geotransform)
+            band_geotransform[3] = geotransform[3] + geotransform[5] * top_row
+            payload = make_array_payload(calculate_impact([H[top_row:bottom_row]], 
+                                                          [E[top_row:bottom_row]], 0),
+                                         projection, band_geotransform)
+            return xmlrpclib.loads(xmlrpclib.dumps((payload,)))[0][0]
+        
+        # Two bands
+        rows = H.shape[0]
+        G, band_projection, band_geotransform = join_array_payloads([make_band(0, rows / 2), 
+                                                                     make_band(rows / 2, rows)])
+        assert G.shape == F.shape
+        assert band_projection == projection
+        assert numpy.allclose(band_geotransform, geotransform)
+        assert numpy.allclose(G, F, rtol=1.0e-12)
+        
+        # Bands that do not join up
+        self.assertRaises(Exception, join_array_payloads, [make_band(0, rows / 2),
+                                                           make_band(rows / 2 + 1, rows)])
+        
+        # Bands made by calculate_tiled from the extent of the layers
+        minx = geotransform[0]
+        maxx = geotransform[0] + geotransform[1] * H.shape[1]
+        maxy = geotransform[3]
+        miny = geotransform[3] + geotransform[5] * rows
+        
+        class API:
+            def resolve_layer_handles(self, handles):
+                return [{'exists': True, 
+                         'extent_wgs84': [minx, miny, maxx, maxy],
+                         'native_resolution': [H.shape[1], rows]} for handle in handles]
+                
+            def _upload_impact(self, F, projection, geotransform, impact):
+                self.uploaded = F, projection, geotransform
+        
+        def map_tiles(params_list):
+            payloads = []
+            for hazards, exposures, impact_function_id, band in params_list:
+                top_row = int(round((maxy - band[3]) / -geotransform[5]))
+                bottom_row = int(round((maxy - band[1]) / -geotransform[5]))
+                payloads.append(make_band(top_row, bottom_row))
+            return payloads
+        
+        api = API()
+        res = calculate_tiled(api, map_tiles, 'hazard', 'exposure', 0, 'impact', [], '', 2)
+        assert res.startswith('SUCCES'), res
+        G, band_projection, band_geotransform = api.uploaded
+        assert band_projection == projection
+        assert numpy.allclose(band_geotransform, geotransform)
+        assert numpy.allclose(G, F, rtol=1.0e-12)
+        
+        
     def test_impact_model_remote_data(self):
         """Test that impact model can be computed correctly using data from geoserver
         """
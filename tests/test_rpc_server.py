@@ -0,0 +1,885 @@
+#!/usr/bin/env python
+
+import sys, os
+import time
+import threading
+import unittest
+import xmlrpclib
+import multiprocessing
+import urllib2
+import httplib
+import json
+import gzip
+import StringIO
+import tempfile
+import shutil
+import socket
+
+# Add location of source code to search path so that API can be imported
+parent_dir = os.path.split(os.getcwd())[0]
+source_path = os.path.join(parent_dir, 'source') 
+sys.path.append(source_path)
+
+from rpc_server import RPCServer, APITest, PoolTask
+from health import HealthChecker
+from cache import ResultCache
+from context import RequestContext, get_request_id, set_context
+from scratch import ScratchDirectory, remove_stale, get_owner
+from common import SERVER_BUSY, DEADLINE_EXCEEDED
+import common
+
+# Port for the in-process test servers (the riab server uses 8000)
+test_port = 8001
+
+
+class Test_RPC_Server(unittest.TestCase):
+    
+    # Serve from an event loop rather than a thread per connection
+    event_loop = False
+
+    def setUp(self):
+        """Start in-process RPC server with the test API
+        """
+        
+        # Scratch directory left behind by an earlier server
+        self.scratch_root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.scratch_root, 'riab-stale'))
+        
+        self.rpc_server = RPCServer('localhost', test_port, APITest, threads=2,
+                                    queue_size=1, cache_ttls={'version': 60},
+                                    cache_invalidations={'test': ['version']},
+                                    scratch_root=self.scratch_root, 
+                                    scratch_quota=1000, 
+                                    event_loop=self.event_loop)
+        self.thread = threading.Thread(target=self.rpc_server.start)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        
+        self.url = 'http://localhost:%i' % test_port
+        self.api = xmlrpclib.ServerProxy(self.url)
+            
+    def tearDown(self):
+        """Stop test server and release the port
+        """
+        
+        if self.thread.isAlive():
+            self.api.stop()
+        self.thread.join()
+        self.rpc_server.server.server_close()
+        shutil.rmtree(self.scratch_root)
+        
+        
+    def test_version(self):
+        """Test that the test API is served
+        """
+        
+        s = self.api.version()
+        assert s == APITest.API_VERSION, 'Version incorrect %s' % s
+
+        
+    def test_concurrent_requests(self):
+        """Test that a slow request does not block other requests
+        """
+        
+        # Start a slow call in the background
+        slow_api = xmlrpclib.ServerProxy(self.url)
+        slow = threading.Thread(target=lambda: slow_api.sleep(2))
+        slow.start()
+        time.sleep(0.2)
+        
+        t0 = time.time()
+        self.api.version()
+        duration = time.time() - t0
+        slow.join()
+        
+        msg = 'Call to version was blocked by slow call for %f seconds' % duration
+        assert duration < 1, msg
+        
+
+    def test_multicall_runs_concurrently(self):
+        """Test that calls in a multicall batch run concurrently and in order
+        """
+        
+        multicall = xmlrpclib.MultiCall(self.api)
+        multicall.sleep(1)
+        multicall.sleep(1)
+        multicall.version()
+        multicall.unknown_method()
+        
+        t0 = time.time()
+        results = multicall()
+        duration = time.time() - t0
+        
+        assert results[0] == True
+        assert results[1] == True
+        assert results[2] == APITest.API_VERSION
+        self.assertRaises(xmlrpclib.Fault, lambda: results[3])
+        
+        msg = 'Multicall was not run concurrently. Duration was %f seconds' % duration
+        assert duration < 1.8, msg
+        
+        
+    def test_multicall_load(self):
+        """Test that workers running calls of a batch count as active
+        """
+        
+        multicall = xmlrpclib.MultiCall(self.api)
+        multicall.sleep(1)
+        multicall.sleep(1)
+        t = threading.Thread(target=lambda: multicall())
+        t.start()
+        time.sleep(0.3)
+        
+        load = self.rpc_server.server.get_load()
+        t.join()
+        assert load['active_requests'] == 2, load
+        assert load['queued_requests'] == 0, load
+        
+        
+    def test_json_rpc(self):
+        """Test that the same methods are served with JSON-RPC on /JSON
+        """
+        
+        def post(request):
+            f = urllib2.urlopen(self.url + '/JSON', json.dumps(request))
+            assert f.info()['Content-type'] == 'application/json'
+            return json.loads(f.read())
+            
+        response = post({'jsonrpc': '2.0', 'method': 'version', 'params': [], 'id': 7})
+        assert response['result'] == APITest.API_VERSION, response
+        assert response['id'] == 7
+        
+        response = post({'jsonrpc': '2.0', 'method': 'unknown_method', 'id': 8})
+        assert response['error']['code'] == 1, response
+        
+        # Batch
+        response = post([{'jsonrpc': '2.0', 'method': 'sleep', 'params': [0], 'id': 1},
+                         {'jsonrpc': '2.0', 'method': 'version', 'id': 2}])
+        assert [r['id'] for r in response] == [1, 2], response
+        assert response[1]['result'] == APITest.API_VERSION
+        
+        # Notifications get no response
+        f = urllib2.urlopen(self.url + '/JSON', 
+                            json.dumps({'jsonrpc': '2.0', 'method': 'version'}))
+        assert f.read() == ''
+        f = urllib2.urlopen(self.url + '/JSON', 
+                            json.dumps([{'jsonrpc': '2.0', 'method': 'version'},
+                                        {'jsonrpc': '2.0', 'method': 'unknown_method'}]))
+        assert f.read() == ''
+        response = post([{'jsonrpc': '2.0', 'method': 'version'},
+                         {'jsonrpc': '2.0', 'method': 'version', 'id': 3},
+                         {'jsonrpc': '2.0', 'method': 'unknown_method'}])
+        assert [r['id'] for r in response] == [3], response
+        
+        
+    def test_ping_and_readiness(self):
+        """Test the cheap health probes
+        """
+        
+        assert self.api.ping() == 'pong'
+        
+        readiness = self.api.readiness()
+        assert readiness['ready'], readiness
+        assert not readiness['stopping']
+        assert readiness['geoservers'] == {}
+        
+        
+    def test_geoserver_health_checks(self):
+        """Test that servers that answer count as reachable and others do not
+        """
+        
+        # The test server answers /rest with 404, which counts as reachable
+        answering = 'http://localhost:%i' % test_port
+        silent = 'http://localhost:1/geoserver'
+        checker = HealthChecker([answering, silent], timeout=1)
+        status = checker.get_status()
+        assert not status[answering]['reachable']
+        
+        checker.check()
+        status = checker.get_status()
+        assert status[answering]['reachable'], status
+        assert not status[silent]['reachable'], status
+        assert status[silent]['error'] != ''
+        assert status[silent]['checked'] > 0
+        
+        
+    def test_server_stats(self):
+        """Test that calls, errors, latencies and sizes are recorded per method
+        """
+        
+        for i in range(3):
+            self.api.version()
+        self.api.sleep(0.2)
+        try:
+            self.api.sleep('not a number')
+        except xmlrpclib.Fault:
+            pass
+            
+        stats = self.api.get_server_stats()
+        assert stats['uptime'] > 0
+        
+        version = stats['methods']['version']
+        assert version['calls'] == 3, version
+        assert version['errors'] == 0
+        assert version['max_request_bytes'] > 0
+        assert version['max_response_bytes'] > 0
+        
+        sleep = stats['methods']['sleep']
+        assert sleep['calls'] == 2, sleep
+        assert sleep['errors'] == 1
+        assert 0.2 <= sleep['latency_p99'] < 1, sleep
+        assert sleep['latency_p50'] <= sleep['latency_p95'] <= sleep['latency_p99']
+        
+        
+    def test_result_cache(self):
+        """Test that results are reused until they expire or are invalidated
+        """
+        
+        for i in range(3):
+            assert self.api.version() == APITest.API_VERSION
+        cache = self.api.get_server_stats()['cache']
+        assert cache.keys() == ['version'], cache
+        assert cache['version']['misses'] == 1, cache
+        assert cache['version']['hits'] == 2, cache
+        
+        # Calling test drops the result
+        self.api.test()
+        self.api.version()
+        cache = self.api.get_server_stats()['cache']
+        assert cache['version']['misses'] == 2, cache
+        
+        # Results expire and are kept per arguments
+        cache = ResultCache({'f': 0.1})
+        hit, result, epoch = cache.get('f', (1,))
+        assert not hit
+        cache.put('f', (1,), 'one', epoch)
+        assert cache.get('f', (1,))[:2] == (True, 'one')
+        assert not cache.get('f', (2,))[0]
+        time.sleep(0.1)
+        assert not cache.get('f', (1,))[0]
+        
+        # A result worked out while results were dropped is not kept
+        hit, result, epoch = cache.get('f', (1,))
+        cache.clear()
+        cache.put('f', (1,), 'stale', epoch)
+        assert not cache.get('f', (1,))[0]
+        
+        
+    def test_profiling(self):
+        """Test profiling of selected calls and sampling of all calls
+        """
+        
+        s = self.api.enable_profiling('sleep', 2)
+        assert s.startswith('SUCCESS'), s
+        for i in range(3):
+            self.api.sleep(0.1)
+            
+        profile = self.api.get_profile('sleep')
+        assert profile['calls_profiled'] == 2, profile
+        assert profile['calls_pending'] == 0, profile
+        assert 'rpc_server.py' in profile['summary'], profile['summary']
+        
+        self.api.start_sampling(0.01)
+        self.api.sleep(0.3)
+        self.api.stop_sampling()
+        
+        samples = self.api.get_samples()
+        assert not samples['sampling']
+        assert samples['methods']['sleep']['samples'] > 5, samples
+        functions = [f[0] for f in samples['methods']['sleep']['functions']]
+        assert functions[0].endswith('(sleep)'), functions
+        
+        
+    def test_keepalive_and_gzip(self):
+        """Test that connections are reused and large responses are compressed
+        """
+        
+        connection = httplib.HTTPConnection('localhost', test_port)
+        
+        # Large enough response to be compressed
+        calls = [{'methodName': 'version', 'params': []}]*100
+        body = xmlrpclib.dumps((calls,), 'system.multicall')
+        connection.request('POST', '/RPC2', body, {'Content-Type': 'text/xml',
+                                                   'Accept-Encoding': 'gzip'})
+        response = connection.getresponse()
+        assert response.getheader('Content-Encoding') == 'gzip'
+        data = gzip.GzipFile(fileobj=StringIO.StringIO(response.read())).read()
+        results = xmlrpclib.loads(data)[0][0]
+        assert results == [[APITest.API_VERSION]]*100
+        sock = connection.sock
+        assert sock is not None, 'Connection was closed'
+        
+        # Small response on the same connection is sent as is
+        connection.request('POST', '/RPC2', xmlrpclib.dumps((), 'version'), 
+                           {'Content-Type': 'text/xml', 'Accept-Encoding': 'gzip'})
+        response = connection.getresponse()
+        assert response.getheader('Content-Encoding') is None
+        assert xmlrpclib.loads(response.read())[0][0] == APITest.API_VERSION
+        assert connection.sock is sock, 'Connection was not reused'
+        connection.close()
+        
+        
+    def test_idle_connections_hold_no_workers(self):
+        """Test that idle keep-alive connections leave the workers to others
+        """
+        
+        # One idle connection for each of the two workers
+        connections = []
+        for i in range(2):
+            connection = httplib.HTTPConnection('localhost', test_port)
+            connection.request('POST', '/RPC2', xmlrpclib.dumps((), 'version'), 
+                               {'Content-Type': 'text/xml'})
+            connection.getresponse().read()
+            connections.append(connection)
+            
+        t0 = time.time()
+        assert self.api.version() == APITest.API_VERSION
+        assert time.time() - t0 < 1, 'Request waited for idle connections'
+        
+        # The idle connections still serve requests
+        for connection in connections:
+            sock = connection.sock
+            connection.request('POST', '/RPC2', xmlrpclib.dumps((), 'version'), 
+                               {'Content-Type': 'text/xml'})
+            response = connection.getresponse()
+            assert xmlrpclib.loads(response.read())[0][0] == APITest.API_VERSION
+            assert connection.sock is sock, 'Connection was not reused'
+            connection.close()
+            
+            
+    def test_request_ids_in_log(self):
+        """Test that log lines of a request carry its correlation id
+        """
+        
+        connection = httplib.HTTPConnection('localhost', test_port)
+        connection.request('POST', '/RPC2', xmlrpclib.dumps((), 'version'), 
+                           {'Content-Type': 'text/xml', 'X-Request-Id': 'test-4711'})
+        response = connection.getresponse()
+        response.read()
+        assert response.getheader('X-Request-Id') == 'test-4711'
+        
+        # Made up if the client does not send one
+        connection.request('POST', '/RPC2', xmlrpclib.dumps((), 'version'), 
+                           {'Content-Type': 'text/xml'})
+        response = connection.getresponse()
+        response.read()
+        request_id = response.getheader('X-Request-Id')
+        assert len(request_id) == 12, request_id
+        connection.close()
+        
+        common.log_handler.flush()
+        lines = open(common.log_filename).readlines()
+        for id in ['test-4711', request_id]:
+            found = [line for line in lines if '[%s]' % id in line]
+            assert found, 'No log line for request %s' % id
+            assert 'POST /RPC2' in found[-1], found
+            
+        # Work handed to other threads keeps the id
+        set_context(RequestContext('test-4712'))
+        task = PoolTask(get_request_id)
+        set_context(None)
+        t = threading.Thread(target=task.run)
+        t.start()
+        t.join()
+        assert task.result == 'test-4712', task.result
+        
+        
+    def test_request_deadline(self):
+        """Test that work stops when the time allowed by the client has passed
+        """
+        
+        connection = httplib.HTTPConnection('localhost', test_port)
+        t0 = time.time()
+        connection.request('POST', '/RPC2', xmlrpclib.dumps((5,), 'work'), 
+                           {'Content-Type': 'text/xml', 'X-Request-Timeout': '0.2'})
+        response = connection.getresponse()
+        try:
+            xmlrpclib.loads(response.read())
+        except xmlrpclib.Fault, e:
+            assert e.faultCode == DEADLINE_EXCEEDED, e
+        else:
+            raise Exception('Expected DEADLINE_EXCEEDED fault')
+        assert time.time() - t0 < 1, 'Work did not stop at the deadline'
+        
+        # Work finishing in time is not affected
+        connection.request('POST', '/RPC2', xmlrpclib.dumps((0.1,), 'work'), 
+                           {'Content-Type': 'text/xml', 'X-Request-Timeout': '5'})
+        assert xmlrpclib.loads(connection.getresponse().read())[0][0] == True
+        connection.close()
+        
+        
+    def test_scratch_directories(self):
+        """Test that each request writes its files in a directory of its own
+        """
+        
+        paths = [self.api.write_file('result.tif', 10) for i in range(2)]
+        assert paths[0] != paths[1], paths
+        for path in paths:
+            assert os.path.dirname(os.path.dirname(path)) == self.scratch_root, path
+            assert os.path.basename(path) == 'result.tif'
+            
+            # Removed when the request is done
+            assert not os.path.exists(os.path.dirname(path)), path
+            
+        # Directories of killed servers were removed when the server started
+        assert os.listdir(self.scratch_root) == [], os.listdir(self.scratch_root)
+        
+        # Requests may only take up so much space
+        try:
+            self.api.write_file('result.tif', 2000)
+        except xmlrpclib.Fault, e:
+            assert 'QuotaExceeded' in e.faultString, e
+        else:
+            raise Exception('Expected quota to be exceeded')
+        assert os.listdir(self.scratch_root) == []
+        
+        
+    def test_scratch_of_live_servers(self):
+        """Test that only scratch directories of dead processes are removed
+        """
+        
+        # Another server process, one that died and an earlier process 
+        # with the pid of this one
+        pid = os.fork()
+        if pid == 0:
+            time.sleep(30)
+            os._exit(0)
+        dead = os.fork()
+        if dead == 0:
+            os._exit(0)
+        os.waitpid(dead, 0)
+        try:
+            live = ['riab-%i.0123abcd-request' % pid, 'riab-%s-request' % get_owner()]
+            stale = ['riab-%i.0123abcd-request' % dead, 
+                     'riab-%i.0123abcd-request' % os.getpid()]
+            for name in live + stale:
+                os.mkdir(os.path.join(self.scratch_root, name))
+            
+            remove_stale(self.scratch_root)
+            assert sorted(os.listdir(self.scratch_root)) == sorted(live)
+        finally:
+            os.kill(pid, 9)
+            os.waitpid(pid, 0)
+            
+        # Threads sharing a directory make it once
+        scratch = ScratchDirectory(self.scratch_root, name='shared')
+        paths = []
+        threads = [threading.Thread(target=lambda: paths.append(scratch.get_path())) 
+                   for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(set(paths)) == 1, paths
+        scratch.remove()
+        assert sorted(os.listdir(self.scratch_root)) == sorted(live)
+        
+        
+    def test_stop_finishes_running_requests(self):
+        """Test that stop takes effect at once while running requests complete
+        """
+        
+        results = []
+        api = xmlrpclib.ServerProxy(self.url)
+        t = threading.Thread(target=lambda: results.append(api.sleep(1)))
+        t.start()
+        time.sleep(0.2)
+        
+        # An idle keep-alive connection must not hold up the shutdown
+        idle = xmlrpclib.ServerProxy(self.url)
+        idle.version()
+        
+        t0 = time.time()
+        s = self.api.stop()
+        assert s.startswith('SUCCESS'), s
+        self.thread.join(5)
+        duration = time.time() - t0
+        
+        assert not self.thread.isAlive(), 'Server did not stop'
+        assert duration < 1.5, 'Stopping took %f seconds' % duration
+        t.join()
+        assert results == [True], 'Running request got %s' % results
+        
+        
+    def test_saturated_server_turns_requests_away(self):
+        """Test that requests beyond the queue size get SERVER_BUSY faults
+        """
+        
+        # Occupy both workers and the one queue slot
+        threads = []
+        for i in range(3):
+            api = xmlrpclib.ServerProxy(self.url)
+            t = threading.Thread(target=lambda api=api: api.sleep(1))
+            t.start()
+            threads.append(t)
+            time.sleep(0.1)  # Let a worker pick it up
+        time.sleep(0.2)
+        
+        t0 = time.time()
+        try:
+            self.api.version()
+        except xmlrpclib.Fault, e:
+            assert e.faultCode == SERVER_BUSY, e
+        else:
+            raise Exception('Expected SERVER_BUSY fault')
+        assert time.time() - t0 < 0.5, 'Request was not turned away immediately'
+            
+        # Load is still reported
+        load = self.api.get_load()
+        assert load['active_requests'] == 2, load
+        assert load['queued_requests'] == 1, load
+        assert load['rejected_requests'] == 1, load
+        
+        for t in threads:
+            t.join()
+            
+            
+    def test_rejected_keepalive_client(self):
+        """Test that requests turned away on keep-alive connections announce the close
+        """
+        
+        threads = []
+        for i in range(3):
+            api = xmlrpclib.ServerProxy(self.url)
+            t = threading.Thread(target=lambda api=api: api.sleep(1))
+            t.start()
+            threads.append(t)
+            time.sleep(0.1)
+        time.sleep(0.2)
+        
+        connection = httplib.HTTPConnection('localhost', test_port)
+        connection.request('POST', '/RPC2', xmlrpclib.dumps((), 'get_load'), 
+                           {'Content-Type': 'text/xml'})
+        response = connection.getresponse()
+        assert 'active_requests' in xmlrpclib.loads(response.read())[0][0]
+        
+        # Unless the server said it would close, the connection is reused
+        if response.getheader('Connection') != 'close':
+            connection.request('POST', '/RPC2', xmlrpclib.dumps((), 'get_load'), 
+                               {'Content-Type': 'text/xml'})
+            response = connection.getresponse()
+            assert 'active_requests' in xmlrpclib.loads(response.read())[0][0]
+        connection.close()
+        
+        for t in threads:
+            t.join()
+            
+            
+    def test_slow_rejected_client(self):
+        """Test that a client sending slowly does not hold up turning others away
+        """
+        
+        threads = []
+        for i in range(3):
+            api = xmlrpclib.ServerProxy(self.url)
+            t = threading.Thread(target=lambda api=api: api.sleep(1.5))
+            t.start()
+            threads.append(t)
+            time.sleep(0.1)
+        time.sleep(0.2)
+        
+        # Turned away, but never sends the rest of its request
+        slow = socket.create_connection(('localhost', test_port))
+        slow.sendall('POST /RPC2 HTTP/1.1\r\nContent-Length: 1000\r\n\r\n<?xml')
+        time.sleep(0.1)
+        
+        for i in range(3):
+            t0 = time.time()
+            try:
+                xmlrpclib.ServerProxy(self.url).version()
+            except xmlrpclib.Fault, e:
+                assert e.faultCode == SERVER_BUSY, e
+            else:
+                raise Exception('Expected SERVER_BUSY fault')
+            assert time.time() - t0 < 0.5, 'Request was not turned away immediately'
+            
+        # The slow client is cut off after reject_timeout. The event loop
+        # waits for it at no cost.
+        if not self.event_loop:
+            slow.settimeout(5)
+            t0 = time.time()
+            while slow.recv(4096):
+                pass
+            assert time.time() - t0 < 2, 'Slow client was not cut off'
+        slow.close()
+        
+        for t in threads:
+            t.join()
+        load = self.api.get_load()
+        assert load['rejected_requests'] >= 3, load
+        
+
+class Test_Event_Loop_RPC_Server(Test_RPC_Server):
+    """Run the tests above against the event loop front end
+    """
+    
+    event_loop = True
+    
+    
+    def test_many_idle_connections(self):
+        """Test that idle connections cost no worker threads
+        """
+        
+        # Far more open connections than worker threads
+        connections = []
+        for i in range(200):
+            connection = httplib.HTTPConnection('localhost', test_port)
+            connection.connect()
+            connections.append(connection)
+            
+        # Half way through sending a request
+        body = xmlrpclib.dumps((), 'version')
+        connections[0].putrequest('POST', '/RPC2')
+        connections[0].putheader('Content-Length', str(len(body)))
+        connections[0].endheaders()
+        
+        t0 = time.time()
+        for connection in connections[-10:]:
+            connection.request('POST', '/RPC2', body, {'Content-Type': 'text/xml'})
+            response = connection.getresponse()
+            assert xmlrpclib.loads(response.read())[0][0] == APITest.API_VERSION
+        assert time.time() - t0 < 1, 'Requests were held up by idle connections'
+        
+        # The slow client finishes its request
+        connections[0].send(body)
+        response = connections[0].getresponse()
+        assert xmlrpclib.loads(response.read())[0][0] == APITest.API_VERSION
+        
+        load = self.api.get_load()
+        assert load['threads'] == 2, load
+        for connection in connections:
+            connection.close()
+            
+            
+    def test_bad_requests(self):
+        """Test that malformed requests get HTTP errors
+        """
+        
+        connection = httplib.HTTPConnection('localhost', test_port)
+        connection.request('GET', '/RPC2')
+        assert connection.getresponse().status == 501
+        connection.close()
+        
+        connection = httplib.HTTPConnection('localhost', test_port)
+        connection.request('POST', '/elsewhere', xmlrpclib.dumps((), 'version'))
+        response = connection.getresponse()
+        assert response.status == 404
+        assert response.getheader('Connection') == 'close'
+        connection.close()
+        
+        
+# Source of a small API module that reports its own version
+reload_api_source = """
+import time
+VERSION = %r
+
+class ReloadAPI:
+    def version(self):
+        return VERSION
+        
+    def slow_version(self, seconds):
+        time.sleep(seconds)
+        return VERSION
+"""
+
+
+class Test_Reload(unittest.TestCase):
+
+    def setUp(self):
+        """Start in-process RPC server with an API module in a temporary directory
+        """
+        
+        self.module_dir = tempfile.mkdtemp()
+        self.write_module('1')
+        sys.path.insert(0, self.module_dir)
+        import reload_api
+        
+        self.rpc_server = RPCServer('localhost', test_port, reload_api.ReloadAPI,
+                                    reload_api, threads=2)
+        self.thread = threading.Thread(target=self.rpc_server.start)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        
+        self.api = xmlrpclib.ServerProxy('http://localhost:%i' % test_port)
+        
+    def tearDown(self):
+        """Stop test server and remove the API module
+        """
+        
+        self.api.stop()
+        self.thread.join()
+        self.rpc_server.server.server_close()
+        sys.path.remove(self.module_dir)
+        del sys.modules['reload_api']
+        shutil.rmtree(self.module_dir)
+        
+    def write_module(self, version):
+        """Write API module with given version and drop stale byte code
+        """
+        
+        filename = os.path.join(self.module_dir, 'reload_api.py')
+        fid = open(filename, 'w')
+        fid.write(reload_api_source % version)
+        fid.close()
+        if os.path.exists(filename + 'c'):
+            os.remove(filename + 'c')
+        
+        
+    def test_reload_drains_old_generation(self):
+        """Test that new requests reach the reloaded API while running ones finish on the old one
+        """
+        
+        results = []
+        api = xmlrpclib.ServerProxy('http://localhost:%i' % test_port)
+        t = threading.Thread(target=lambda: results.append(api.slow_version(1)))
+        t.start()
+        time.sleep(0.2)
+        
+        self.write_module('2')
+        s = self.api.reload()
+        assert s.startswith('SUCCESS'), s
+        assert 'generation 2' in s, s
+        
+        assert self.api.version() == '2'
+        load = self.api.get_load()
+        assert load['api_generation'] == 2, load
+        assert load['draining_generations'] == 1, load
+        
+        t.join()
+        assert results == ['1'], 'In-flight request got %s' % results
+        assert self.api.get_load()['draining_generations'] == 0
+        
+        
+    def test_servers_share_no_state(self):
+        """Test that servers in one process keep their own generations and deferred work
+        """
+        
+        other = RPCServer('localhost', test_port + 1, APITest, threads=1)
+        try:
+            self.write_module('2')
+            s = self.api.reload()
+            assert s.startswith('SUCCESS'), s
+            
+            assert other.server.generation.number == 1
+            assert [g.number for g in other.server.generations] == [1]
+            assert other.server.generation_lock is not self.rpc_server.server.generation_lock
+            
+            other.server.deferred.append(lambda: None)
+            assert self.rpc_server.server.deferred == []
+        finally:
+            other.server.server_close()
+        
+        
+    def test_failed_reload_keeps_serving(self):
+        """Test that a reload with a broken API module leaves the old one in place
+        """
+        
+        fid = open(os.path.join(self.module_dir, 'reload_api.py'), 'w')
+        fid.write('this is not python\n')
+        fid.close()
+        
+        try:
+            self.api.reload()
+        except xmlrpclib.Fault:
+            pass
+        else:
+            raise Exception('Reload of broken module should fail')
+            
+        assert self.api.version() == '1'
+        assert self.api.get_load()['api_generation'] == 1
+        
+        
+class Test_Prefork_RPC_Server(unittest.TestCase):
+
+    def setUp(self):
+        """Start pre-forked RPC server with the test API in separate process
+        """
+        
+        self.rpc_server = RPCServer('localhost', test_port, APITest, 
+                                    threads=0, processes=2)
+        self.master = multiprocessing.Process(target=self.rpc_server.start)
+        self.master.start()
+        self.rpc_server.server.server_close() # Only the master needs it
+        
+        self.url = 'http://localhost:%i' % test_port
+        self.api = xmlrpclib.ServerProxy(self.url)
+            
+    def tearDown(self):
+        """Stop test server unless a test already did
+        """
+        
+        if self.master.is_alive():
+            self.api.stop()
+            self.master.join()
+        
+        
+    def test_workers_serve_concurrently(self):
+        """Test that two single threaded workers serve two slow calls at once
+        """
+        
+        t0 = time.time()
+        threads = []
+        for i in range(2):
+            api = xmlrpclib.ServerProxy(self.url)
+            t = threading.Thread(target=lambda api=api: api.sleep(1))
+            t.start()
+            threads.append(t)
+            
+        for t in threads:
+            t.join()
+        duration = time.time() - t0
+        
+        msg = 'Calls were not served concurrently. Duration was %f seconds' % duration
+        assert duration < 1.8, msg
+        
+        
+    def test_workers_close_connections(self):
+        """Test that workers without threads announce that they close connections
+        """
+        
+        connection = httplib.HTTPConnection('localhost', test_port)
+        connection.request('POST', '/RPC2', xmlrpclib.dumps((), 'version'), 
+                           {'Content-Type': 'text/xml'})
+        response = connection.getresponse()
+        assert response.getheader('Connection') == 'close'
+        assert xmlrpclib.loads(response.read())[0][0] == APITest.API_VERSION
+        connection.close()
+        
+        
+    def test_stop_reaches_all_workers(self):
+        """Test that stop sent to one worker stops master and all workers
+        """
+        
+        s = self.api.stop()
+        assert s.startswith('SUCCESS'), s
+        
+        self.master.join(5)
+        assert not self.master.is_alive(), 'Master process did not stop'
+        
+        
+    def test_reload_reaches_all_workers_once(self):
+        """Test that reload sent to one worker reloads every worker exactly once
+        """
+        
+        s = self.api.reload()
+        assert s.startswith('SUCCESS'), s
+        time.sleep(0.5)
+        
+        # Without worker threads each call is served on a new connection 
+        # by whichever worker accepts it
+        generations = set()
+        for i in range(20):
+            load = xmlrpclib.ServerProxy(self.url).get_load()
+            generations.add(load['api_generation'])
+        assert generations == set([2]), generations
+        
+        
+################################################################################
+
+if __name__ == '__main__':
+    suite = unittest.makeSuite(Test_RPC_Server, 'test')
+    suite.addTest(unittest.makeSuite(Test_Event_Loop_RPC_Server, 'test'))
+    suite.addTest(unittest.makeSuite(Test_Reload, 'test'))
+    suite.addTest(unittest.makeSuite(Test_Prefork_RPC_Server, 'test'))
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
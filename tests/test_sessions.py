@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+import sys, os
+import stat
+import binascii
+import time
+import tempfile
+import shutil
+import unittest
+
+# Add location of source code to search path so that API can be imported
+parent_dir = os.path.split(os.getcwd())[0]
+source_path = os.path.join(parent_dir, 'source')
+sys.path.append(source_path)
+
+from sessions import SessionStore, ConnectionPool, seal, unseal
+from riab_api import RiabAPI, SESSION_USERNAME, seal_layer_handle, unseal_layer_handle
+
+
+class Test_Sessions(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = SessionStore(os.path.join(self.tmpdir, 'sessions.db'))
+        
+        self.verified = []
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    
+    def connect(self, geoserver_url, username, userpass):
+        """Stand-in for geoserver.Geoserver that records verifications
+        """
+        
+        if userpass != 'geoserver':
+            raise Exception('Could not connect to geoserver at %s' % geoserver_url)
+        self.verified.append((geoserver_url, username))
+        return (geoserver_url, username)
+    
+    
+    def test_session_store(self):
+        """Test that sessions can be used, shared and ended
+        """
+        
+        token = self.store.create('admin', 'geoserver', 'http://localhost:8080/geoserver')
+        assert len(token) == 32
+        assert self.store.get(token) == ('admin', 'geoserver', 'http://localhost:8080/geoserver')
+        
+        # Processes forked by the server share the sessions
+        pid = os.fork()
+        if pid == 0:
+            ok = False
+            try:
+                ok = self.store.get(token)[1] == 'geoserver'
+            finally:
+                os._exit(not ok)
+        assert os.waitpid(pid, 0)[1] == 0, 'Session not found in forked process'
+        
+        # Only the owner can read the database
+        mode = os.stat(self.store.filename).st_mode
+        assert not mode & (stat.S_IRGRP | stat.S_IROTH), oct(mode)
+        
+        self.store.delete(token)
+        self.assertRaises(Exception, self.store.get, token)
+        self.assertRaises(Exception, self.store.get, 'nonexistent')
+    
+    
+    def test_passwords_not_stored(self):
+        """Test that passwords are not written to the database as they are
+        """
+        
+        token = self.store.create('admin', 'secret-password', 'http://localhost:8080/geoserver')
+        data = open(self.store.filename, 'rb').read()
+        assert 'secret-password' not in data
+        assert binascii.hexlify('secret-password') not in data
+        
+        # A server started later does not know the key
+        restarted = SessionStore(self.store.filename)
+        self.assertRaises(Exception, restarted.get, token)
+        assert self.store.get(token)[1] == 'secret-password'
+    
+    
+    def test_sessions_expire(self):
+        """Test that sessions expire unless they are used
+        """
+        
+        store = SessionStore(self.store.filename, lifetime=0.2)
+        token = store.create('admin', 'geoserver', 'http://localhost:8080/geoserver')
+        for i in range(3):
+            time.sleep(0.15)
+            store.get(token)
+        time.sleep(0.25)
+        self.assertRaises(Exception, store.get, token)
+    
+    
+    def test_seal(self):
+        """Test that sealed text can only be read with the same key and nonce
+        """
+        
+        sealed = seal('key', 'nonce', u'geoserver \xe9')
+        assert 'geoserver' not in sealed
+        assert unseal('key', 'nonce', sealed) == u'geoserver \xe9'
+        assert unseal('other key', 'nonce', sealed) is None
+        assert unseal('key', 'other nonce', sealed) is None
+        assert unseal('key', 'nonce', sealed[:-2]) is None
+        assert unseal('key', 'nonce', 'not hex') is None
+        
+        # Same text, different nonce
+        assert seal('key', 'nonce', 'geoserver') != seal('key', 'nonce2', 'geoserver')
+        
+        
+    def test_sealed_layer_handles(self):
+        """Test that handles sent to workers carry no credentials as they are
+        """
+        
+        handle = 'admin:geoserver@http://localhost:8080/geoserver/[hazard]/shakemap'
+        sealed = seal_layer_handle(handle, 'secret')
+        assert 'geoserver@' not in sealed, sealed
+        assert sealed.endswith('@http://localhost:8080/geoserver/[hazard]/shakemap'), sealed
+        assert sealed != seal_layer_handle(handle, 'secret')
+        
+        # Sealed handles are well formed
+        username, userpass, geoserver_url, layer_name, workspace = \
+            RiabAPI().split_geoserver_layer_handle(sealed)
+        assert (geoserver_url, layer_name, workspace) == ('http://localhost:8080/geoserver', 
+                                                         'shakemap', 'hazard')
+        
+        assert unseal_layer_handle(sealed, 'secret') == handle
+        self.assertRaises(Exception, unseal_layer_handle, sealed, 'wrong')
+        self.assertRaises(Exception, unseal_layer_handle, handle, 'secret')
+    
+    
+    def test_connection_pool(self):
+        """Test that connections are verified once and reused
+        """
+        
+        pool = ConnectionPool(self.connect, max_age=0.2)
+        url = 'http://localhost:8080/geoserver'
+        for i in range(3):
+            assert pool.get(url, 'admin', 'geoserver') == (url, 'admin')
+        assert len(self.verified) == 1, self.verified
+        
+        # Wrong credentials are not kept
+        self.assertRaises(Exception, pool.get, url, 'admin', 'wrong')
+        self.assertRaises(Exception, pool.get, url, 'admin', 'wrong')
+        
+        # Connections are verified again when they get old
+        time.sleep(0.2)
+        pool.get(url, 'admin', 'geoserver')
+        assert len(self.verified) == 2, self.verified
+    
+    
+    def test_session_layer_handles(self):
+        """Test that API calls with session handles use the session
+        """
+        
+        api = RiabAPI(self.store)
+        api.connections = ConnectionPool(self.connect)
+        url = 'http://localhost:8080/geoserver'
+        
+        self.assertRaises(Exception, api.login, 'admin', 'wrong', url)
+        token = api.login('admin', 'geoserver', url)
+        
+        lh = api.create_session_layer_handle(token, 'shakemap', 'hazard')
+        assert lh == '%s:%s@%s/[hazard]/shakemap' % (SESSION_USERNAME, token, url), lh
+        
+        username, userpass, geoserver_url, layer_name, workspace = api.split_geoserver_layer_handle(lh)
+        assert geoserver_url == url
+        assert api._connect(username, userpass, geoserver_url) == (url, 'admin')
+        assert len(self.verified) == 1, self.verified
+        
+        # Sessions are bound to their geoserver
+        self.assertRaises(Exception, api._connect, username, userpass, 'http://elsewhere/geoserver')
+        
+        assert api.logout(token) == 'SUCCESS'
+        self.assertRaises(Exception, api._connect, username, userpass, geoserver_url)
+
+
+################################################################################
+
+if __name__ == '__main__':
+    suite = unittest.makeSuite(Test_Sessions, 'test')
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)